@@ -0,0 +1,344 @@
+"""Load test for the join gate and the Stars payment flow.
+
+Simulated users run /start -> promo_ selection -> forwarded channel post ->
+payment, with some updates redelivered, straight through the bot's update
+processor and handlers. Some users haven't joined the required channels, and
+some paying users start a second checkout before Telegram sends their charge
+again under a new update_id. The Bot API is replaced by an in-process stub, so no
+network or real token is needed. Set DATABASE_URL to load-test PostgreSQL
+storage instead of the SQLite file.
+
+    python load_test.py --users 2000 --duplicate-rate 0.05
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import tempfile
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from telegram import Update
+from telegram.ext import Application
+from telegram.request import BaseRequest
+
+STUB_TOKEN = '123456:LOADTEST'
+BOT_ID = 123456
+
+
+class StubRequest(BaseRequest):
+    """Answers Bot API calls in-process, with a small artificial latency"""
+
+    def __init__(self, latency=0.002, required_chats=(), unjoined=()):
+        self.latency = latency
+        self.required_chats = {str(chat_id) for chat_id in required_chats}
+        self.unjoined = set(unjoined)
+        self.calls = defaultdict(int)
+        self._message_id = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit('/', 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls[api_method] += 1
+        await asyncio.sleep(self.latency)
+        return 200, json.dumps({'ok': True, 'result': self.result_for(api_method, params)}).encode()
+
+    def result_for(self, api_method, params):
+        if api_method == 'getMe':
+            return {'id': BOT_ID, 'is_bot': True, 'first_name': 'Promo', 'username': 'loadtest_bot'}
+        if api_method == 'getChatMember':
+            user_id = int(params.get('user_id', 1))
+            left = str(params.get('chat_id')) in self.required_chats and user_id in self.unjoined
+            return {'status': 'left' if left else 'creator', 'is_anonymous': False,
+                    'user': {'id': user_id, 'is_bot': False, 'first_name': 'User'}}
+        if api_method == 'getChat':
+            return {'id': params.get('chat_id'), 'type': 'channel', 'title': 'Channel'}
+        if api_method.startswith(('send', 'edit', 'copy', 'forward')):
+            self._message_id += 1
+            return {'message_id': self._message_id, 'date': int(time.time()),
+                    'chat': {'id': params.get('chat_id') or 1, 'type': 'private'},
+                    'text': params.get('text', '')}
+        return True
+
+
+class UpdateGenerator:
+    """Realistic update JSON for the promotion flow of many users"""
+
+    def __init__(self, users, duplicate_rate, repay_rate=0.0, unjoined_rate=0.0, seed=1):
+        self.users = users
+        self.duplicate_rate = duplicate_rate
+        self.random = random.Random(seed)
+        self.user_ids = [100000 + index for index in range(users)]
+        self.unjoined = {user_id for user_id in self.user_ids if self.random.random() < unjoined_rate}
+        self.repaid = {user_id for user_id in self.user_ids if self.random.random() < repay_rate}
+        self._update_id = 0
+        self._message_id = 0
+
+    def _ids(self):
+        self._update_id += 1
+        self._message_id += 1
+        return self._update_id, self._message_id
+
+    @staticmethod
+    def _user(user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'}
+
+    def _message(self, user_id, **fields):
+        update_id, message_id = self._ids()
+        message = {'message_id': message_id, 'date': int(time.time()),
+                   'chat': {'id': user_id, 'type': 'private'}, 'from': self._user(user_id)}
+        message.update(fields)
+        return {'update_id': update_id, 'message': message}
+
+    def start(self, user_id):
+        return self._message(user_id, text='/start', entities=[{'type': 'bot_command', 'offset': 0, 'length': 6}])
+
+    def select_plan(self, user_id, plan='week'):
+        update_id, message_id = self._ids()
+        return {'update_id': update_id, 'callback_query': {
+            'id': str(update_id), 'from': self._user(user_id), 'chat_instance': str(user_id),
+            'data': f'promo_{plan}',
+            'message': {'message_id': message_id, 'date': int(time.time()),
+                        'chat': {'id': user_id, 'type': 'private'}, 'text': 'menu'}
+        }}
+
+    @staticmethod
+    def channel_id(user_id):
+        return -1000000000000 - user_id
+
+    def forward_channel_post(self, user_id):
+        channel_id = self.channel_id(user_id)
+        return self._message(
+            user_id, text='post', forward_date=int(time.time()),
+            forward_from_chat={'id': channel_id, 'type': 'channel', 'title': f'Channel {user_id}',
+                               'username': f'loadtest_channel_{user_id}'}
+        )
+
+    def payment(self, user_id, stars=10):
+        return self._message(user_id, successful_payment={
+            'currency': 'XTR', 'total_amount': stars, 'invoice_payload': f'promo-{user_id}',
+            'telegram_payment_charge_id': f'tg-charge-{user_id}',
+            'provider_payment_charge_id': f'provider-charge-{user_id}'
+        })
+
+    def streams(self):
+        """Per-user update lists, redelivered updates included"""
+        for user_id in self.user_ids:
+            stream = [self.start(user_id), self.select_plan(user_id),
+                      self.forward_channel_post(user_id), self.payment(user_id)]
+            if user_id in self.repaid:
+                # A second checkout is pending when the first charge arrives again
+                stream += [self.select_plan(user_id), self.forward_channel_post(user_id), self.payment(user_id)]
+            with_duplicates = []
+            for update in stream:
+                with_duplicates.append(update)
+                if self.random.random() < self.duplicate_rate:
+                    with_duplicates.append(update)
+            yield with_duplicates
+
+    def interleave(self):
+        """Mix all users' updates, keeping each user's own order"""
+        pending = [list(stream) for stream in self.streams()]
+        while pending:
+            stream = self.random.choice(pending)
+            yield stream.pop(0)
+            if not stream:
+                pending.remove(stream)
+
+
+class DatabaseTimer:
+    """Wraps Database methods to record call counts and time spent"""
+
+    def __init__(self, db):
+        self.stats = defaultdict(lambda: [0, 0.0, 0.0])
+        for name in dir(db):
+            method = getattr(db, name)
+            if name.startswith('_') or not callable(method):
+                continue
+            setattr(db, name, self._wrap(name, method))
+
+    def _wrap(self, name, method):
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - started
+                entry = self.stats[name]
+                entry[0] += 1
+                entry[1] += elapsed
+                entry[2] = max(entry[2], elapsed)
+        return timed
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def run_load_test(args):
+    os.environ.setdefault('BOT_TOKEN', STUB_TOKEN)
+    os.environ['CONCURRENT_UPDATES'] = str(args.concurrency)
+    for variable in ('GITHUB_TOKEN', 'TARGET_CHANNELS', 'ADMIN_USER_IDS'):
+        os.environ.pop(variable, None)
+
+    import promo_bot
+
+    promo = promo_bot.PromotionBot()
+    timer = DatabaseTimer(promo.db)
+    generator = UpdateGenerator(args.users, args.duplicate_rate, repay_rate=args.repay_rate,
+                                unjoined_rate=args.unjoined_rate, seed=args.seed)
+    stub = StubRequest(latency=args.api_latency,
+                       required_chats=[channel['id'] for channel in promo.required_channels],
+                       unjoined=generator.unjoined)
+
+    # Same wiring as PromotionBot, with the Bot API stubbed out
+    promo.application = (
+        Application.builder()
+        .token(STUB_TOKEN)
+        .request(stub)
+        .get_updates_request(StubRequest())
+        .concurrent_updates(promo_bot.PerUserUpdateProcessor(args.concurrency, admission=promo.admission,
+                                                             seen=promo.seen_updates))
+        .persistence(promo.persistence)
+        .build()
+    )
+    promo.setup_handlers()
+    application = promo.application
+
+    errors = []
+
+    async def on_error(update, context):
+        errors.append(repr(context.error))
+
+    application.add_error_handler(on_error)
+    await application.initialize()
+
+    updates = [Update.de_json(data, application.bot) for data in generator.interleave()]
+    latencies = []
+
+    async def feed(update):
+        started = time.perf_counter()
+        await application.update_processor.process_update(update, application.process_update(update))
+        latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(feed(update) for update in updates))
+    elapsed = time.perf_counter() - started
+
+    await application.update_persistence()
+    await application.shutdown()
+
+    return promo, stub, timer, generator, updates, latencies, elapsed, errors
+
+
+def check_payments(promo, generator, plan='week'):
+    """Every joined user paid once and got exactly one plan's days, users outside the join gate got nothing"""
+    conn = promo.db.engine.connect()
+    completed = dict(conn.execute('''
+        SELECT user_id, COUNT(*) FROM payments WHERE status = 'completed' GROUP BY user_id
+    ''').fetchall())
+    ledger = dict(conn.execute('SELECT user_id, COUNT(*) FROM payment_ledger GROUP BY user_id').fetchall())
+    ledger_stars = conn.execute('SELECT COALESCE(SUM(amount), 0) FROM payment_ledger').fetchone()[0]
+    promotions = {row[0]: row[1:] for row in conn.execute(
+        "SELECT channel_id, promotion_start, promotion_end FROM channels WHERE status = 'active'").fetchall()}
+    conn.close()
+
+    plan_length = timedelta(days=promo.pricing[plan]['days'])
+    joined = [user_id for user_id in generator.user_ids if user_id not in generator.unjoined]
+    double_counted = []
+    missing = []
+    for user_id in joined:
+        promotion = promotions.get(generator.channel_id(user_id))
+        if promotion is None or ledger.get(user_id, 0) == 0:
+            missing.append(user_id)
+            continue
+        length = datetime.fromisoformat(str(promotion[1])) - datetime.fromisoformat(str(promotion[0]))
+        if length != plan_length or ledger[user_id] > 1 or completed.get(user_id, 0) > 1:
+            double_counted.append(user_id)
+    leaked = [user_id for user_id in generator.unjoined
+              if user_id in ledger or generator.channel_id(user_id) in promotions]
+
+    return {
+        'paid_users': len(completed),
+        'expected_users': len(joined),
+        'repaid_users': len(generator.repaid),
+        'unjoined_users': len(generator.unjoined),
+        'double_counted': len(double_counted),
+        'missing': len(missing),
+        'paid_without_join': len(leaked),
+        'ledger_entries': sum(ledger.values()),
+        'ledger_stars': ledger_stars,
+        'rollup_stars': promo.db.get_stats_totals().get('stars_earned', 0),
+    }
+
+
+def print_report(args, promo, stub, timer, updates, latencies, elapsed, errors, payments):
+    print(f"\nUpdates processed: {len(updates)} in {elapsed:.2f}s ({len(updates) / elapsed:.0f} updates/s)")
+    print(f"Latency p50 {percentile(latencies, 0.5) * 1000:.1f} ms, "
+          f"p95 {percentile(latencies, 0.95) * 1000:.1f} ms, "
+          f"max {max(latencies) * 1000:.1f} ms")
+    print(f"Bot API calls: {dict(stub.calls)}")
+    print(f"Redelivered updates dropped: {promo.seen_updates.dropped}")
+
+    print("\nDatabase (calls, total s, max ms):")
+    for name, (calls, total, longest) in sorted(timer.stats.items(), key=lambda item: -item[1][1])[:10]:
+        print(f"  {name:32} {calls:7} {total:8.3f} {longest * 1000:8.1f}")
+
+    print(f"\nHandler errors: {len(errors)}")
+    for error in sorted(set(errors))[:5]:
+        print(f"  {error}")
+
+    print(f"\nPayments: {payments}")
+    ok = (payments['double_counted'] == 0 and payments['missing'] == 0 and payments['paid_without_join'] == 0
+          and payments['paid_users'] == payments['expected_users']
+          and payments['ledger_entries'] == payments['expected_users']
+          and payments['rollup_stars'] == payments['ledger_stars'])
+    print("✅ No payment double-counted" if ok else "❌ Payment check failed")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duplicate-rate', type=float, default=0.05,
+                        help='share of updates delivered twice')
+    parser.add_argument('--repay-rate', type=float, default=0.1,
+                        help='share of users whose charge arrives again under a new update_id')
+    parser.add_argument('--unjoined-rate', type=float, default=0.1,
+                        help="share of users who haven't joined the required channels")
+    parser.add_argument('--api-latency', type=float, default=0.002,
+                        help='seconds added to each stubbed Bot API call')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    # Configured before promo_bot is imported, so its basicConfig(level=INFO) is a no-op
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.WARNING)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    # The bot keeps promotion_bot.db in the working directory
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        promo, stub, timer, generator, updates, latencies, elapsed, errors = asyncio.run(run_load_test(args))
+        payments = check_payments(promo, generator)
+        ok = print_report(args, promo, stub, timer, updates, latencies, elapsed, errors, payments)
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,33 @@
 import os
+import re
 import sqlite3
 import json
 import base64
+import gzip
+import glob
+import shutil
+import hashlib
 import logging
 import asyncio
+import multiprocessing
+import random
+import socket
+import threading
+import zlib
+import time
 import traceback
+import contextlib
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters
-from telegram.error import TelegramError
-import requests
+from decimal import Decimal
+
+# Boot timing starts before the heavier third-party imports
+BOOT_STARTED = time.monotonic()
+
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.ext import Application, BasePersistence, BaseUpdateProcessor, CallbackContext, PersistenceInput, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters
+from telegram.error import BadRequest, ChatMigrated, Forbidden, RetryAfter, TelegramError
 from aiohttp import web
 
 # Configure logging
@@ -25,6 +43,12 @@ class HealthServer:
     def __init__(self):
         # Automatically get PORT from Render environment variable
         self.port = int(os.getenv('PORT', 10000))
+        # 'starting' until the bot is polling, then 'running'
+        self.state = 'starting'
+        self.startup = None
+        # Set by the bot in webhook mode - receives each update's JSON
+        self.on_update = None
+        self.webhook_path = os.getenv('WEBHOOK_PATH', '/telegram')
         self.app = web.Application()
         self.setup_routes()
         logger.info(f"🔧 Health server configured for port: {self.port}")
@@ -33,6 +57,7 @@ class HealthServer:
         self.app.router.add_get('/', self.health_check)
         self.app.router.add_get('/health', self.health_check)
         self.app.router.add_get('/status', self.status_check)
+        self.app.router.add_post(self.webhook_path, self.webhook)
     
     async def health_check(self, request):
         """Simple health check endpoint"""
@@ -46,13 +71,24 @@ class HealthServer:
     async def status_check(self, request):
         """Status check with bot info"""
         return web.json_response({
-            "status": "running",
+            "status": self.state,
             "service": "Telegram Promotion Bot",
             "timestamp": datetime.now().isoformat(),
             "environment": "production",
-            "port": self.port
+            "port": self.port,
+            "startup": self.startup.as_dict() if self.startup else None
         })
     
+    async def webhook(self, request):
+        """Telegram webhook - any replica behind the load balancer can take an update"""
+        if self.on_update is None:
+            return web.Response(status=503)
+        secret = os.getenv('WEBHOOK_SECRET')
+        if secret and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != secret:
+            return web.Response(status=403)
+        await self.on_update(await request.json())
+        return web.Response()
+    
     async def start(self):
         """Start the HTTP server"""
         runner = web.AppRunner(self.app)
@@ -65,9 +101,689 @@ class HealthServer:
 # Global health server instance
 health_server = HealthServer()
 
+class StartupReport:
+    """Time spent in each boot stage, logged and served on /status"""
+    
+    def __init__(self, started=None):
+        self.started = started or time.monotonic()
+        self.stages = {}
+        self.total = None
+    
+    @contextlib.contextmanager
+    def stage(self, name):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(name, time.monotonic() - started)
+    
+    def record(self, name, seconds):
+        self.stages[name] = round(seconds, 3)
+        logger.info(f"⏱️ Startup stage '{name}': {seconds:.3f}s")
+    
+    def finish(self):
+        self.total = round(time.monotonic() - self.started, 3)
+        stages = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in self.stages.items())
+        logger.info(f"⏱️ Startup finished in {self.total:.2f}s ({stages})")
+    
+    def as_dict(self):
+        return {
+            "stages": dict(self.stages),
+            "total": self.total if self.total is not None else round(time.monotonic() - self.started, 3)
+        }
+
+class SeenUpdates:
+    """Filter for redelivered updates - a ring of `size` bits over the newest update ids.
+    
+    An id is marked in the ring once its handler has finished; until then it is in
+    `in_progress`, which catches concurrent duplicates without losing the update if
+    the process dies first. The ring covers (high - size, high]. Ids below it are
+    stale redeliveries and dropped, unless they are so far below that Telegram must
+    have restarted its numbering, which it does after a week without updates. The
+    ring is merged into the database copy every few seconds and on shutdown, so
+    replicas share it and restarts keep it.
+    """
+    
+    # An id this many windows below the newest starts a new numbering
+    RESTART_GAP = 64
+    
+    def __init__(self, db, size=8192, name='polling'):
+        self.db = db
+        self.size = -(-size // 8) * 8
+        self.name = name
+        self.bits = bytearray(self.size // 8)
+        self.high = None
+        self.in_progress = set()
+        self.dropped = 0
+        self._dirty = False
+    
+    def load(self):
+        saved = self.db.get_seen_updates(self.name)
+        if saved and len(saved[1]) == len(self.bits):
+            self.high, self.bits = saved[0], bytearray(saved[1])
+            logger.info(f"✅ Seen-update window loaded up to update {self.high}")
+    
+    def _bit(self, update_id):
+        slot = update_id % self.size
+        return slot // 8, 1 << (slot % 8)
+    
+    def _renumbered(self, update_id):
+        return self.high - update_id > self.size * self.RESTART_GAP
+    
+    def start(self, update_id):
+        """Claim update_id for processing - False if it is a duplicate"""
+        duplicate = update_id in self.in_progress
+        if not duplicate and self.high is not None and update_id <= self.high:
+            if update_id > self.high - self.size:
+                index, mask = self._bit(update_id)
+                duplicate = bool(self.bits[index] & mask)
+            else:
+                duplicate = not self._renumbered(update_id)
+        
+        if duplicate:
+            self.dropped += 1
+            return False
+        self.in_progress.add(update_id)
+        return True
+    
+    def finish(self, update_id, processed=True):
+        """Release a claimed id, marking it seen if its handler ran"""
+        self.in_progress.discard(update_id)
+        if not processed:
+            return
+        
+        if self.high is None or update_id - self.high >= self.size or self._renumbered(update_id):
+            self.bits = bytearray(len(self.bits))
+            self.high = update_id
+        elif update_id > self.high:
+            # Slots the ring moves over belonged to ids `size` older
+            for stale in range(self.high + 1, update_id + 1):
+                index, mask = self._bit(stale)
+                self.bits[index] &= ~mask & 0xFF
+            self.high = update_id
+        elif update_id <= self.high - self.size:
+            # The window moved past it while the handler ran
+            return
+        
+        index, mask = self._bit(update_id)
+        self.bits[index] |= mask
+        self._dirty = True
+    
+    def _window(self, ring_high, bits, high):
+        """Bits of a ring that fall inside the window (high - size, high], as an int"""
+        count = ring_high - (high - self.size)
+        if count <= 0:
+            return 0
+        first = (ring_high - count + 1) % self.size
+        mask = ((1 << count) - 1) << first
+        mask = (mask | (mask >> self.size)) & ((1 << self.size) - 1)
+        return int.from_bytes(bits, 'little') & mask
+    
+    def _union(self, ring_high, bits, saved):
+        """Union of a ring and the saved one - other replicas' updates count as seen too"""
+        if saved and len(saved[1]) == len(bits) and abs(saved[0] - ring_high) <= self.size * self.RESTART_GAP:
+            high = max(ring_high, saved[0])
+            merged = self._window(ring_high, bits, high) | self._window(saved[0], saved[1], high)
+            return high, merged.to_bytes(len(bits), 'little')
+        return ring_high, bytes(bits)
+    
+    def _merge(self, saved):
+        self.high, bits = self._union(self.high, self.bits, saved)
+        self.bits = bytearray(bits)
+        return self.high, bits
+    
+    def flush(self):
+        """Blocking merge into the database copy - for shutdown"""
+        if not self._dirty:
+            return
+        self.db.merge_seen_updates(self.name, self._merge)
+        self._dirty = False
+    
+    async def save(self):
+        """flush() on a thread - the merge waits for the write lock, the event loop must not"""
+        if not self._dirty:
+            return
+        self._dirty = False
+        # The transaction merges a copy; the live ring keeps taking updates meanwhile
+        high, bits = self.high, bytes(self.bits)
+        stored = []
+        
+        def merge(saved):
+            stored.append(self._union(high, bits, saved))
+            return stored[-1]
+        
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self.db.merge_seen_updates, self.name, merge)
+        except Exception:
+            self._dirty = True
+            raise
+        self._merge(stored[-1])
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Process updates concurrently while keeping each user's updates in order.
+    
+    The base class semaphore only bounds how many updates may be pending; the
+    max_concurrent_updates workers are a semaphore of our own, taken after the
+    user's lock so one busy user can't occupy every worker while their updates
+    queue up.
+    """
+    
+    def __init__(self, max_concurrent_updates, admission=None, seen=None, max_pending_updates=1024):
+        super().__init__(max(max_pending_updates, max_concurrent_updates))
+        self.workers = max_concurrent_updates
+        self._worker_slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        # user/chat key -> [lock, number of updates holding or waiting for it]
+        self._user_locks = {}
+        self.admission = admission
+        self.seen = seen
+    
+    @staticmethod
+    def get_update_key(update):
+        """Key used to serialize updates - user first, chat for channel posts"""
+        if not isinstance(update, Update):
+            return None
+        if update.effective_user:
+            return ('user', update.effective_user.id)
+        if update.effective_chat:
+            return ('chat', update.effective_chat.id)
+        return None
+    
+    async def do_process_update(self, update, coroutine):
+        # Redelivered updates are dropped before they cost any API or database work
+        update_id = update.update_id if self.seen and isinstance(update, Update) else None
+        if update_id is not None and not self.seen.start(update_id):
+            coroutine.close()
+            logger.info(f"🔁 Dropped redelivered update {update_id}")
+            return
+        
+        try:
+            await self._process_in_order(update, coroutine)
+        except BaseException:
+            # Not handled - a redelivery has to run it
+            if update_id is not None:
+                self.seen.finish(update_id, processed=False)
+            raise
+        if update_id is not None:
+            self.seen.finish(update_id)
+    
+    async def _process_in_order(self, update, coroutine):
+        """Wait for the user's previous update before taking a worker slot"""
+        if self.admission:
+            self.admission.in_flight += 1
+        try:
+            key = self.get_update_key(update)
+            if key is None:
+                await self._admit(update, coroutine)
+                return
+            
+            entry = self._user_locks.setdefault(key, [asyncio.Lock(), 0])
+            entry[1] += 1
+            try:
+                async with entry[0]:
+                    await self._admit(update, coroutine)
+            finally:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    self._user_locks.pop(key, None)
+        finally:
+            if self.admission:
+                self.admission.in_flight -= 1
+    
+    async def _admit(self, update, coroutine):
+        if self.admission and isinstance(update, Update):
+            await self.admission.run(update, coroutine, self._run)
+        else:
+            await self._run(update, coroutine)
+    
+    async def _run(self, update, coroutine):
+        async with self._worker_slots:
+            await coroutine
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        self._user_locks.clear()
+
+class AdmissionController:
+    """Backpressure in front of the handlers.
+    
+    Tracks updates in flight and an estimate of Bot API calls per second. When
+    either runs out, /start is answered from cache without membership checks and
+    expensive flows (promotion, payment, backup) wait for one of a few slots.
+    Without congestion expensive flows run unrestricted.
+    """
+    
+    def __init__(self, degraded_response, max_in_flight=64, api_rate=25, expensive_slots=4, full_start_cost=2):
+        self.degraded_response = degraded_response
+        self.max_in_flight = max_in_flight
+        self.api_budget = RateLimiter(api_rate)
+        self.expensive_slots = expensive_slots
+        self.full_start_cost = full_start_cost
+        self.in_flight = 0
+        self.shed_count = 0
+        self._expensive = None
+    
+    @staticmethod
+    def classify(update):
+        """'cheap' - can be answered from cache, 'expensive' - many API/DB calls, else 'normal'"""
+        if update.callback_query:
+            data = update.callback_query.data or ''
+            if data.startswith('promo_') or data in ('verify_join', 'admin_backup', 'admin_restore'):
+                return 'expensive'
+            return 'normal'
+        
+        message = update.message
+        if not message:
+            return 'normal'
+        if message.forward_date or message.successful_payment:
+            return 'expensive'
+        text = message.text or ''
+        if text.startswith('/start'):
+            return 'cheap'
+        if text.startswith(('/promote', '/backup', '/health', '/check_join')):
+            return 'expensive'
+        return 'normal'
+    
+    def overloaded(self):
+        return self.in_flight > self.max_in_flight or not self.api_budget.try_acquire(self.full_start_cost)
+    
+    def congested(self):
+        """Like overloaded, for flows that already took their API budget"""
+        return self.in_flight > self.max_in_flight or self.api_budget.tokens < 0
+    
+    async def run(self, update, coroutine, process):
+        kind = self.classify(update)
+        
+        if kind == 'cheap':
+            if self.overloaded():
+                coroutine.close()
+                self.shed_count += 1
+                try:
+                    await self.degraded_response(update)
+                except Exception as e:
+                    logger.error(f"Degraded response error: {e}")
+                return
+        elif kind == 'expensive':
+            self.api_budget.consume(3)
+            if self.congested():
+                if self._expensive is None:
+                    self._expensive = asyncio.Semaphore(self.expensive_slots)
+                async with self._expensive:
+                    await process(update, coroutine)
+                return
+        else:
+            self.api_budget.consume(1)
+        
+        await process(update, coroutine)
+
+def convert_datetime(value):
+    """sqlite3 converter for DATETIME columns, written by Python or CURRENT_TIMESTAMP"""
+    try:
+        return datetime.fromisoformat(value.decode())
+    except ValueError:
+        return None
+
+sqlite3.register_converter('DATETIME', convert_datetime)
+
+class Record:
+    """Compact row record - __slots__ lists the selected columns in order"""
+    __slots__ = ()
+    
+    @classmethod
+    def columns(cls):
+        return ', '.join(cls.__slots__)
+    
+    @classmethod
+    def from_row(cls, row):
+        record = cls.__new__(cls)
+        for name, value in zip(cls.__slots__, row):
+            setattr(record, name, value)
+        return record
+    
+    def __repr__(self):
+        fields = ', '.join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+class Channel(Record):
+    __slots__ = ('id', 'channel_id', 'channel_username', 'channel_title', 'owner_id',
+                 'promotion_start', 'promotion_end', 'status', 'created_at')
+
+class TargetChannel(Record):
+    __slots__ = ('id', 'channel_id', 'channel_username', 'channel_title', 'added_at', 'auto_added')
+
+class PromotionMessage(Record):
+    __slots__ = ('id', 'channel_id', 'message_id', 'posted_at', 'delete_at', 'status')
+
+class SQLiteEngine:
+    """Default storage - a SQLite file through the stdlib driver"""
+    dialect = 'sqlite'
+    
+    def __init__(self, path='promotion_bot.db'):
+        self.path = path
+    
+    def connect(self, **kwargs):
+        return sqlite3.connect(self.path, **kwargs)
+    
+    def close(self):
+        pass
+
+class PostgresEngine:
+    """PostgreSQL storage on an asyncpg connection pool.
+    
+    The pool runs on a private event loop thread. connect() hands out a pooled
+    connection with the sqlite3 API the Database methods are written against
+    and translates their SQLite dialect - ? placeholders, INSERT OR REPLACE /
+    IGNORE, rowid, datetime('now'), julianday() and column types in DDL.
+    Translations are cached per statement and run through asyncpg's statement
+    cache; executemany() is one prepared statement fed every row on the server.
+    
+    The API stays synchronous - each call waits for the pool's loop thread - so
+    async code runs Database calls through AsyncDatabase.
+    """
+    dialect = 'postgresql'
+    path = None
+    
+    # Column types of CREATE/ALTER TABLE statements; ids need 64 bits
+    TYPES = [
+        (re.compile(r"\bINTEGER PRIMARY KEY AUTOINCREMENT\b", re.I), "BIGSERIAL PRIMARY KEY"),
+        (re.compile(r"\bINTEGER\b", re.I), "BIGINT"),
+        (re.compile(r"\bDATETIME DEFAULT CURRENT_TIMESTAMP\b", re.I), "TIMESTAMP DEFAULT (now() AT TIME ZONE 'UTC')"),
+        (re.compile(r"\bDATETIME\b", re.I), "TIMESTAMP"),
+        (re.compile(r"\bREAL\b", re.I), "DOUBLE PRECISION"),
+        (re.compile(r"\bBLOB\b", re.I), "BYTEA"),
+    ]
+    
+    # SQLite's datetime('now') and julianday() work in UTC
+    FUNCTIONS = [
+        (re.compile(r"julianday\('now'\)", re.I), "(EXTRACT(EPOCH FROM (now() AT TIME ZONE 'UTC')) / 86400.0)"),
+        (re.compile(r"julianday\((\w+)\)", re.I), r"(EXTRACT(EPOCH FROM \1) / 86400.0)"),
+        (re.compile(r"datetime\('now'\)", re.I), "(now() AT TIME ZONE 'UTC')"),
+        (re.compile(r"\browid\b", re.I), "ctid"),
+    ]
+    
+    INSERT_OR = re.compile(r"INSERT\s+OR\s+(REPLACE|IGNORE)\s+INTO\s+(\w+)", re.I)
+    INSERT_INTO = re.compile(r"INSERT\s+INTO\s+(\w+)", re.I)
+    PLACEHOLDER = re.compile(r"'[^']*'|\?")
+    
+    # Serializes writers the way SQLite's BEGIN IMMEDIATE does
+    WRITE_LOCK = 0x70726F6D6F
+    
+    def __init__(self, dsn, min_size=1, max_size=10):
+        try:
+            import asyncpg
+        except ImportError:
+            raise RuntimeError("PostgreSQL storage needs asyncpg - pip install asyncpg")
+        
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name='postgres-engine', daemon=True)
+        self._thread.start()
+        self._tables = {}   # table -> (columns, conflict key for INSERT OR REPLACE)
+        self._statements = {}   # SQLite statement -> (statement, returns new id, parameter types)
+        
+        async def create_pool():
+            return await asyncpg.create_pool(dsn, min_size=min_size, max_size=max_size)
+        self.pool = self.run(create_pool())
+        logger.info(f"✅ PostgreSQL pool ready ({min_size}-{max_size} connections)")
+    
+    def run(self, coroutine):
+        """Run a coroutine on the pool's loop and wait for the result"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+    
+    def connect(self, detect_types=0, isolation_level='', **kwargs):
+        return PostgresConnection(self, self.run(self._acquire()), detect_types, autocommit=isolation_level is None)
+    
+    async def _acquire(self):
+        return await self.pool.acquire()
+    
+    def close(self):
+        self.run(self.pool.close())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+    
+    async def statement(self, conn, sql):
+        """Translated statement, whether it returns the new id and its parameter types"""
+        cached = self._statements.get(sql)
+        if cached is None:
+            translated, returns_id = await self.translate(conn, sql, returning_id=True)
+            types = (await conn.prepare(translated)).get_parameters()
+            cached = self._statements[sql] = (translated, returns_id, types)
+        return cached
+    
+    async def table_info(self, conn, table):
+        if table not in self._tables:
+            columns = [row[0] for row in await conn.fetch('''
+                SELECT column_name FROM information_schema.columns
+                WHERE table_schema = current_schema() AND table_name = $1
+                ORDER BY ordinal_position
+            ''', table)]
+            keys = [list(row[0]) for row in await conn.fetch('''
+                SELECT array_agg(a.attname::text ORDER BY k.ord)
+                FROM pg_index i
+                CROSS JOIN LATERAL unnest(i.indkey::int2[]) WITH ORDINALITY AS k(attnum, ord)
+                JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = k.attnum
+                WHERE i.indrelid = to_regclass($1) AND i.indisunique
+                GROUP BY i.indexrelid
+            ''', table)]
+            keys = [key for key in keys if key != ['id']]
+            self._tables[table] = (columns, keys[0] if keys else None)
+        return self._tables[table]
+    
+    async def translate(self, conn, sql, returning_id=False):
+        """SQLite statement -> (PostgreSQL statement, whether it returns the new id)"""
+        command = sql.split(None, 1)[0].upper()
+        if command in ('CREATE', 'ALTER'):
+            for pattern, replacement in self.TYPES:
+                sql = pattern.sub(replacement, sql)
+        for pattern, replacement in self.FUNCTIONS:
+            sql = pattern.sub(replacement, sql)
+        
+        numbers = iter(range(1, sql.count('?') + 1))
+        sql = self.PLACEHOLDER.sub(lambda m: f"${next(numbers)}" if m.group(0) == '?' else m.group(0), sql)
+        
+        if command != 'INSERT':
+            return sql, False
+        
+        insert_or = self.INSERT_OR.match(sql)
+        if insert_or:
+            action, table = insert_or.group(1).upper(), insert_or.group(2)
+            sql = f"INSERT INTO {table}{sql[insert_or.end():]}"
+            if action == 'IGNORE':
+                sql += " ON CONFLICT DO NOTHING"
+            else:
+                columns, key = await self.table_info(conn, table)
+                if key:
+                    # Like REPLACE, columns left out of the insert go back to their defaults
+                    updates = ', '.join(f"{c} = EXCLUDED.{c}" for c in columns if c != 'id' and c not in key)
+                    sql += f" ON CONFLICT ({', '.join(key)}) DO " + (f"UPDATE SET {updates}" if updates else "NOTHING")
+        
+        if returning_id and 'RETURNING' not in sql.upper():
+            columns, _ = await self.table_info(conn, self.INSERT_INTO.match(sql).group(1))
+            if 'id' in columns:
+                return sql + " RETURNING id", True
+        return sql, False
+
+class PostgresConnection:
+    """sqlite3-style connection over one pooled asyncpg connection"""
+    
+    WRITES = ('INSERT', 'UPDATE', 'DELETE')
+    
+    def __init__(self, engine, conn, detect_types, autocommit=False):
+        self.engine = engine
+        self.conn = conn
+        # Like sqlite3 without PARSE_DECLTYPES, timestamps are returned as text
+        self.detect_types = detect_types
+        self.autocommit = autocommit
+        self.in_transaction = False
+    
+    def cursor(self):
+        return PostgresCursor(self)
+    
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+    
+    def executemany(self, sql, rows):
+        return self.cursor().executemany(sql, rows)
+    
+    def commit(self):
+        if self.in_transaction:
+            self.engine.run(self.conn.execute('COMMIT'))
+            self.in_transaction = False
+    
+    def rollback(self):
+        if self.in_transaction:
+            self.engine.run(self.conn.execute('ROLLBACK'))
+            self.in_transaction = False
+    
+    def close(self):
+        if self.conn is None:
+            return
+        try:
+            self.rollback()
+        finally:
+            self.engine.run(self.engine.pool.release(self.conn))
+            self.conn = None
+    
+    async def _begin(self, command):
+        # Like sqlite3, only writes open a transaction - reads run on their own
+        if not self.autocommit and not self.in_transaction and command in self.WRITES:
+            await self.conn.execute('BEGIN')
+            self.in_transaction = True
+    
+    async def _execute(self, sql, params):
+        sql = sql.strip()
+        command = sql.split(None, 1)[0].upper()
+        
+        if command in ('BEGIN', 'COMMIT', 'END', 'ROLLBACK'):
+            if command == 'BEGIN':
+                await self.conn.execute('BEGIN')
+                if 'IMMEDIATE' in sql.upper() or 'EXCLUSIVE' in sql.upper():
+                    await self.conn.execute('SELECT pg_advisory_xact_lock($1)', self.engine.WRITE_LOCK)
+                self.in_transaction = True
+            elif self.in_transaction:
+                await self.conn.execute('ROLLBACK' if command == 'ROLLBACK' else 'COMMIT')
+                self.in_transaction = False
+            return [], -1, None
+        
+        await self._begin(command)
+        
+        if command in ('CREATE', 'ALTER', 'DROP'):
+            sql, _ = await self.engine.translate(self.conn, sql)
+            await self.conn.execute(sql)
+            self.engine._tables.clear()
+            self.engine._statements.clear()
+            return [], -1, None
+        
+        sql, returns_id, types = await self.engine.statement(self.conn, sql)
+        args = self._coerce(params, types)
+        
+        if command in self.WRITES and not returns_id and 'RETURNING' not in sql.upper():
+            status = await self.conn.execute(sql, *args)
+            return [], int(status.split()[-1]), None
+        
+        rows = await self.conn.fetch(sql, *args)
+        rowcount = len(rows) if command in self.WRITES else -1
+        if returns_id:
+            return [], rowcount, rows[0][0] if rows else None
+        return [tuple(self._value(value) for value in row) for row in rows], rowcount, None
+    
+    async def _executemany(self, sql, rows):
+        if not rows:
+            return
+        sql = sql.strip()
+        await self._begin(sql.split(None, 1)[0].upper())
+        sql, _, types = await self.engine.statement(self.conn, sql)
+        await self.conn.executemany(sql, [self._coerce(row, types) for row in rows])
+    
+    @staticmethod
+    def _coerce(params, types):
+        """Adapt Python values the way SQLite's loose typing would accept them"""
+        values = []
+        for value, pg_type in zip(params, types):
+            kind = pg_type.name
+            if value is None:
+                pass
+            elif kind in ('int2', 'int4', 'int8'):
+                value = int(value)
+            elif kind == 'bool' and not isinstance(value, bool):
+                value = value.lower() in ('1', 'true', 't') if isinstance(value, str) else bool(value)
+            elif kind in ('timestamp', 'timestamptz') and isinstance(value, str):
+                value = datetime.fromisoformat(value)
+            elif kind in ('float4', 'float8') and not isinstance(value, float):
+                value = float(value)
+            elif kind in ('text', 'varchar', 'bpchar') and not isinstance(value, str):
+                value = str(value)
+            values.append(value)
+        return values
+    
+    def _value(self, value):
+        if isinstance(value, Decimal):
+            # SUM() of integers comes back as numeric
+            return int(value) if value == value.to_integral_value() else float(value)
+        if isinstance(value, datetime) and not self.detect_types:
+            return str(value)
+        return value
+
+class PostgresCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.rowcount = -1
+        self.lastrowid = None
+        self._rows = []
+        self._position = 0
+    
+    def execute(self, sql, params=()):
+        connection = self.connection
+        self._rows, self.rowcount, self.lastrowid = connection.engine.run(connection._execute(sql, params))
+        self._position = 0
+        return self
+    
+    def executemany(self, sql, rows):
+        connection = self.connection
+        connection.engine.run(connection._executemany(sql, list(rows)))
+        self._rows, self.rowcount, self._position = [], -1, 0
+        return self
+    
+    def fetchone(self):
+        if self._position >= len(self._rows):
+            return None
+        self._position += 1
+        return self._rows[self._position - 1]
+    
+    def fetchall(self):
+        rows = self._rows[self._position:]
+        self._position = len(self._rows)
+        return rows
+
+def create_engine(url=None):
+    """Storage engine for DATABASE_URL - the SQLite file unless it's a PostgreSQL URL"""
+    if url and url.startswith(('postgres://', 'postgresql://')):
+        return PostgresEngine(
+            url,
+            min_size=int(os.getenv('DATABASE_POOL_MIN', 1)),
+            max_size=int(os.getenv('DATABASE_POOL_MAX', 10))
+        )
+    if url and url.startswith('sqlite:///'):
+        return SQLiteEngine(url[len('sqlite:///'):])
+    if url:
+        logger.warning("⚠️ Unsupported DATABASE_URL, using promotion_bot.db")
+    return SQLiteEngine()
+
 class Database:
-    def __init__(self):
-        self.db_path = "promotion_bot.db"
+    # Tables carried by export_data/import_data
+    EXPORT_TABLES = ('channels', 'admins', 'payments', 'payment_ledger', 'user_joins', 'target_channels', 'promotion_messages', 'user_state', 'stats_rollup')
+    
+    # Bucket of the all-time stats rollup
+    ALL_TIME = datetime(2000, 1, 1)
+    
+    def __init__(self, engine=None, cache_max_age=300):
+        # SQLite file by default, DATABASE_URL can point at PostgreSQL
+        self.engine = engine or create_engine(os.getenv('DATABASE_URL'))
+        self.db_path = self.engine.path
+        # Read-through cache of the active/target channel sets: name -> (version, deadline, rows).
+        # Writes in this process bump the version, max age covers writes from worker processes
+        self.cache_max_age = cache_max_age
+        self._cache = {}
+        self._cache_versions = {'active_channels': 0, 'target_channels': 0}
         try:
             self.init_db()
             logger.info("✅ Database initialized successfully")
@@ -75,9 +791,25 @@ class Database:
             logger.error(f"❌ Database initialization failed: {e}")
             raise
     
+    def invalidate_cache(self, *names):
+        for name in names:
+            self._cache_versions[name] += 1
+            self._cache.pop(name, None)
+    
+    def _cached(self, name):
+        entry = self._cache.get(name)
+        if entry and entry[0] == self._cache_versions[name] and time.monotonic() < entry[1]:
+            return entry[2]
+        return None
+    
+    def _store_cache(self, name, version, rows, ttl):
+        # A write during the query bumped the version - don't cache stale rows
+        if version == self._cache_versions[name]:
+            self._cache[name] = (version, time.monotonic() + min(ttl, self.cache_max_age), rows)
+    
     def init_db(self):
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = self.engine.connect()
             cursor = conn.cursor()
             
             # Channels table
@@ -118,6 +850,22 @@ class Database:
                 )
             ''')
             
+            # Received Stars payments, one row per Telegram charge - a redelivered
+            # or concurrently processed payment update is applied only once
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS payment_ledger (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    charge_id TEXT UNIQUE,
+                    payment_id INTEGER,
+                    user_id INTEGER,
+                    channel_id INTEGER,
+                    amount INTEGER,
+                    days INTEGER,
+                    promotion_end DATETIME,
+                    received_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            
             # User join status table
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS user_joins (
@@ -154,6 +902,121 @@ class Database:
                 )
             ''')
             
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_promotion_messages_due
+                ON promotion_messages (status, delete_at)
+            ''')
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_promotion_messages_posted
+                ON promotion_messages (posted_at)
+            ''')
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_user_joins_checked
+                ON user_joins (checked_at)
+            ''')
+            
+            # Conversation state table (persisted context.user_data, compact JSON per user)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS user_state (
+                    user_id INTEGER PRIMARY KEY,
+                    data TEXT NOT NULL,
+                    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            
+            # Target channel health (circuit breaker state per target)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS target_health (
+                    channel_id INTEGER PRIMARY KEY,
+                    state TEXT DEFAULT 'closed',
+                    failures INTEGER DEFAULT 0,
+                    trips INTEGER DEFAULT 0,
+                    last_error TEXT,
+                    last_failure_at DATETIME,
+                    open_until DATETIME,
+                    fatal_failures INTEGER DEFAULT 0
+                )
+            ''')
+            
+            # Databases from before the consecutive fatal counter
+            self._add_column(cursor, 'target_health', 'fatal_failures', 'INTEGER DEFAULT 0')
+            
+            # Broadcast job queue shared with the worker processes
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS broadcast_jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    kind TEXT NOT NULL,
+                    shard INTEGER NOT NULL,
+                    payload TEXT,
+                    status TEXT DEFAULT 'pending',
+                    lease_owner TEXT,
+                    lease_until DATETIME,
+                    attempts INTEGER DEFAULT 0,
+                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    finished_at DATETIME
+                )
+            ''')
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_broadcast_jobs_shard
+                ON broadcast_jobs (shard, status)
+            ''')
+            
+            # Scheduled job state - survives restarts so long intervals still complete
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS scheduled_jobs (
+                    name TEXT PRIMARY KEY,
+                    interval INTEGER,
+                    next_run DATETIME,
+                    running_since DATETIME,
+                    last_run DATETIME,
+                    last_status TEXT,
+                    run_count INTEGER DEFAULT 0,
+                    running_owner TEXT,
+                    running_until DATETIME
+                )
+            ''')
+            
+            # Runs are leased by the replica running them, so a new leader leaves live ones alone
+            self._add_column(cursor, 'scheduled_jobs', 'running_owner', 'TEXT')
+            self._add_column(cursor, 'scheduled_jobs', 'running_until', 'DATETIME')
+            
+            # Scheduled job run history
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS job_runs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    name TEXT,
+                    started_at DATETIME,
+                    finished_at DATETIME,
+                    status TEXT,
+                    error TEXT
+                )
+            ''')
+            
+            # Window of recently seen update ids, see SeenUpdates
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS seen_updates (
+                    name TEXT PRIMARY KEY,
+                    high_update_id INTEGER,
+                    bitmap BLOB,
+                    updated_at DATETIME
+                )
+            ''')
+            
+            # Counters per hour, day and all time, kept up to date by the writes that change them
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS stats_rollup (
+                    period TEXT,
+                    bucket DATETIME,
+                    metric TEXT,
+                    value INTEGER DEFAULT 0,
+                    PRIMARY KEY (period, bucket, metric)
+                )
+            ''')
+            
+            # Databases from before the rollup start it from the rows they still have
+            if cursor.execute('SELECT COUNT(*) FROM stats_rollup').fetchone()[0] == 0:
+                self._rebuild_stats(cursor)
+            
             # Insert default admin if specified
             admin_ids = os.getenv('ADMIN_USER_IDS', '')
             if admin_ids:
@@ -183,6 +1046,14 @@ class Database:
                             logger.error(f"❌ Error adding target channel {channel_id}: {e}")
             
             conn.commit()
+            
+            # Incremental auto-vacuum lets retention runs shrink the file; an
+            # existing database needs one full VACUUM for the mode to apply
+            if self.engine.dialect == 'sqlite' and cursor.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+                cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+                cursor.execute('VACUUM')
+                logger.info("✅ Database switched to incremental auto-vacuum")
+            
             conn.close()
             logger.info("✅ Database tables created successfully")
             
@@ -190,67 +1061,163 @@ class Database:
             logger.error(f"❌ Database initialization failed: {e}")
             raise
     
+    def _add_column(self, cursor, table, column, definition):
+        """Add a column to a table created by an older release"""
+        if self.engine.dialect == 'sqlite':
+            columns = [row[1] for row in cursor.execute(f'PRAGMA table_info({table})').fetchall()]
+            if column not in columns:
+                cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+        else:
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} {definition}')
+    
     def add_channel(self, channel_id, channel_username, channel_title, owner_id, duration_days):
-        conn = sqlite3.connect(self.db_path)
+        """Start a promotion, or extend the channel's running one"""
+        conn = self.engine.connect(timeout=30, isolation_level=None)
         cursor = conn.cursor()
         
-        promotion_start = datetime.now()
-        promotion_end = promotion_start + timedelta(days=duration_days)
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            self._extend_promotion(cursor, channel_id, channel_username, channel_title, owner_id, duration_days)
+            cursor.execute('COMMIT')
+            return True
+        except Exception as e:
+            if conn.in_transaction:
+                cursor.execute('ROLLBACK')
+            logger.error(f"Error adding channel: {e}")
+            return False
+        finally:
+            conn.close()
+            self.invalidate_cache('active_channels')
+    
+    def record_payment(self, charge_id, payment_id, user_id, channel_id, channel_username, channel_title, amount, duration_days):
+        """Apply a received payment exactly once.
+        
+        The ledger entry, the completed payment and the promotion extension are
+        written in one transaction, keyed on the Telegram charge id. Returns the new
+        promotion end, None if the charge was already applied, False on error.
+        """
+        conn = self.engine.connect(timeout=30, isolation_level=None)
+        cursor = conn.cursor()
         
         try:
+            cursor.execute('BEGIN IMMEDIATE')
             cursor.execute('''
-                INSERT OR REPLACE INTO channels 
-                (channel_id, channel_username, channel_title, owner_id, promotion_start, promotion_end)
+                INSERT OR IGNORE INTO payment_ledger (charge_id, payment_id, user_id, channel_id, amount, days)
                 VALUES (?, ?, ?, ?, ?, ?)
-            ''', (channel_id, channel_username, channel_title, owner_id, promotion_start, promotion_end))
-            conn.commit()
-            return True
+            ''', (charge_id, payment_id, user_id, channel_id, amount, duration_days))
+            if cursor.rowcount == 0:
+                cursor.execute('ROLLBACK')
+                return None
+            
+            cursor.execute('''
+                UPDATE payments SET status = 'completed' 
+                WHERE id = ? AND status != 'completed'
+            ''', (payment_id,))
+            if cursor.rowcount:
+                self._bump_stats(cursor, datetime.now(), payments_completed=1, stars_earned=amount)
+            
+            promotion_end = self._extend_promotion(cursor, channel_id, channel_username, channel_title, user_id, duration_days)
+            cursor.execute('UPDATE payment_ledger SET promotion_end = ? WHERE charge_id = ?', (promotion_end, charge_id))
+            cursor.execute('COMMIT')
+            return promotion_end
         except Exception as e:
-            logger.error(f"Error adding channel: {e}")
+            if conn.in_transaction:
+                cursor.execute('ROLLBACK')
+            logger.error(f"Error recording payment {charge_id}: {e}")
             return False
         finally:
             conn.close()
+            self.invalidate_cache('active_channels')
+    
+    def _extend_promotion(self, cursor, channel_id, channel_username, channel_title, owner_id, duration_days):
+        """Add days to a running promotion, or start a new one - returns the promotion end"""
+        now = datetime.now()
+        cursor.execute('SELECT promotion_end, status FROM channels WHERE channel_id = ?', (channel_id,))
+        row = cursor.fetchone()
+        current_end = datetime.fromisoformat(str(row[0])) if row and row[0] else None
+        
+        if row is None:
+            promotion_end = now + timedelta(days=duration_days)
+            cursor.execute('''
+                INSERT INTO channels 
+                (channel_id, channel_username, channel_title, owner_id, promotion_start, promotion_end)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (channel_id, channel_username, channel_title, owner_id, now, promotion_end))
+        elif row[1] == 'active' and current_end and current_end > now:
+            # Running promotion - keep its start, push its end
+            promotion_end = current_end + timedelta(days=duration_days)
+            cursor.execute('''
+                UPDATE channels SET channel_username = ?, channel_title = ?, owner_id = ?, promotion_end = ?
+                WHERE channel_id = ?
+            ''', (channel_username, channel_title, owner_id, promotion_end, channel_id))
+        else:
+            promotion_end = now + timedelta(days=duration_days)
+            cursor.execute('''
+                UPDATE channels SET channel_username = ?, channel_title = ?, owner_id = ?,
+                    promotion_start = ?, promotion_end = ?, status = 'active'
+                WHERE channel_id = ?
+            ''', (channel_username, channel_title, owner_id, now, promotion_end, channel_id))
+        
+        self._bump_stats(cursor, now, promotions_started=1)
+        return promotion_end
     
     def get_active_channels(self):
-        conn = sqlite3.connect(self.db_path)
+        """Active promotions - cached until the next one ends, treat the list as read-only"""
+        channels = self._cached('active_channels')
+        if channels is not None:
+            return channels
+        
+        version = self._cache_versions['active_channels']
+        conn = self.engine.connect(detect_types=sqlite3.PARSE_DECLTYPES)
         cursor = conn.cursor()
         
-        cursor.execute('''
-            SELECT * FROM channels 
+        cursor.execute(f'''
+            SELECT {Channel.columns()} FROM channels 
             WHERE promotion_end > datetime('now') AND status = 'active'
         ''')
+        channels = [Channel.from_row(row) for row in cursor.fetchall()]
         
-        channels = cursor.fetchall()
+        # Seconds until the first active promotion drops out of this query
+        cursor.execute('''
+            SELECT MIN(julianday(promotion_end) - julianday('now')) * 86400 FROM channels
+            WHERE promotion_end > datetime('now') AND status = 'active'
+        ''')
+        next_end = cursor.fetchone()[0]
         conn.close()
+        
+        self._store_cache('active_channels', version, channels, next_end if next_end is not None else self.cache_max_age)
         return channels
     
     def get_expired_channels(self):
-        conn = sqlite3.connect(self.db_path)
+        conn = self.engine.connect(detect_types=sqlite3.PARSE_DECLTYPES)
         cursor = conn.cursor()
         
-        cursor.execute('''
-            SELECT * FROM channels 
+        cursor.execute(f'''
+            SELECT {Channel.columns()} FROM channels 
             WHERE promotion_end <= datetime('now') AND status = 'active'
         ''')
         
-        channels = cursor.fetchall()
+        channels = [Channel.from_row(row) for row in cursor.fetchall()]
         conn.close()
         return channels
     
     def expire_channel(self, channel_id):
-        conn = sqlite3.connect(self.db_path)
+        conn = self.engine.connect()
         cursor = conn.cursor()
         
         cursor.execute('''
             UPDATE channels SET status = 'expired' 
-            WHERE channel_id = ?
+            WHERE channel_id = ? AND status != 'expired'
         ''', (channel_id,))
+        if cursor.rowcount:
+            self._bump_stats(cursor, datetime.now(), promotions_expired=1)
         
         conn.commit()
         conn.close()
+        self.invalidate_cache('active_channels')
     
     def is_admin(self, user_id):
-        conn = sqlite3.connect(self.db_path)
+        conn = self.engine.connect()
         cursor = conn.cursor()
         
         cursor.execute('SELECT * FROM admins WHERE user_id = ?', (user_id,))
@@ -260,7 +1227,7 @@ class Database:
         return admin is not None
     
     def add_admin(self, user_id, username):
-        conn = sqlite3.connect(self.db_path)
+        conn = self.engine.connect()
         cursor = conn.cursor()
         
         try:
@@ -276,7 +1243,7 @@ class Database:
             conn.close()
     
     def add_payment(self, user_id, channel_id, amount, duration):
-        conn = sqlite3.connect(self.db_path)
+        conn = self.engine.connect()
         cursor = conn.cursor()
         
         try:
@@ -293,19 +1260,22 @@ class Database:
             conn.close()
     
     def complete_payment(self, payment_id):
-        conn = sqlite3.connect(self.db_path)
+        conn = self.engine.connect()
         cursor = conn.cursor()
         
         cursor.execute('''
             UPDATE payments SET status = 'completed' 
-            WHERE id = ?
+            WHERE id = ? AND status != 'completed'
         ''', (payment_id,))
+        if cursor.rowcount:
+            cursor.execute('SELECT amount FROM payments WHERE id = ?', (payment_id,))
+            self._bump_stats(cursor, datetime.now(), payments_completed=1, stars_earned=cursor.fetchone()[0])
         
         conn.commit()
         conn.close()
     
     def update_user_join_status(self, user_id, channel_id, joined):
-        conn = sqlite3.connect(self.db_path)
+        conn = self.engine.connect()
         cursor = conn.cursor()
         
         try:
@@ -320,7 +1290,7 @@ class Database:
             conn.close()
     
     def get_user_join_status(self, user_id, channel_id):
-        conn = sqlite3.connect(self.db_path)
+        conn = self.engine.connect()
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -334,7 +1304,7 @@ class Database:
         return result[0] if result else False
     
     def add_target_channel(self, channel_id, channel_username=None, channel_title=None):
-        conn = sqlite3.connect(self.db_path)
+        conn = self.engine.connect()
         cursor = conn.cursor()
         
         try:
@@ -350,85 +1320,599 @@ class Database:
             return False
         finally:
             conn.close()
+            self.invalidate_cache('target_channels')
     
     def get_target_channels(self):
-        conn = sqlite3.connect(self.db_path)
+        """Target channels - cached, treat the list as read-only"""
+        channels = self._cached('target_channels')
+        if channels is not None:
+            return channels
+        
+        version = self._cache_versions['target_channels']
+        conn = self.engine.connect(detect_types=sqlite3.PARSE_DECLTYPES)
         cursor = conn.cursor()
         
-        cursor.execute('SELECT * FROM target_channels')
-        channels = cursor.fetchall()
+        cursor.execute(f'SELECT {TargetChannel.columns()} FROM target_channels')
+        channels = [TargetChannel.from_row(row) for row in cursor.fetchall()]
         conn.close()
+        
+        self._store_cache('target_channels', version, channels, self.cache_max_age)
         return channels
     
-    def remove_target_channel(self, channel_id):
-        conn = sqlite3.connect(self.db_path)
+    def update_target_metadata(self, rows):
+        """Store refreshed (channel_id, username, title) of target channels in one transaction"""
+        if not rows:
+            return
+        conn = self.engine.connect()
         cursor = conn.cursor()
         
-        cursor.execute('DELETE FROM target_channels WHERE channel_id = ?', (channel_id,))
+        cursor.executemany('''
+            UPDATE target_channels SET channel_username = ?, channel_title = ?
+            WHERE channel_id = ?
+        ''', [(username, title, channel_id) for channel_id, username, title in rows])
+        
         conn.commit()
         conn.close()
+        self.invalidate_cache('target_channels')
     
-    def add_promotion_message(self, channel_id, message_id):
-        conn = sqlite3.connect(self.db_path)
+    def upsert_target_channels(self, rows, batch_size=100):
+        """Add or update verified (channel_id, username, title) targets, one transaction per batch"""
+        conn = self.engine.connect()
         cursor = conn.cursor()
         
-        delete_at = datetime.now() + timedelta(hours=5)
-        
         try:
-            cursor.execute('''
-                INSERT INTO promotion_messages 
-                (channel_id, message_id, delete_at)
-                VALUES (?, ?, ?)
-            ''', (channel_id, message_id, delete_at))
-            conn.commit()
-            return True
-        except Exception as e:
-            logger.error(f"Error adding promotion message: {e}")
-            return False
+            for i in range(0, len(rows), batch_size):
+                cursor.executemany('''
+                    INSERT INTO target_channels (channel_id, channel_username, channel_title, auto_added)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT(channel_id) DO UPDATE SET
+                        channel_username = excluded.channel_username,
+                        channel_title = excluded.channel_title
+                ''', [(channel_id, username, title, False) for channel_id, username, title in rows[i:i + batch_size]])
+                conn.commit()
         finally:
             conn.close()
+            self.invalidate_cache('target_channels')
     
-    def get_promotion_messages_to_delete(self):
-        conn = sqlite3.connect(self.db_path)
+    def remove_target_channel(self, channel_id):
+        conn = self.engine.connect()
         cursor = conn.cursor()
         
-        cursor.execute('''
-            SELECT * FROM promotion_messages 
+        cursor.execute('DELETE FROM target_channels WHERE channel_id = ?', (channel_id,))
+        cursor.execute('DELETE FROM target_health WHERE channel_id = ?', (channel_id,))
+        conn.commit()
+        conn.close()
+        self.invalidate_cache('target_channels')
+    
+    def migrate_target_channel(self, old_channel_id, new_channel_id):
+        """Follow a group that was upgraded to a supergroup"""
+        conn = self.engine.connect()
+        cursor = conn.cursor()
+        
+        try:
+            # The new id may already be a target - the migrated row replaces it
+            cursor.execute('DELETE FROM target_channels WHERE channel_id = ?', (new_channel_id,))
+            cursor.execute('''
+                UPDATE target_channels SET channel_id = ?
+                WHERE channel_id = ?
+            ''', (new_channel_id, old_channel_id))
+            cursor.execute('DELETE FROM target_health WHERE channel_id = ?', (old_channel_id,))
+            conn.commit()
+        except Exception as e:
+            logger.error(f"Error migrating target channel: {e}")
+        finally:
+            conn.close()
+            self.invalidate_cache('target_channels')
+    
+    def get_target_health(self):
+        """Circuit breaker records of all targets that failed recently"""
+        conn = self.engine.connect()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT channel_id, state, failures, trips, last_error, last_failure_at, open_until, fatal_failures
+            FROM target_health
+        ''')
+        rows = cursor.fetchall()
+        conn.close()
+        
+        health = {}
+        for channel_id, state, failures, trips, last_error, last_failure_at, open_until, fatal_failures in rows:
+            health[channel_id] = {
+                'state': state,
+                'failures': failures,
+                'fatal_failures': fatal_failures or 0,
+                'trips': trips,
+                'last_error': last_error,
+                'last_failure_at': datetime.fromisoformat(last_failure_at) if last_failure_at else None,
+                'open_until': datetime.fromisoformat(open_until) if open_until else None
+            }
+        return health
+    
+    def save_target_health(self, records):
+        """Store circuit breaker records in one transaction - None marks a healthy target"""
+        if not records:
+            return
+        conn = self.engine.connect()
+        cursor = conn.cursor()
+        
+        try:
+            cursor.executemany('''
+                INSERT OR REPLACE INTO target_health
+                (channel_id, state, failures, trips, last_error, last_failure_at, open_until, fatal_failures)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', [
+                (channel_id, r['state'], r['failures'], r['trips'], r['last_error'], r['last_failure_at'], r['open_until'],
+                 r.get('fatal_failures', 0))
+                for channel_id, r in records.items() if r is not None
+            ])
+            cursor.executemany(
+                'DELETE FROM target_health WHERE channel_id = ?',
+                [(channel_id,) for channel_id, r in records.items() if r is None]
+            )
+            conn.commit()
+        except Exception as e:
+            logger.error(f"Error saving target health: {e}")
+        finally:
+            conn.close()
+    
+    def add_promotion_message(self, channel_id, message_id):
+        conn = self.engine.connect()
+        cursor = conn.cursor()
+        
+        posted_at = datetime.now()
+        delete_at = posted_at + timedelta(hours=5)
+        
+        try:
+            cursor.execute('''
+                INSERT INTO promotion_messages 
+                (channel_id, message_id, delete_at)
+                VALUES (?, ?, ?)
+            ''', (channel_id, message_id, delete_at))
+            self._bump_stats(cursor, posted_at, promotion_posts=1)
+            conn.commit()
+            return True
+        except Exception as e:
+            logger.error(f"Error adding promotion message: {e}")
+            return False
+        finally:
+            conn.close()
+    
+    def _bump_stats(self, cursor, when, **counters):
+        """Add to the hourly, daily and all-time rollups in the caller's transaction"""
+        hour = when.replace(minute=0, second=0, microsecond=0)
+        buckets = (('hour', hour), ('day', hour.replace(hour=0)), ('all', self.ALL_TIME))
+        cursor.executemany('''
+            INSERT INTO stats_rollup (period, bucket, metric, value) VALUES (?, ?, ?, ?)
+            ON CONFLICT(period, bucket, metric) DO UPDATE SET value = stats_rollup.value + excluded.value
+        ''', [(period, bucket, metric, amount) for period, bucket in buckets for metric, amount in counters.items()])
+    
+    def _rebuild_stats(self, cursor):
+        """Recount the rollups from the rows in the database.
+        
+        Pruned promotion messages and pending payments, and promotions replaced by a
+        renewal, are gone and can't be counted.
+        """
+        cursor.execute('DELETE FROM stats_rollup')
+        events = [(row[0], {'promotions_started': 1}) for row in cursor.execute(
+            'SELECT promotion_start FROM channels WHERE promotion_start IS NOT NULL').fetchall()]
+        events += [(row[0], {'promotions_expired': 1}) for row in cursor.execute(
+            "SELECT promotion_end FROM channels WHERE status = 'expired' AND promotion_end IS NOT NULL").fetchall()]
+        events += [(row[0], {'payments_completed': 1, 'stars_earned': row[1]}) for row in cursor.execute(
+            "SELECT created_at, amount FROM payments WHERE status = 'completed'").fetchall()]
+        events += [(row[0], {'promotion_posts': 1}) for row in cursor.execute(
+            'SELECT posted_at FROM promotion_messages').fetchall()]
+        
+        # Promotions expired early by an admin end in the future
+        now = datetime.now()
+        for when, counters in events:
+            self._bump_stats(cursor, min(datetime.fromisoformat(str(when)), now), **counters)
+        if events:
+            logger.info(f"📊 Stats rollup rebuilt from {len(events)} rows")
+    
+    def get_stats_totals(self):
+        """All-time counters - {metric: value}"""
+        conn = self.engine.connect()
+        rows = conn.execute(
+            "SELECT metric, value FROM stats_rollup WHERE period = 'all' AND bucket = ?", (self.ALL_TIME,)
+        ).fetchall()
+        conn.close()
+        return dict(rows)
+    
+    def get_stats_series(self, period, since):
+        """Rollup buckets of one period from since on - [(bucket, {metric: value})], oldest first"""
+        conn = self.engine.connect(detect_types=sqlite3.PARSE_DECLTYPES)
+        rows = conn.execute('''
+            SELECT bucket, metric, value FROM stats_rollup
+            WHERE period = ? AND bucket >= ? ORDER BY bucket
+        ''', (period, since)).fetchall()
+        conn.close()
+        
+        series = {}
+        for bucket, metric, value in rows:
+            series.setdefault(bucket, {})[metric] = value
+        return list(series.items())
+    
+    def count_channels(self):
+        """(active promotions, promotions past their end not yet expired) without fetching the rows"""
+        conn = self.engine.connect()
+        row = conn.execute('''
+            SELECT
+                COALESCE(SUM(CASE WHEN promotion_end > datetime('now') THEN 1 ELSE 0 END), 0),
+                COALESCE(SUM(CASE WHEN promotion_end <= datetime('now') THEN 1 ELSE 0 END), 0)
+            FROM channels WHERE status = 'active'
+        ''').fetchone()
+        conn.close()
+        return row[0], row[1]
+    
+    def get_promotion_messages_to_delete(self):
+        conn = self.engine.connect(detect_types=sqlite3.PARSE_DECLTYPES)
+        cursor = conn.cursor()
+        
+        cursor.execute(f'''
+            SELECT {PromotionMessage.columns()} FROM promotion_messages 
             WHERE delete_at <= datetime('now') AND status = 'active'
         ''')
         
-        messages = cursor.fetchall()
+        messages = [PromotionMessage.from_row(row) for row in cursor.fetchall()]
         conn.close()
         return messages
     
-    def mark_message_deleted(self, message_id):
-        conn = sqlite3.connect(self.db_path)
+    def mark_messages_deleted(self, messages):
+        """Mark (channel_id, message_id) pairs deleted in one transaction"""
+        conn = self.engine.connect()
         cursor = conn.cursor()
         
-        cursor.execute('''
+        cursor.executemany('''
             UPDATE promotion_messages SET status = 'deleted' 
-            WHERE message_id = ?
-        ''', (message_id,))
+            WHERE channel_id = ? AND message_id = ?
+        ''', messages)
+        
+        conn.commit()
+        conn.close()
+    
+    def delete_expired_batch(self, table, condition, params, batch_size):
+        """Delete up to batch_size rows matching condition, returns the number deleted"""
+        conn = self.engine.connect()
+        cursor = conn.cursor()
+        
+        cursor.execute(f'''
+            DELETE FROM {table} WHERE rowid IN (
+                SELECT rowid FROM {table} WHERE {condition} LIMIT ?
+            )
+        ''', (*params, batch_size))
+        deleted = cursor.rowcount
+        
+        conn.commit()
+        conn.close()
+        return deleted
+    
+    def get_storage_stats(self):
+        """Return (file size, free bytes) of the database"""
+        conn = self.engine.connect()
+        cursor = conn.cursor()
+        
+        if self.engine.dialect == 'postgresql':
+            size = cursor.execute('SELECT pg_database_size(current_database())').fetchone()[0]
+            conn.close()
+            return size, 0
+        
+        page_size = cursor.execute('PRAGMA page_size').fetchone()[0]
+        page_count = cursor.execute('PRAGMA page_count').fetchone()[0]
+        freelist_count = cursor.execute('PRAGMA freelist_count').fetchone()[0]
+        conn.close()
+        
+        return page_size * page_count, page_size * freelist_count
+    
+    def incremental_vacuum(self, pages=0):
+        """Return free pages to the filesystem (all of them when pages is 0)"""
+        if self.engine.dialect != 'sqlite':
+            # PostgreSQL's autovacuum takes care of this
+            return
+        conn = self.engine.connect()
+        # executescript steps the pragma to completion, execute() frees a single page
+        conn.executescript(f'PRAGMA incremental_vacuum({int(pages)});')
+        conn.close()
+    
+    def get_user_state(self, user_id):
+        conn = self.engine.connect()
+        cursor = conn.cursor()
+        
+        cursor.execute('SELECT data FROM user_state WHERE user_id = ?', (user_id,))
+        result = cursor.fetchone()
+        conn.close()
+        
+        return json.loads(result[0]) if result else None
+    
+    def save_user_states(self, states):
+        """Write a batch of user states in one transaction - empty states are removed"""
+        conn = self.engine.connect()
+        cursor = conn.cursor()
+        
+        now = datetime.now()
+        try:
+            cursor.executemany('''
+                INSERT OR REPLACE INTO user_state (user_id, data, updated_at)
+                VALUES (?, ?, ?)
+            ''', [(user_id, data, now) for user_id, data in states.items() if data])
+            cursor.executemany(
+                'DELETE FROM user_state WHERE user_id = ?',
+                [(user_id,) for user_id, data in states.items() if not data]
+            )
+            conn.commit()
+        except Exception as e:
+            logger.error(f"Error saving user states: {e}")
+        finally:
+            conn.close()
+    
+    def delete_user_state(self, user_id):
+        conn = self.engine.connect()
+        cursor = conn.cursor()
+        
+        cursor.execute('DELETE FROM user_state WHERE user_id = ?', (user_id,))
+        conn.commit()
+        conn.close()
+    
+    def purge_user_states(self, cutoff):
+        """Remove conversation states not touched since cutoff"""
+        conn = self.engine.connect()
+        cursor = conn.cursor()
+        
+        cursor.execute('DELETE FROM user_state WHERE updated_at < ?', (cutoff,))
+        purged = cursor.rowcount
+        conn.commit()
+        conn.close()
+        return purged
+    
+    def enqueue_job(self, kind, shard, payload=None):
+        """Queue a job for a shard - an unclaimed job of the same kind is refreshed instead"""
+        conn = self.engine.connect()
+        cursor = conn.cursor()
+        
+        payload_json = json.dumps(payload) if payload is not None else None
+        try:
+            cursor.execute('''
+                UPDATE broadcast_jobs SET payload = ?
+                WHERE kind = ? AND shard = ? AND status = 'pending'
+            ''', (payload_json, kind, shard))
+            if cursor.rowcount == 0:
+                cursor.execute('''
+                    INSERT INTO broadcast_jobs (kind, shard, payload)
+                    VALUES (?, ?, ?)
+                ''', (kind, shard, payload_json))
+            conn.commit()
+        finally:
+            conn.close()
+    
+    def lease_job(self, worker_id, shard, lease_seconds, max_attempts=3):
+        """Claim the oldest pending (or lease-expired) job of a shard.
+        
+        A lease that expired on its last attempt means the job took its worker
+        down every time - it is marked failed instead of being retaken.
+        """
+        conn = self.engine.connect(timeout=30, isolation_level=None)
+        cursor = conn.cursor()
+        
+        now = datetime.now()
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute('''
+                UPDATE broadcast_jobs
+                SET status = 'failed', lease_owner = NULL, lease_until = NULL, finished_at = ?
+                WHERE shard = ? AND status = 'leased' AND lease_until < ? AND attempts >= ?
+            ''', (now, shard, now, max_attempts))
+            poisoned = cursor.rowcount
+            cursor.execute('''
+                SELECT id, kind, payload FROM broadcast_jobs
+                WHERE shard = ? AND (status = 'pending' OR (status = 'leased' AND lease_until < ? AND attempts < ?))
+                ORDER BY id LIMIT 1
+            ''', (shard, now, max_attempts))
+            job = cursor.fetchone()
+            if job:
+                cursor.execute('''
+                    UPDATE broadcast_jobs
+                    SET status = 'leased', lease_owner = ?, lease_until = ?, attempts = attempts + 1
+                    WHERE id = ?
+                ''', (worker_id, now + timedelta(seconds=lease_seconds), job[0]))
+            cursor.execute('COMMIT')
+        except Exception:
+            cursor.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+        
+        if poisoned > 0:
+            logger.error(f"❌ Shard {shard}: {poisoned} job(s) lost their worker {max_attempts} times, marked failed")
+        if not job:
+            return None
+        return job[0], job[1], json.loads(job[2]) if job[2] else None
+    
+    def renew_job_lease(self, job_id, worker_id, lease_seconds):
+        conn = self.engine.connect()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            UPDATE broadcast_jobs SET lease_until = ?
+            WHERE id = ? AND lease_owner = ? AND status = 'leased'
+        ''', (datetime.now() + timedelta(seconds=lease_seconds), job_id, worker_id))
+        
+        conn.commit()
+        conn.close()
+    
+    def finish_job(self, job_id, status, max_attempts=3):
+        """Mark a job done, or put a failed one back until it runs out of attempts"""
+        conn = self.engine.connect()
+        cursor = conn.cursor()
+        
+        if status == 'failed':
+            cursor.execute('''
+                UPDATE broadcast_jobs
+                SET status = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END,
+                    lease_owner = NULL, lease_until = NULL
+                WHERE id = ?
+            ''', (max_attempts, job_id))
+        else:
+            cursor.execute('''
+                UPDATE broadcast_jobs SET status = ?, finished_at = ?
+                WHERE id = ?
+            ''', (status, datetime.now(), job_id))
+        
+        conn.commit()
+        conn.close()
+    
+    def get_scheduled_job(self, name):
+        """Return (interval, next_run) of a scheduled job, or None if it never ran"""
+        conn = self.engine.connect()
+        cursor = conn.cursor()
+        
+        cursor.execute('SELECT interval, next_run FROM scheduled_jobs WHERE name = ?', (name,))
+        result = cursor.fetchone()
+        conn.close()
+        
+        if not result or not result[1]:
+            return None
+        return result[0], datetime.fromisoformat(result[1])
+    
+    def save_scheduled_job(self, name, interval, next_run):
+        conn = self.engine.connect()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            INSERT INTO scheduled_jobs (name, interval, next_run) VALUES (?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET interval = excluded.interval, next_run = excluded.next_run
+        ''', (name, interval, next_run))
         
         conn.commit()
         conn.close()
     
-    def cleanup_old_messages(self):
-        """Clean up messages older than 7 days"""
-        conn = sqlite3.connect(self.db_path)
+    def get_seen_updates(self, name):
+        """Return (newest update id, bitmap) of a seen-update window, or None"""
+        conn = self.engine.connect()
+        cursor = conn.cursor()
+        
+        cursor.execute('SELECT high_update_id, bitmap FROM seen_updates WHERE name = ?', (name,))
+        result = cursor.fetchone()
+        conn.close()
+        
+        if not result or result[0] is None:
+            return None
+        return result[0], bytes(result[1])
+    
+    def merge_seen_updates(self, name, merge):
+        """Replace a seen-update window with merge(saved) in one transaction.
+        
+        saved is the stored (newest update id, bitmap) or None, merge returns the pair to store.
+        """
+        conn = self.engine.connect(timeout=30, isolation_level=None)
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute('SELECT high_update_id, bitmap FROM seen_updates WHERE name = ?', (name,))
+            row = cursor.fetchone()
+            high_update_id, bitmap = merge((row[0], bytes(row[1])) if row and row[0] is not None else None)
+            cursor.execute('''
+                INSERT OR REPLACE INTO seen_updates (name, high_update_id, bitmap, updated_at)
+                VALUES (?, ?, ?, ?)
+            ''', (name, high_update_id, bitmap, datetime.now()))
+            cursor.execute('COMMIT')
+        except Exception:
+            if conn.in_transaction:
+                cursor.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+    
+    def claim_scheduled_job(self, name, stale_before, owner=None, lease_seconds=60):
+        """Mark a job as running unless another run is still in progress.
+        
+        A run is over when its owner stopped renewing the lease, or when it
+        started before stale_before.
+        """
+        conn = self.engine.connect()
+        cursor = conn.cursor()
+        
+        now = datetime.now()
+        cursor.execute('''
+            UPDATE scheduled_jobs SET running_since = ?, running_owner = ?, running_until = ?
+            WHERE name = ? AND (running_since IS NULL OR running_since < ? OR running_until < ?)
+        ''', (now, owner, now + timedelta(seconds=lease_seconds), name, stale_before, now))
+        claimed = cursor.rowcount == 1
+        
+        conn.commit()
+        conn.close()
+        return claimed
+    
+    def finish_scheduled_job(self, name, next_run, started_at, status, error=None):
+        """Release a job, store its next run and record the run in job_runs"""
+        conn = self.engine.connect()
+        cursor = conn.cursor()
+        
+        finished_at = datetime.now()
+        try:
+            cursor.execute('''
+                UPDATE scheduled_jobs
+                SET running_since = NULL, running_owner = NULL, running_until = NULL,
+                    next_run = ?, last_run = ?, last_status = ?, run_count = run_count + 1
+                WHERE name = ?
+            ''', (next_run, started_at, status, name))
+            cursor.execute('''
+                INSERT INTO job_runs (name, started_at, finished_at, status, error)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (name, started_at, finished_at, status, error))
+            conn.commit()
+        except Exception as e:
+            logger.error(f"Error recording job run: {e}")
+        finally:
+            conn.close()
+    
+    def get_job_run_count(self, name):
+        conn = self.engine.connect()
+        cursor = conn.cursor()
+        
+        cursor.execute('SELECT run_count FROM scheduled_jobs WHERE name = ?', (name,))
+        result = cursor.fetchone()
+        conn.close()
+        
+        return result[0] if result and result[0] else 0
+    
+    def renew_scheduled_job(self, name, owner, lease_seconds):
+        """Extend the lease of a run this owner holds"""
+        conn = self.engine.connect()
         cursor = conn.cursor()
         
-        cutoff_date = datetime.now() - timedelta(days=7)
         cursor.execute('''
-            DELETE FROM promotion_messages 
-            WHERE posted_at < ?
-        ''', (cutoff_date,))
+            UPDATE scheduled_jobs SET running_until = ?
+            WHERE name = ? AND running_owner = ? AND running_since IS NOT NULL
+        ''', (datetime.now() + timedelta(seconds=lease_seconds), name, owner))
+        
+        conn.commit()
+        conn.close()
+    
+    def reset_running_jobs(self, expired_only=False):
+        """Release jobs left running by a previous process.
+        
+        With expired_only, runs whose owner still renews its lease are kept.
+        """
+        conn = self.engine.connect()
+        cursor = conn.cursor()
+        
+        if expired_only:
+            cursor.execute('''
+                UPDATE scheduled_jobs SET running_since = NULL, running_owner = NULL, running_until = NULL
+                WHERE running_since IS NOT NULL AND (running_until IS NULL OR running_until < ?)
+            ''', (datetime.now(),))
+        else:
+            cursor.execute('''
+                UPDATE scheduled_jobs SET running_since = NULL, running_owner = NULL, running_until = NULL
+                WHERE running_since IS NOT NULL
+            ''')
         
         conn.commit()
         conn.close()
     
     def export_data(self):
-        conn = sqlite3.connect(self.db_path)
+        conn = self.engine.connect()
         cursor = conn.cursor()
         
         # Export channels
@@ -443,6 +1927,10 @@ class Database:
         cursor.execute('SELECT * FROM payments')
         payments = cursor.fetchall()
         
+        # Export payment ledger
+        cursor.execute('SELECT * FROM payment_ledger')
+        payment_ledger = cursor.fetchall()
+        
         # Export user joins
         cursor.execute('SELECT * FROM user_joins')
         user_joins = cursor.fetchall()
@@ -455,37 +1943,186 @@ class Database:
         cursor.execute('SELECT * FROM promotion_messages')
         promotion_messages = cursor.fetchall()
         
+        # Export in-flight conversation states
+        cursor.execute('SELECT * FROM user_state')
+        user_state = cursor.fetchall()
+        
+        # Export stats rollups
+        cursor.execute('SELECT * FROM stats_rollup')
+        stats_rollup = cursor.fetchall()
+        
         conn.close()
         
-        return {
+        data = {
             'channels': channels,
             'admins': admins,
             'payments': payments,
+            'payment_ledger': payment_ledger,
             'user_joins': user_joins,
             'target_channels': target_channels,
             'promotion_messages': promotion_messages,
+            'user_state': user_state,
+            'stats_rollup': stats_rollup,
             'exported_at': datetime.now().isoformat()
         }
+        
+        # Row counts and checksums let a restore prove it got every row back
+        data['header'] = {
+            'version': 2,
+            'tables': {
+                table: {'rows': len(data[table]), 'checksum': self.table_checksum(data[table])}
+                for table in self.EXPORT_TABLES
+            }
+        }
+        return data
     
-    def import_data(self, data):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    @staticmethod
+    def table_checksum(rows):
+        """Order-independent sha256 of exported rows"""
+        lines = sorted(
+            json.dumps([int(value) if isinstance(value, bool) else value for value in row], default=str)
+            for row in rows
+        )
+        return hashlib.sha256('\n'.join(lines).encode('utf-8')).hexdigest()
+    
+    def verify_import(self, cursor, data):
+        """Compare imported tables with the backup header - returns the mismatches"""
+        # Backups from before the header can only be checked by row count
+        expected = data.get('header', {}).get('tables') or {
+            table: {'rows': len(data.get(table, [])), 'checksum': None} for table in self.EXPORT_TABLES
+        }
+        
+        problems = []
+        for table, stats in expected.items():
+            rows = cursor.execute(f'SELECT * FROM {table}').fetchall()
+            if len(rows) != stats['rows']:
+                problems.append(f"{table}: {len(rows)} rows, backup has {stats['rows']}")
+            elif stats['checksum'] and self.table_checksum(rows) != stats['checksum']:
+                problems.append(f"{table}: checksum mismatch")
+        return problems
+    
+    def restore_data(self, data):
+        """Replace the database with a backup once it is verified.
         
+        SQLite builds and checks the backup in a separate file, then copies it in,
+        so readers see the old data until the copy and a bad backup changes
+        nothing. PostgreSQL imports and checks it in one transaction.
+        """
+        if self.engine.dialect != 'sqlite':
+            return self.import_data(data, verify=True)
+        
+        staging_path = self._clear_staging()
         try:
-            # Clear existing data
-            cursor.execute('DELETE FROM channels')
-            cursor.execute('DELETE FROM admins')
-            cursor.execute('DELETE FROM payments')
-            cursor.execute('DELETE FROM user_joins')
-            cursor.execute('DELETE FROM target_channels')
-            cursor.execute('DELETE FROM promotion_messages')
+            staging = Database(engine=SQLiteEngine(staging_path))
+            if not staging.import_data(data, verify=True):
+                return False
+            self._swap_in(staging_path)
+            return True
+        except Exception as e:
+            logger.error(f"Error restoring data: {e}")
+            return False
+        finally:
+            self._clear_staging()
+            self.invalidate_cache('active_channels', 'target_channels')
+    
+    def restore_snapshot(self, snapshot_path):
+        """Replace the database with a SQLite snapshot file once it passes an integrity check.
+        
+        The snapshot is copied, so the file at snapshot_path is left as it is.
+        """
+        if self.engine.dialect != 'sqlite':
+            logger.error("❌ SQLite snapshots can only be restored into SQLite storage")
+            return False
+        
+        staging_path = self._clear_staging()
+        try:
+            shutil.copyfile(snapshot_path, staging_path)
+            conn = sqlite3.connect(staging_path)
+            try:
+                result = conn.execute('PRAGMA integrity_check').fetchone()[0]
+            finally:
+                conn.close()
+            if result != 'ok':
+                logger.error(f"❌ Snapshot {snapshot_path} failed integrity check: {result}")
+                return False
             
-            # Import channels
-            for channel in data.get('channels', []):
-                cursor.execute('''
-                    INSERT INTO channels 
-                    (id, channel_id, channel_username, channel_title, owner_id, promotion_start, promotion_end, status, created_at)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            # Brings snapshots from older releases up to the current schema
+            Database(engine=SQLiteEngine(staging_path))
+            self._swap_in(staging_path)
+            return True
+        except Exception as e:
+            logger.error(f"Error restoring snapshot: {e}")
+            return False
+        finally:
+            self._clear_staging()
+            self.invalidate_cache('active_channels', 'target_channels')
+    
+    def _clear_staging(self):
+        """Remove leftovers of an earlier restore - returns the staging file path"""
+        staging_path = f"{self.db_path}.restore"
+        for path in (staging_path, f"{staging_path}-journal"):
+            if os.path.exists(path):
+                os.remove(path)
+        return staging_path
+    
+    def _swap_in(self, staging_path):
+        """Copy a checked staging file into the live database.
+        
+        The file itself is never replaced - broadcast workers and executor threads
+        keep valid connections and read the restored pages on their next query.
+        """
+        conn = self.engine.connect(timeout=30, isolation_level=None)
+        try:
+            self._carry_over_state(conn, staging_path)
+            staging = sqlite3.connect(staging_path)
+            try:
+                # A single step copies every page in one write transaction
+                staging.backup(conn)
+            finally:
+                staging.close()
+        finally:
+            conn.close()
+        
+        logger.info("✅ Restored database swapped in")
+    
+    def _carry_over_state(self, conn, staging_path):
+        """Copy tables backups don't carry - job schedule and queue, target health, leases - into the staging file"""
+        conn.execute('ATTACH DATABASE ? AS staging', (staging_path,))
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            tables = conn.execute("SELECT name, sql FROM main.sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'").fetchall()
+            for name, sql in tables:
+                if name in self.EXPORT_TABLES:
+                    continue
+                conn.execute(re.sub(r'^CREATE TABLE\s+(IF NOT EXISTS\s+)?', 'CREATE TABLE IF NOT EXISTS staging.', sql))
+                conn.execute(f'DELETE FROM staging.{name}')
+                conn.execute(f'INSERT INTO staging.{name} SELECT * FROM main.{name}')
+            conn.execute('COMMIT')
+        finally:
+            conn.execute('DETACH DATABASE staging')
+    
+    def import_data(self, data, verify=False):
+        conn = self.engine.connect()
+        cursor = conn.cursor()
+        
+        try:
+            # Clear existing data
+            cursor.execute('DELETE FROM channels')
+            cursor.execute('DELETE FROM admins')
+            cursor.execute('DELETE FROM payments')
+            cursor.execute('DELETE FROM payment_ledger')
+            cursor.execute('DELETE FROM user_joins')
+            cursor.execute('DELETE FROM target_channels')
+            cursor.execute('DELETE FROM promotion_messages')
+            cursor.execute('DELETE FROM user_state')
+            cursor.execute('DELETE FROM stats_rollup')
+            
+            # Import channels
+            for channel in data.get('channels', []):
+                cursor.execute('''
+                    INSERT INTO channels 
+                    (id, channel_id, channel_username, channel_title, owner_id, promotion_start, promotion_end, status, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
                 ''', channel)
             
             # Import admins
@@ -502,6 +2139,13 @@ class Database:
                     VALUES (?, ?, ?, ?, ?, ?, ?)
                 ''', payment)
             
+            # Import payment ledger
+            for entry in data.get('payment_ledger', []):
+                cursor.execute('''
+                    INSERT INTO payment_ledger (id, charge_id, payment_id, user_id, channel_id, amount, days, promotion_end, received_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', entry)
+            
             # Import user joins
             for user_join in data.get('user_joins', []):
                 cursor.execute('''
@@ -523,6 +2167,39 @@ class Database:
                     VALUES (?, ?, ?, ?, ?, ?)
                 ''', message)
             
+            # Import conversation states
+            for state in data.get('user_state', []):
+                cursor.execute('''
+                    INSERT INTO user_state (user_id, data, updated_at)
+                    VALUES (?, ?, ?)
+                ''', state)
+            
+            # Import stats rollups
+            for rollup in data.get('stats_rollup', []):
+                cursor.execute('''
+                    INSERT INTO stats_rollup (period, bucket, metric, value)
+                    VALUES (?, ?, ?, ?)
+                ''', rollup)
+            
+            if self.engine.dialect == 'postgresql':
+                # Rows came in with their ids - move the id sequences past them
+                for table in ('channels', 'admins', 'payments', 'payment_ledger', 'user_joins', 'target_channels', 'promotion_messages'):
+                    cursor.execute(f'''
+                        SELECT setval(pg_get_serial_sequence('{table}', 'id'), COALESCE(MAX(id), 0) + 1, false)
+                        FROM {table}
+                    ''')
+            
+            if verify:
+                problems = self.verify_import(cursor, data)
+                if problems:
+                    logger.error(f"❌ Backup failed verification: {'; '.join(problems)}")
+                    conn.rollback()
+                    return False
+            
+            # Backups from before the rollup - recount it from the restored rows
+            if 'stats_rollup' not in data:
+                self._rebuild_stats(cursor)
+            
             conn.commit()
             return True
         except Exception as e:
@@ -530,19 +2207,1290 @@ class Database:
             return False
         finally:
             conn.close()
+            self.invalidate_cache('active_channels', 'target_channels')
 
-class GitHubBackup:
+class AsyncDatabase:
+    """Awaitable view of Database for handlers and jobs.
+
+    The engines are still synchronous; every call runs on a small thread pool
+    so a slow query or lock wait no longer stalls the event loop.
+    """
+
+    def __init__(self, db, workers=None):
+        self.db = db
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers or int(os.getenv('DB_THREADS', '4')),
+            thread_name_prefix='database'
+        )
+
+    def __getattr__(self, name):
+        method = getattr(self.db, name)
+        if not callable(method):
+            return method
+
+        async def call(*args, **kwargs):
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor, functools.partial(method, *args, **kwargs)
+            )
+        return call
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+class SQLitePersistence(BasePersistence):
+    """Keeps context.user_data in the bot database so promotion flows survive restarts.
+    
+    User data is loaded lazily on a user's first update, written behind in batches
+    and evicted from memory once the user goes idle. Records of abandoned flows are
+    purged after state_ttl. db is an AsyncDatabase.
+    """
+    
+    def __init__(self, db, update_interval=30, idle_ttl=1800, state_ttl=timedelta(days=7)):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self.db = db
+        self.idle_ttl = idle_ttl
+        self.state_ttl = state_ttl
+        self._hydrated = set()   # users whose record is loaded in application.user_data
+        self._last_seen = {}     # user_id -> monotonic time of last update
+        self._evicting = set()   # users dropped from memory only, record must be kept
+        self._revived = {}       # evicting users that came back before the drop was persisted
+        self._dirty = {}         # user_id -> compact JSON waiting to be written
+        self._flush_task = None
+        self._flush_lock = asyncio.Lock()  # keeps batches for the same user in order
+    
+    async def get_user_data(self):
+        # Records are loaded per user in refresh_user_data
+        return {}
+    
+    async def get_chat_data(self):
+        return {}
+    
+    async def get_bot_data(self):
+        return {}
+    
+    async def get_callback_data(self):
+        return None
+    
+    async def get_conversations(self, name):
+        return {}
+    
+    async def update_conversation(self, name, key, new_state):
+        pass
+    
+    async def update_chat_data(self, chat_id, data):
+        pass
+    
+    async def update_bot_data(self, data):
+        pass
+    
+    async def update_callback_data(self, data):
+        pass
+    
+    async def drop_chat_data(self, chat_id):
+        pass
+    
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+    
+    async def refresh_bot_data(self, bot_data):
+        pass
+    
+    async def refresh_user_data(self, user_id, user_data):
+        """Hydrate a user's flow state from the database on their first update"""
+        self._last_seen[user_id] = time.monotonic()
+        if user_id in self._evicting:
+            self._revived[user_id] = user_data
+        if user_id in self._hydrated:
+            return
+        
+        self._hydrated.add(user_id)
+        state = self._dirty.get(user_id)
+        record = json.loads(state) if state else await self.db.get_user_state(user_id)
+        if record:
+            user_data.update(record)
+    
+    async def update_user_data(self, user_id, data):
+        self._dirty[user_id] = json.dumps(data, separators=(',', ':'), default=str) if data else ''
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._write_behind())
+    
+    async def drop_user_data(self, user_id):
+        if user_id not in self._evicting:
+            self._dirty.pop(user_id, None)
+            self._hydrated.discard(user_id)
+            self._last_seen.pop(user_id, None)
+            await self.db.delete_user_state(user_id)
+            return
+        
+        # Memory eviction - keep the record, unless the user came back meanwhile
+        self._evicting.discard(user_id)
+        revived = self._revived.pop(user_id, None)
+        if revived is not None:
+            await self.update_user_data(user_id, dict(revived))
+    
+    async def _write_behind(self):
+        # Let the rest of this persistence run queue its writes first
+        await asyncio.sleep(0)
+        await self.flush()
+    
+    async def flush(self):
+        """Write all buffered user states in one transaction"""
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            states, self._dirty = self._dirty, {}
+            await self.db.save_user_states(states)
+    
+    async def evict_idle(self, application):
+        """Drop idle users from memory and purge abandoned flow records"""
+        # Make sure nothing is lost before memory is released
+        await application.update_persistence()
+        await self.flush()
+        
+        now = time.monotonic()
+        idle_users = [user_id for user_id, seen in self._last_seen.items() if now - seen > self.idle_ttl]
+        for user_id in idle_users:
+            del self._last_seen[user_id]
+            self._hydrated.discard(user_id)
+            self._evicting.add(user_id)
+            application.drop_user_data(user_id)
+        
+        purged = await self.db.purge_user_states(datetime.now() - self.state_ttl)
+        if idle_users or purged:
+            logger.info(f"🧹 User state: {len(idle_users)} evicted from memory, {purged} abandoned flows purged")
+
+    def reload(self, application):
+        """Forget user data in memory after a restore - each user's record loads again on their next update"""
+        self._dirty.clear()
+        self._hydrated.clear()
+        self._revived.clear()
+        self._last_seen.clear()
+        for user_id in list(application.user_data):
+            # Dropped like an eviction, so the restored record is kept
+            self._evicting.add(user_id)
+            application.drop_user_data(user_id)
+
+class RateLimiter:
+    """Token bucket shared by concurrent Bot API calls"""
+    
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self._lock = None
+    
+    def pause(self, seconds):
+        """Hold every caller for a flood-control wait, not just the one that got it"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+    
+    async def acquire(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while True:
+                paused = self.paused_until - time.monotonic()
+                if paused > 0:
+                    await asyncio.sleep(paused)
+                    continue
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+    
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def try_acquire(self, tokens=1):
+        """Take tokens without waiting, False if the bucket can't cover them"""
+        self._refill()
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+    
+    def consume(self, tokens=1):
+        """Take tokens without waiting, going into debt if needed"""
+        self._refill()
+        self.tokens -= tokens
+
+class TargetCircuitBreaker:
+    """Per-target failure tracking with exponential back-off.
+    
+    closed -> open after failure_threshold consecutive failures (at once for fatal
+    errors), open -> half_open when the back-off expires, half_open -> closed on the
+    next successful post or back to open with a doubled back-off. Targets failing
+    with fatal errors max_fatal_failures times in a row are removed - any other
+    outcome resets that count. Flood control (RetryAfter) is not held against a target.
+    """
+    
+    def __init__(self, failure_threshold=3, base_backoff=timedelta(hours=6),
+                 max_backoff=timedelta(days=7), max_fatal_failures=3):
+        self.failure_threshold = failure_threshold
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.max_fatal_failures = max_fatal_failures
+    
+    @staticmethod
+    def classify(error):
+        """'fatal' when the bot can't post there, 'content' when the post itself was
+        rejected, 'rate_limited' for flood control, 'transient' for everything else"""
+        if isinstance(error, RetryAfter):
+            return 'rate_limited'
+        if isinstance(error, Forbidden):
+            return 'fatal'
+        if isinstance(error, BadRequest):
+            message = str(error).lower()
+            if any(x in message for x in ['chat not found', 'not enough rights', 'have no rights', 'chat_write_forbidden']):
+                return 'fatal'
+            return 'content'
+        return 'transient'
+    
+    def is_open(self, record, now):
+        """True if the target should be skipped this round"""
+        if not record or record['state'] == 'closed':
+            return False
+        if record['open_until'] and record['open_until'] > now:
+            return True
+        record['state'] = 'half_open'
+        return False
+    
+    def on_failure(self, record, kind, error, now):
+        """Return the updated record, with state 'removed' if the target should be dropped"""
+        record = dict(record or {'state': 'closed', 'failures': 0, 'trips': 0})
+        record['failures'] += 1
+        record['fatal_failures'] = record.get('fatal_failures', 0) + 1 if kind == 'fatal' else 0
+        record['last_error'] = f"{type(error).__name__}: {error}"[:200]
+        record['last_failure_at'] = now
+        
+        if kind == 'fatal' and record['fatal_failures'] >= self.max_fatal_failures:
+            record['state'] = 'removed'
+        elif kind == 'fatal' or record['state'] == 'half_open' or record['failures'] >= self.failure_threshold:
+            backoff = min(self.base_backoff * (2 ** record['trips']), self.max_backoff)
+            record['trips'] += 1
+            record['state'] = 'open'
+            record['open_until'] = now + backoff
+        else:
+            record['open_until'] = None
+        return record
+
+class ExposurePlanner:
+    """Places active promotions into the limited lines of each target's post.
+    
+    While there are enough slots every promotion is shown each round, otherwise
+    promotions take turns across rounds. Remaining slots go to promotions by plan
+    tier with smooth weighted round-robin.
+    """
+    
+    def __init__(self, pricing, slots_per_post=20):
+        # Plans are listed cheapest first - a longer plan weighs more
+        self.tiers = sorted((info['days'], weight) for weight, info in enumerate(pricing.values(), start=1))
+        self.slots_per_post = slots_per_post
+    
+    def weight_for(self, channel):
+        """Plan tier weight from the promotion's length"""
+        if not channel.promotion_start or not channel.promotion_end:
+            return 1
+        
+        days = round((channel.promotion_end - channel.promotion_start).total_seconds() / 86400)
+        weight = 1
+        for tier_days, tier_weight in self.tiers:
+            if days >= tier_days:
+                weight = tier_weight
+        return weight
+    
+    def plan(self, active_channels, target_ids, round_index=0):
+        """Return {target_id: [channel_id, ...]} or None if every promotion fits in one post"""
+        channel_ids = [channel.channel_id for channel in active_channels]
+        if len(channel_ids) <= self.slots_per_post or not target_ids:
+            return None
+        
+        weights = {channel.channel_id: self.weight_for(channel) for channel in active_channels}
+        targets = set(target_ids)
+        total_slots = len(target_ids) * self.slots_per_post
+        # At most one line per post, and never in its own channel
+        caps = {cid: len(target_ids) - (cid in targets) for cid in channel_ids}
+        
+        # Guaranteed exposure - everyone once, rotating the start between rounds
+        start = (round_index * total_slots) % len(channel_ids)
+        sequence = (channel_ids[start:] + channel_ids[:start])[:total_slots]
+        counts = dict.fromkeys(channel_ids, 0)
+        for cid in sequence:
+            counts[cid] += 1
+        
+        # Extra exposure by weight
+        current = dict.fromkeys(channel_ids, 0)
+        while len(sequence) < total_slots:
+            open_ids = [cid for cid in channel_ids if counts[cid] < caps[cid]]
+            if not open_ids:
+                break
+            total_weight = sum(weights[cid] for cid in open_ids)
+            for cid in open_ids:
+                current[cid] += weights[cid]
+            best = max(open_ids, key=current.get)
+            current[best] -= total_weight
+            counts[best] += 1
+            sequence.append(best)
+        
+        # Deal the sequence out over the posts
+        posts = {tid: [] for tid in target_ids}
+        placed = {tid: set() for tid in target_ids}
+        cursor = 0
+        for cid in sequence:
+            for k in range(len(target_ids)):
+                tid = target_ids[(cursor + k) % len(target_ids)]
+                if tid != cid and cid not in placed[tid] and len(posts[tid]) < self.slots_per_post:
+                    posts[tid].append(cid)
+                    placed[tid].add(cid)
+                    cursor = (cursor + k + 1) % len(target_ids)
+                    break
+        return posts
+
+class PromotionTemplate:
+    """Promotion post compiled once per round and rendered cheaply per target.
+    
+    A target listed in the exposure plan gets exactly its planned lines. Any other
+    target gets the list rotated by a per-target offset, cut to max_lines. A
+    promoted channel never sees its own line.
+    """
+    
+    HEADER = "📢 **Promoted Channels**\n\n"
+    FOOTER = "\n💫 Promote your channel with @worldwidepromotion1_bot"
+    
+    def __init__(self, entries, seed=0, plan=None, max_lines=None):
+        self.entries = entries
+        self.seed = seed
+        self.plan = plan or {}
+        self.max_lines = max_lines
+        self._lines = [line for _, line in entries]
+        self._positions = {channel_id: i for i, (channel_id, _) in enumerate(entries)}
+        self._cache = {}
+    
+    @classmethod
+    def compile(cls, active_channels, seed=0, plan=None, max_lines=None):
+        entries = []
+        for channel in active_channels:
+            username = channel.channel_username
+            title = channel.channel_title
+            
+            if username:
+                entries.append((channel.channel_id, f"• [{title}](https://t.me/{username})\n"))
+            else:
+                entries.append((channel.channel_id, f"• {title}\n"))
+        return cls(entries, seed, plan, max_lines)
+    
+    def to_payload(self):
+        return {'entries': self.entries, 'seed': self.seed, 'plan': self.plan, 'max_lines': self.max_lines}
+    
+    @classmethod
+    def from_payload(cls, payload):
+        # JSON turns the plan's target ids into strings
+        plan = {int(target_id): ids for target_id, ids in (payload.get('plan') or {}).items()}
+        return cls([tuple(entry) for entry in payload['entries']], payload['seed'], plan, payload.get('max_lines'))
+    
+    def render(self, target_channel_id=None):
+        """Post text for a target, None if there is nothing to promote there"""
+        planned = self.plan.get(target_channel_id)
+        if planned is not None:
+            lines = [self._lines[self._positions[cid]] for cid in planned if cid in self._positions]
+            return self.HEADER + "".join(lines) + self.FOOTER if lines else None
+        
+        count = len(self._lines)
+        if target_channel_id is None:
+            offset = self.seed % count if count else 0
+        else:
+            offset = (zlib.crc32(str(target_channel_id).encode()) + self.seed) % count if count else 0
+        own_line = self._positions.get(target_channel_id)
+        
+        if own_line is None and offset in self._cache:
+            return self._cache[offset]
+        
+        lines = self._lines[offset:] + self._lines[:offset]
+        if own_line is not None:
+            del lines[(own_line - offset) % count]
+        if self.max_lines:
+            lines = lines[:self.max_lines]
+        if not lines:
+            return None
+        
+        text = self.HEADER + "".join(lines) + self.FOOTER
+        if own_line is None:
+            self._cache[offset] = text
+        return text
+
+class BroadcastEngine:
+    """Posts promotions to target channels and deletes expired posts.
+    
+    Used inline by the bot, or per shard of target_channels by BroadcastWorker.
+    db is an AsyncDatabase.
+    """
+    
+    # Requests/second for the whole bot, below Telegram's ~30 bot-wide limit
+    BOT_RATE = 25
+    
+    def __init__(self, db, breaker=None, rate_limiter=None, max_parallel_chats=10, process_count=1):
+        self.db = db
+        self.breaker = breaker or TargetCircuitBreaker()
+        # The bot and each broadcast worker get an equal share of BOT_RATE
+        self.rate_limiter = rate_limiter or RateLimiter(self.BOT_RATE / process_count)
+        self.max_parallel_chats = max_parallel_chats
+    
+    @staticmethod
+    def shard_for(channel_id, shard_count):
+        """Stable shard of a channel, identical in every process"""
+        return zlib.crc32(str(channel_id).encode()) % shard_count
+    
+    async def send_promotions(self, bot, template, target_channels, staging=None, mode='send'):
+        """Send the promotion post to each target channel, returns the number of successful posts.
+        
+        With a staging post (chat_id, message_id) and mode 'copy' or 'forward' every target
+        gets that same message instead of its own rendering.
+        """
+        health = await self.db.get_target_health()
+        updated_health = {}
+        successful_posts = 0
+        skipped = 0
+        now = datetime.now()
+        
+        for channel in target_channels:
+            channel_id = channel.channel_id
+            channel_title = channel.channel_title or "Unknown"
+            record = health.get(channel_id)
+            
+            # Open circuit - don't spend API calls on a target that keeps failing
+            if self.breaker.is_open(record, now):
+                skipped += 1
+                continue
+            
+            try:
+                # Try to send message even if bot is not admin
+                if staging:
+                    sent_message = await self.call_api(
+                        bot.copy_message if mode == 'copy' else bot.forward_message,
+                        chat_id=channel_id,
+                        from_chat_id=staging[0],
+                        message_id=staging[1]
+                    )
+                else:
+                    promotion_message = template.render(channel_id)
+                    if promotion_message is None:
+                        continue
+                    sent_message = await self.call_api(
+                        bot.send_message,
+                        chat_id=channel_id,
+                        text=promotion_message,
+                        parse_mode='Markdown',
+                        disable_web_page_preview=True
+                    )
+                
+                # Store message info for deletion after 5 hours
+                await self.db.add_promotion_message(channel_id, sent_message.message_id)
+                
+                if record:
+                    updated_health[channel_id] = None
+                successful_posts += 1
+                logger.info(f"✅ Promoted channels in: {channel_title} (ID: {channel_id})")
+                
+            except ChatMigrated as e:
+                await self.db.migrate_target_channel(channel_id, e.new_chat_id)
+                logger.info(f"🔀 Target channel {channel_title} migrated: {channel_id} -> {e.new_chat_id}")
+            except Exception as e:
+                kind = self.breaker.classify(e)
+                if kind == 'rate_limited':
+                    logger.warning(f"⚠️ Flood control while posting in {channel_title} (ID: {channel_id}): {e}")
+                    continue
+                if kind == 'content':
+                    logger.warning(f"⚠️ Post rejected in {channel_title} (ID: {channel_id}): {e}")
+                    # The bot could reach the target, so fatal errors are no longer in a row
+                    if record and record.get('fatal_failures'):
+                        updated_health[channel_id] = dict(record, fatal_failures=0)
+                    continue
+                
+                record = self.breaker.on_failure(record, kind, e, now)
+                if record['state'] == 'removed':
+                    # Remove inaccessible channels
+                    await self.db.remove_target_channel(channel_id)
+                    logger.info(f"❌ Removed inaccessible target channel: {channel_title} (ID: {channel_id}) - {e}")
+                else:
+                    updated_health[channel_id] = record
+                    logger.warning(f"⚠️ Could not post in {channel_title} (ID: {channel_id}), circuit {record['state']}: {e}")
+        
+        await self.db.save_target_health(updated_health)
+        if skipped:
+            logger.info(f"⏭️ Skipped {skipped} targets with open circuits")
+        
+        return successful_posts
+    
+    async def call_api(self, method, **kwargs):
+        """Rate-limited Bot API call, waiting out a flood-control RetryAfter once"""
+        for attempt in range(2):
+            await self.rate_limiter.acquire()
+            try:
+                return await method(**kwargs)
+            except RetryAfter as e:
+                if attempt:
+                    raise
+                # Telegram throttles the whole bot - every caller of this process waits
+                self.rate_limiter.pause(e.retry_after)
+    
+    async def delete_messages(self, bot, messages_to_delete):
+        """Delete old promotion posts chat by chat in parallel, returns (deleted, errors)"""
+        by_chat = {}
+        for message in messages_to_delete:
+            by_chat.setdefault(message.channel_id, []).append(message.message_id)
+        
+        semaphore = asyncio.Semaphore(self.max_parallel_chats)
+        
+        async def delete_chat(channel_id, message_ids):
+            async with semaphore:
+                return await self.delete_chat_messages(bot, channel_id, message_ids)
+        
+        results = await asyncio.gather(*(delete_chat(c, ids) for c, ids in by_chat.items()))
+        
+        # Failed deletions are marked too, to avoid retrying
+        await self.db.mark_messages_deleted([(message.channel_id, message.message_id) for message in messages_to_delete])
+        
+        return sum(r[0] for r in results), sum(r[1] for r in results)
+    
+    async def delete_chat_messages(self, bot, channel_id, message_ids):
+        """Delete one chat's messages, returns (deleted, errors)"""
+        deleted_count = 0
+        error_count = 0
+        
+        # deleteMessages (Bot API 7.0) removes up to 100 messages per call
+        bulk_delete = getattr(bot, 'delete_messages', None)
+        if bulk_delete is not None:
+            batches = [message_ids[i:i + 100] for i in range(0, len(message_ids), 100)]
+        else:
+            batches = [[message_id] for message_id in message_ids]
+        
+        for batch in batches:
+            try:
+                if bulk_delete is not None:
+                    await self.call_api(bulk_delete, chat_id=channel_id, message_ids=batch)
+                else:
+                    await self.call_api(bot.delete_message, chat_id=channel_id, message_id=batch[0])
+                deleted_count += len(batch)
+            except Exception as e:
+                error_count += len(batch)
+                logger.warning(f"⚠️ Could not delete {len(batch)} messages from {channel_id}: {e}")
+        
+        if deleted_count:
+            logger.info(f"✅ Deleted {deleted_count} old promotion messages from channel: {channel_id}")
+        return deleted_count, error_count
+
+class BroadcastWorker:
+    """Worker process running the broadcast and deletion jobs of one shard"""
+    
+    def __init__(self, token, shard, shard_count, poll_interval=5, lease_seconds=300):
+        self.token = token
+        self.shard = shard
+        self.shard_count = shard_count
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.worker_id = f"worker-{shard}-{os.getpid()}"
+        self.db = AsyncDatabase(Database(), workers=2)
+        # The bot process shares the rate budget with the shard workers
+        self.engine = BroadcastEngine(self.db, process_count=shard_count + 1)
+    
+    def in_shard(self, channel_id):
+        return BroadcastEngine.shard_for(channel_id, self.shard_count) == self.shard
+    
+    async def run(self):
+        logger.info(f"🛠️ Broadcast worker {self.worker_id} started (shard {self.shard + 1}/{self.shard_count})")
+        async with Bot(self.token) as bot:
+            while True:
+                try:
+                    job = await self.db.lease_job(self.worker_id, self.shard, self.lease_seconds)
+                except Exception as e:
+                    logger.error(f"Job lease error in {self.worker_id}: {e}")
+                    job = None
+                
+                if not job:
+                    await asyncio.sleep(self.poll_interval)
+                    continue
+                
+                await self.run_job(bot, *job)
+    
+    async def run_job(self, bot, job_id, kind, payload):
+        heartbeat = asyncio.create_task(self._keep_lease(job_id))
+        try:
+            if kind == 'broadcast':
+                targets = [c for c in await self.db.get_target_channels() if self.in_shard(c.channel_id)]
+                successful_posts = await self.engine.send_promotions(
+                    bot,
+                    PromotionTemplate.from_payload(payload['template']),
+                    targets,
+                    staging=payload.get('staging'),
+                    mode=payload.get('mode', 'send')
+                )
+                logger.info(f"📊 Shard {self.shard} promotion round: {successful_posts}/{len(targets)} channels")
+            elif kind == 'delete':
+                messages = [m for m in await self.db.get_promotion_messages_to_delete() if self.in_shard(m.channel_id)]
+                deleted_count, error_count = await self.engine.delete_messages(bot, messages)
+                if deleted_count > 0 or error_count > 0:
+                    logger.info(f"🗑️ Shard {self.shard} cleanup: {deleted_count} deleted, {error_count} errors")
+            else:
+                logger.warning(f"⚠️ Unknown job kind: {kind}")
+            await self.db.finish_job(job_id, 'done')
+        except Exception as e:
+            logger.error(f"❌ Job {job_id} ({kind}) failed in {self.worker_id}: {e}")
+            await self.db.finish_job(job_id, 'failed')
+        finally:
+            heartbeat.cancel()
+    
+    async def _keep_lease(self, job_id):
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            await self.db.renew_job_lease(job_id, self.worker_id, self.lease_seconds)
+
+def run_broadcast_worker(shard, shard_count):
+    """Entry point of a broadcast worker process"""
+    try:
+        worker = BroadcastWorker(os.getenv('BOT_TOKEN'), shard, shard_count)
+        asyncio.run(worker.run())
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        logger.error(f"💥 Broadcast worker {shard} crashed: {e}")
+        logger.error(traceback.format_exc())
+
+class LocalLeaseBackend:
+    """In-process lease store - a stand-in for a single instance and for tests"""
+    
     def __init__(self):
+        self.leases = {}
+    
+    def try_acquire(self, name, holder, ttl):
+        now = time.time()
+        current = self.leases.get(name)
+        if current and current[0] != holder and current[1] > now:
+            return False
+        self.leases[name] = (holder, now + ttl)
+        return True
+    
+    def release(self, name, holder):
+        if name in self.leases and self.leases[name][0] == holder:
+            del self.leases[name]
+    
+    def get_holder(self, name):
+        current = self.leases.get(name)
+        return current[0] if current and current[1] > time.time() else None
+
+class DatabaseLeaseBackend:
+    """Leases in a table every replica can reach - a shared SQLite file or PostgreSQL.
+    
+    Expiry uses wall-clock time, so the lease ttl must be well above the clock
+    skew between hosts.
+    """
+    
+    def __init__(self, engine):
+        self.engine = engine
+        conn = self.engine.connect(timeout=10)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS leader_lease (
+                name TEXT PRIMARY KEY,
+                holder TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        ''')
+        conn.commit()
+        conn.close()
+    
+    def try_acquire(self, name, holder, ttl):
+        """Take the lease if it is free or expired, or renew it if we hold it"""
+        now = time.time()
+        conn = self.engine.connect(timeout=10)
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            INSERT INTO leader_lease (name, holder, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at
+            WHERE leader_lease.holder = excluded.holder OR leader_lease.expires_at < ?
+        ''', (name, holder, now + ttl, now))
+        acquired = cursor.rowcount == 1
+        
+        conn.commit()
+        conn.close()
+        return acquired
+    
+    def release(self, name, holder):
+        conn = self.engine.connect(timeout=10)
+        conn.execute('DELETE FROM leader_lease WHERE name = ? AND holder = ?', (name, holder))
+        conn.commit()
+        conn.close()
+    
+    def get_holder(self, name):
+        conn = self.engine.connect(timeout=10)
+        cursor = conn.cursor()
+        cursor.execute('SELECT holder FROM leader_lease WHERE name = ? AND expires_at >= ?', (name, time.time()))
+        result = cursor.fetchone()
+        conn.close()
+        return result[0] if result else None
+
+class LeaderElection:
+    """Lease-based leader election between bot replicas.
+    
+    Every replica tries to take or renew the named lease each renew_interval
+    seconds and only the lease holder is leader. A replica that can't reach the
+    backend keeps leading until its own copy of the lease runs out; one that
+    finds the lease taken steps down at once.
+    """
+    
+    def __init__(self, backend, name='scheduler', holder=None, ttl=30, renew_interval=10):
+        self.backend = backend
+        self.name = name
+        self.holder = holder or f"{socket.gethostname()}:{os.getpid()}"
+        self.ttl = ttl
+        self.renew_interval = renew_interval
+        self.listeners = []   # called with True/False when leadership changes
+        self._leading = False
+        self._valid_until = 0
+        self._task = None
+    
+    @property
+    def is_leader(self):
+        return self._leading and time.monotonic() < self._valid_until
+    
+    async def campaign(self):
+        """Take or renew the lease once, returns whether this replica leads"""
+        was_leader = self._leading
+        asked_at = time.monotonic()
+        try:
+            # Backends are blocking database calls - a busy lease file must not stall the loop
+            acquired = await asyncio.get_running_loop().run_in_executor(
+                None, self.backend.try_acquire, self.name, self.holder, self.ttl
+            )
+            if acquired:
+                self._leading = True
+                self._valid_until = asked_at + self.ttl
+            else:
+                self._leading = False
+        except Exception as e:
+            logger.error(f"❌ Leader lease error: {e}")
+        
+        if self._leading and time.monotonic() >= self._valid_until:
+            self._leading = False
+        
+        if self._leading != was_leader:
+            if self._leading:
+                logger.info(f"👑 {self.holder} is now leader for '{self.name}'")
+            else:
+                logger.warning(f"⚠️ {self.holder} lost leadership for '{self.name}'")
+            for listener in self.listeners:
+                listener(self._leading)
+        return self._leading
+    
+    def start(self):
+        self._task = asyncio.create_task(self._loop())
+    
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+        if self._leading:
+            self._leading = False
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self.backend.release, self.name, self.holder)
+            except Exception as e:
+                logger.error(f"❌ Leader lease release error: {e}")
+    
+    async def _loop(self):
+        while True:
+            await self.campaign()
+            await asyncio.sleep(self.renew_interval)
+
+class DurableScheduler:
+    """Repeating job scheduler with next-run times stored in the database.
+    
+    Restarts keep the schedule, missed runs are caught up once, a job never
+    overlaps with itself and heavy jobs are kept spread_seconds apart. With a
+    leader election only the leader runs jobs, except leader_only=False ones -
+    per-replica housekeeping that keeps its schedule in memory. db is an
+    AsyncDatabase.
+    """
+    
+    def __init__(self, db, application, tick=5, spread_seconds=120, leader=None, run_lease=60):
+        self.db = db
+        self.application = application
+        self.tick = tick
+        self.spread_seconds = spread_seconds
+        self.leader = leader
+        # Leader-only runs are leased to this replica and renewed while they run
+        self.owner = leader.holder if leader else f"{socket.gethostname()}:{os.getpid()}"
+        self.run_lease = run_lease
+        self.jobs = {}
+        self._task = None
+        self._takeover = None
+        if leader:
+            leader.listeners.append(self.on_leadership_change)
+    
+    async def add_job(self, callback, interval, first, heavy=False, name=None, leader_only=True):
+        name = name or callback.__name__
+        now = datetime.now()
+        
+        if not leader_only:
+            self.jobs[name] = {
+                'name': name, 'callback': callback, 'interval': interval, 'heavy': False,
+                'next_run': now + timedelta(seconds=first), 'task': None, 'leader_only': False
+            }
+            return
+        
+        saved = await self.db.get_scheduled_job(name)
+        if saved is None:
+            next_run = now + timedelta(seconds=first)
+        else:
+            # Keep the stored schedule; anything missed while down runs once, shortly
+            next_run = max(saved[1], now + timedelta(seconds=first))
+            next_run = min(next_run, now + timedelta(seconds=interval))
+        
+        job = {
+            'name': name, 'callback': callback, 'interval': interval, 'heavy': heavy,
+            'next_run': next_run, 'task': None, 'leader_only': True
+        }
+        self.jobs[name] = job
+        job['next_run'] = self._spread(job, next_run)
+        await self.db.save_scheduled_job(name, interval, job['next_run'])
+    
+    def _spread(self, job, next_run):
+        """Move a heavy job's run away from other heavy jobs"""
+        if not job['heavy']:
+            return next_run
+        
+        spread = timedelta(seconds=self.spread_seconds)
+        others = [j['next_run'] for j in self.jobs.values() if j['heavy'] and j is not job]
+        moved = True
+        while moved:
+            moved = False
+            for other in others:
+                if abs(other - next_run) < spread:
+                    next_run = other + spread
+                    moved = True
+        return next_run
+    
+    def start(self):
+        if self.leader:
+            # Runs left by a previous leader are released on takeover
+            self.leader.start()
+        self._task = asyncio.create_task(self._loop())
+        logger.info(f"✅ Scheduler started with {len(self.jobs)} jobs")
+    
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+        if self.leader:
+            await self.leader.stop()
+    
+    def on_leadership_change(self, leading):
+        if not leading:
+            running = [job['name'] for job in self.jobs.values() if job['leader_only'] and job['task']]
+            if running:
+                logger.warning(f"⚠️ Lost leadership while running: {', '.join(running)}")
+            return
+        # Leader-only jobs wait until the takeover has read the schedule
+        self._takeover = asyncio.create_task(self._take_over())
+    
+    async def _take_over(self):
+        # A run the old leader is still renewing keeps going - it is claimed once it ends
+        await self.db.reset_running_jobs(expired_only=True)
+        # The previous leader moved the schedule on - pick it up from the database
+        for job in self.jobs.values():
+            if job['leader_only']:
+                saved = await self.db.get_scheduled_job(job['name'])
+                if saved is not None:
+                    job['next_run'] = saved[1]
+    
+    async def _loop(self):
+        if self.leader is None:
+            await self.db.reset_running_jobs()
+        while True:
+            now = datetime.now()
+            leading = self.leader is None or self.leader.is_leader
+            if self._takeover is not None:
+                if not self._takeover.done():
+                    leading = False
+                elif self._takeover.exception():
+                    logger.error(f"❌ Leader takeover failed: {self._takeover.exception()}")
+                    self._takeover = asyncio.create_task(self._take_over())
+                    leading = False
+            for job in self.jobs.values():
+                if job['task'] is None and job['next_run'] <= now and (leading or not job['leader_only']):
+                    await self._launch(job)
+            await asyncio.sleep(self.tick)
+    
+    async def _launch(self, job):
+        if not job['leader_only']:
+            job['task'] = asyncio.create_task(self._run_job(job))
+            return
+        
+        # A run that outlived several intervals is treated as dead
+        stale_before = datetime.now() - timedelta(seconds=job['interval'] * 3)
+        if not await self.db.claim_scheduled_job(job['name'], stale_before, self.owner, self.run_lease):
+            logger.warning(f"⚠️ Skipping {job['name']} - previous run still in progress")
+            job['next_run'] = datetime.now() + timedelta(seconds=self.tick)
+            return
+        job['task'] = asyncio.create_task(self._run_job(job))
+    
+    async def _run_job(self, job):
+        started_at = datetime.now()
+        status, error = 'ok', None
+        heartbeat = asyncio.create_task(self._keep_lease(job)) if job['leader_only'] else None
+        try:
+            await job['callback'](CallbackContext(self.application))
+        except Exception as e:
+            status, error = 'error', str(e)
+            logger.error(f"❌ Scheduled job {job['name']} failed: {e}")
+        finally:
+            if heartbeat:
+                heartbeat.cancel()
+            # Fixed rate from the planned time, but never queue up missed runs
+            next_run = job['next_run'] + timedelta(seconds=job['interval'])
+            now = datetime.now()
+            if next_run <= now:
+                next_run = now + timedelta(seconds=job['interval'])
+            job['next_run'] = self._spread(job, next_run)
+            if job['leader_only']:
+                await self.db.finish_scheduled_job(job['name'], job['next_run'], started_at, status, error)
+            job['task'] = None
+    
+    async def _keep_lease(self, job):
+        while True:
+            await asyncio.sleep(self.run_lease / 3)
+            try:
+                await self.db.renew_scheduled_job(job['name'], self.owner, self.run_lease)
+            except Exception as e:
+                logger.error(f"❌ Could not renew the run of {job['name']}: {e}")
+
+class RetentionEngine:
+    """Prunes old rows table by table in small batches and reclaims the freed space"""
+    
+    # table -> (condition on a cutoff timestamp, retention)
+    POLICIES = {
+        'promotion_messages': ("posted_at < ?", timedelta(days=7)),
+        'user_joins': ("checked_at < ?", timedelta(days=30)),
+        'payments': ("status = 'pending' AND created_at < ?", timedelta(days=30)),
+        'broadcast_jobs': ("status IN ('done', 'failed') AND created_at < ?", timedelta(days=1)),
+        'job_runs': ("started_at < ?", timedelta(days=7)),
+        'stats_rollup': ("period = 'hour' AND bucket < ?", timedelta(days=30)),
+    }
+    
+    def __init__(self, db, batch_size=500, pause=0.05):
+        # db is an AsyncDatabase, deletes and the vacuum run off the event loop
+        self.db = db
+        self.batch_size = batch_size
+        self.pause = pause
+        self.last_report = None
+    
+    async def run(self):
+        """Apply every policy, vacuum and return a report"""
+        size_before, _ = await self.db.get_storage_stats()
+        now = datetime.now()
+        
+        deleted = {}
+        for table, (condition, retention) in self.POLICIES.items():
+            deleted[table] = 0
+            while True:
+                count = await self.db.delete_expired_batch(table, condition, (now - retention,), self.batch_size)
+                deleted[table] += count
+                if count < self.batch_size:
+                    break
+                # Short write transactions with a gap so handlers and workers get the lock
+                await asyncio.sleep(self.pause)
+        
+        await self.db.incremental_vacuum()
+        size_after, free_bytes = await self.db.get_storage_stats()
+        
+        self.last_report = {
+            'deleted': deleted,
+            'reclaimed_bytes': size_before - size_after,
+            'size_bytes': size_after,
+            'free_bytes': free_bytes,
+            'finished_at': datetime.now().isoformat()
+        }
+        return self.last_report
+
+class BotMetadataCache:
+    """TTL cache for Bot API data that rarely changes: get_me, get_chat and the
+    bot's own member status per chat. When a fetch fails, ordinary reads keep
+    serving the old value; refresh=True reads raise, so probes and re-checks
+    never report cached data as fresh.
+    """
+    
+    def __init__(self, call_api=None, me_ttl=3600, chat_ttl=21600, status_ttl=3600):
+        self.call_api = call_api or (lambda method, **kwargs: method(**kwargs))
+        self.me_ttl = me_ttl
+        self.chat_ttl = chat_ttl
+        self.status_ttl = status_ttl
+        self._entries = {}   # key -> (expires_at, value)
+    
+    async def _get(self, key, ttl, fetch, refresh=False):
+        entry = self._entries.get(key)
+        if entry and not refresh and time.monotonic() < entry[0]:
+            return entry[1]
+        try:
+            value = await fetch()
+        except Exception:
+            if entry and not refresh:
+                return entry[1]
+            raise
+        self._entries[key] = (time.monotonic() + ttl, value)
+        return value
+    
+    async def get_me(self, bot, refresh=False):
+        return await self._get(('me',), self.me_ttl, lambda: self.call_api(bot.get_me), refresh)
+    
+    async def get_chat(self, bot, chat_id, refresh=False):
+        return await self._get(
+            ('chat', chat_id), self.chat_ttl,
+            lambda: self.call_api(bot.get_chat, chat_id=chat_id), refresh
+        )
+    
+    async def get_bot_status(self, bot, chat_id, refresh=False):
+        """The bot's own ChatMember status in a chat"""
+        async def fetch():
+            member = await self.call_api(bot.get_chat_member, chat_id=chat_id, user_id=bot.id)
+            return member.status
+        return await self._get(('status', chat_id), self.status_ttl, fetch, refresh)
+    
+    def forget_chat(self, chat_id):
+        self._entries.pop(('chat', chat_id), None)
+        self._entries.pop(('status', chat_id), None)
+    
+    def age_of_me(self):
+        """Seconds since get_me was fetched, None if never"""
+        entry = self._entries.get(('me',))
+        return None if entry is None else self.me_ttl - (entry[0] - time.monotonic())
+    
+    async def refresh_targets(self, bot, target_channels, concurrency=5):
+        """Re-read title, username and bot status of each target, returns changed rows"""
+        semaphore = asyncio.Semaphore(concurrency)
+        changed = []
+        
+        async def refresh(channel):
+            async with semaphore:
+                try:
+                    chat = await self.get_chat(bot, channel.channel_id, refresh=True)
+                    await self.get_bot_status(bot, channel.channel_id, refresh=True)
+                except Exception as e:
+                    logger.warning(f"⚠️ Could not refresh target {channel.channel_id}: {e}")
+                    return
+                if (chat.username, chat.title) != (channel.channel_username, channel.channel_title):
+                    changed.append((channel.channel_id, chat.username, chat.title))
+        
+        await asyncio.gather(*(refresh(channel) for channel in target_channels))
+        return changed
+
+class TargetOnboarder:
+    """Verifies target channels in bulk in the background.
+    
+    Each chat is resolved with get_chat and the bot's status there, concurrently
+    under the shared rate limiter. Chats the bot can post in are upserted in batches
+    through db, an AsyncDatabase.
+    """
+    
+    REF_PATTERN = re.compile(r'^(?:https?://)?(?:t\.me/|@)?([A-Za-z][A-Za-z0-9_]{3,31})$')
+    
+    def __init__(self, db, metadata, concurrency=10):
+        self.db = db
+        self.metadata = metadata
+        self.concurrency = concurrency
+        self._queue = None
+        self._task = None
+    
+    @classmethod
+    def parse_refs(cls, text):
+        """Chat ids and @usernames from a pasted list or file, duplicates dropped"""
+        refs = []
+        for token in re.split(r'[\s,;]+', text):
+            token = token.strip()
+            if re.fullmatch(r'-?\d+', token):
+                ref = int(token)
+            else:
+                match = cls.REF_PATTERN.match(token)
+                if not match:
+                    continue
+                ref = f"@{match.group(1)}"
+            if ref not in refs:
+                refs.append(ref)
+        return refs
+    
+    def submit(self, bot, refs, report_chat_id=None):
+        """Queue refs for verification, returns the queue length"""
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        self._queue.put_nowait((bot, refs, report_chat_id))
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        return self._queue.qsize()
+    
+    async def _run(self):
+        while not self._queue.empty():
+            bot, refs, report_chat_id = await self._queue.get()
+            try:
+                verified, failed = await self.verify(bot, refs)
+                await self.db.upsert_target_channels(verified)
+                logger.info(f"✅ Target import: {len(verified)} added, {len(failed)} failed")
+                if report_chat_id:
+                    await bot.send_message(chat_id=report_chat_id, text=self.format_report(verified, failed))
+            except Exception as e:
+                logger.error(f"Target import error: {e}")
+    
+    async def verify(self, bot, refs):
+        """Returns ([(channel_id, username, title)], [(ref, reason)])"""
+        semaphore = asyncio.Semaphore(self.concurrency)
+        verified = []
+        failed = []
+        
+        async def check(ref):
+            async with semaphore:
+                try:
+                    chat = await self.metadata.get_chat(bot, ref, refresh=True)
+                    status = await self.metadata.get_bot_status(bot, chat.id, refresh=True)
+                except Exception as e:
+                    failed.append((ref, str(e)))
+                    return
+                
+                # Channels need admin rights to post, groups only membership
+                if status in ('administrator', 'creator') or (status == 'member' and chat.type != 'channel'):
+                    verified.append((chat.id, chat.username, chat.title))
+                else:
+                    failed.append((ref, f"bot is {status}"))
+        
+        await asyncio.gather(*(check(ref) for ref in refs))
+        return verified, failed
+    
+    @staticmethod
+    def format_report(verified, failed):
+        text = f"🎯 Target import finished\n\n✅ Added: {len(verified)}\n❌ Failed: {len(failed)}\n"
+        for ref, reason in failed[:10]:
+            text += f"\n• {ref}: {reason}"
+        if len(failed) > 10:
+            text += f"\n... and {len(failed) - 10} more"
+        return text
+
+class SnapshotStore:
+    """Rotating SQLite snapshot files on local disk.
+    
+    A snapshot is copied with the online backup API `pages` pages per step in a
+    worker thread; the source is only locked during a step, so writers wait for
+    one step at most, never for the whole copy. Point SNAPSHOT_DIR at a
+    persistent disk to keep snapshots across restarts.
+    """
+    
+    NAME = re.compile(r'snapshot_(\d{8}_\d{6})\.db')
+    
+    def __init__(self, engine, directory='snapshots', keep=8, pages=256, step_sleep=0.005):
+        self.engine = engine
+        self.directory = directory
+        self.keep = keep
+        self.pages = pages
+        self.step_sleep = step_sleep
+    
+    async def take(self):
+        """Write a new snapshot - returns its path"""
+        return await asyncio.get_running_loop().run_in_executor(None, self.take_sync)
+    
+    def take_sync(self):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"snapshot_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db")
+        partial = f"{path}.partial"
+        
+        started = time.monotonic()
+        source = self.engine.connect()
+        target = sqlite3.connect(partial)
+        try:
+            source.backup(target, pages=self.pages, sleep=self.step_sleep)
+        finally:
+            target.close()
+            source.close()
+        os.replace(partial, path)
+        
+        self.rotate()
+        logger.info(f"📸 Snapshot {os.path.basename(path)} written in {time.monotonic() - started:.2f}s")
+        return path
+    
+    def snapshots(self):
+        """[(timestamp, path)] of the snapshots on disk, newest first"""
+        found = []
+        for path in glob.glob(os.path.join(self.directory, 'snapshot_*.db')):
+            match = self.NAME.fullmatch(os.path.basename(path))
+            if match:
+                found.append((datetime.strptime(match.group(1), "%Y%m%d_%H%M%S"), path))
+        return sorted(found, reverse=True)
+    
+    def latest(self):
+        snapshots = self.snapshots()
+        return snapshots[0] if snapshots else None
+    
+    def rotate(self):
+        for _, path in self.snapshots()[self.keep:]:
+            os.remove(path)
+
+class BackupRetentionPolicy:
+    """Tiered backup retention - the newest backup of each of the last `hourly`
+    hours, `daily` days and `weekly` ISO weeks that have one, plus the latest"""
+    
+    TIERS = (('hourly', '%Y%m%d%H'), ('daily', '%Y%m%d'), ('weekly', '%G%V'))
+    
+    def __init__(self, hourly=24, daily=7, weekly=8):
+        self.limits = {'hourly': hourly, 'daily': daily, 'weekly': weekly}
+    
+    def select(self, entries):
+        """Split manifest entries, newest first, into (keep, prune)"""
+        keep = {entries[0]['name']} if entries else set()
+        for tier, bucket_format in self.TIERS:
+            buckets = set()
+            for entry in entries:
+                bucket = datetime.fromisoformat(entry['timestamp']).strftime(bucket_format)
+                if bucket in buckets:
+                    continue
+                if len(buckets) >= self.limits[tier]:
+                    break
+                buckets.add(bucket)
+                keep.add(entry['name'])
+        return [e for e in entries if e['name'] in keep], [e for e in entries if e['name'] not in keep]
+
+class GitHubBackup:
+    """Database backups in a GitHub repo, indexed by a manifest.
+    
+    manifest.json in the backup directory lists every backup newest first with
+    its timestamp, size, sha256 and type, so restore reads one small file instead
+    of listing the directory. A backup is a gzipped SQLite snapshot file, or a
+    JSON export when storage is not SQLite. A backup is written through the Git Data API - the
+    data, the updated manifest and the deletion of everything the retention
+    policy no longer keeps go into one commit on top of the cached branch head.
+    """
+    
+    MANIFEST = 'manifest.json'
+    EXTENSIONS = {'json': 'json', 'sqlite.gz': 'db.gz'}
+    
+    def __init__(self, retention=None):
         try:
             self.token = os.getenv('GITHUB_TOKEN')
             self.repo_owner = os.getenv('GITHUB_REPO_OWNER')
             self.repo_name = os.getenv('GITHUB_REPO_NAME')
             self.backup_path = os.getenv('GITHUB_BACKUP_PATH', 'backups')
             self.branch = os.getenv('GITHUB_BACKUP_BRANCH', 'main')
+            self.retention = retention or BackupRetentionPolicy(
+                hourly=int(os.getenv('BACKUP_KEEP_HOURLY', 24)),
+                daily=int(os.getenv('BACKUP_KEEP_DAILY', 7)),
+                weekly=int(os.getenv('BACKUP_KEEP_WEEKLY', 8))
+            )
+            # (commit sha, tree sha) of the branch head and the manifest in it, kept
+            # between backups and dropped when another writer moves the branch
+            self._head = None
+            self._manifest = None
             
             # Log GitHub configuration status
             if self.token and self.repo_owner and self.repo_name:
-                self.base_url = f"https://api.github.com/repos/{self.repo_owner}/{self.repo_name}/contents"
+                self.repo_url = f"https://api.github.com/repos/{self.repo_owner}/{self.repo_name}"
+                self.base_url = f"{self.repo_url}/contents"
                 logger.info("✅ GitHub backup configured")
             else:
                 self.base_url = None
@@ -551,105 +3499,236 @@ class GitHubBackup:
             logger.error(f"❌ GitHubBackup initialization failed: {e}")
             self.base_url = None
     
-    def backup_database(self, database_export):
+    def _headers(self, raw=False):
+        return {
+            "Authorization": f"token {self.token}",
+            "Accept": "application/vnd.github.raw" if raw else "application/vnd.github.v3+json"
+        }
+    
+    def _request(self, method, path, raw=False, **kwargs):
+        import requests
+        
+        return requests.request(method, f"{self.base_url}/{path}", headers=self._headers(raw), timeout=30, **kwargs)
+    
+    def _git(self, method, path, **kwargs):
+        import requests
+        
+        return requests.request(method, f"{self.repo_url}/git/{path}", headers=self._headers(), timeout=60, **kwargs)
+    
+    def backup_database(self, database_export, backup_type='scheduled'):
+        """Upload a JSON export of the database"""
         if not self.token or not self.base_url:
             logger.warning("GitHub token not available, skipping backup")
             return False
-            
+        
+        data_json = json.dumps(database_export, indent=2, default=str)
+        return self._upload(data_json.encode('utf-8'), 'json', backup_type)
+    
+    def backup_snapshot(self, snapshot_path, backup_type='scheduled'):
+        """Upload a SQLite snapshot file, gzip-compressed"""
+        if not self.token or not self.base_url:
+            logger.warning("GitHub token not available, skipping backup")
+            return False
+        
+        try:
+            with open(snapshot_path, 'rb') as f:
+                data_bytes = gzip.compress(f.read(), compresslevel=6, mtime=0)
+        except OSError as e:
+            logger.error(f"Backup error: {e}")
+            return False
+        return self._upload(data_bytes, 'sqlite.gz', backup_type)
+    
+    def _upload(self, data_bytes, backup_format, backup_type):
         try:
-            # Convert data to JSON
-            data_json = json.dumps(database_export, indent=2, default=str)
-            data_bytes = data_json.encode('utf-8')
             data_b64 = base64.b64encode(data_bytes).decode('utf-8')
             
             # Create filename with timestamp
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            filename = f"{self.backup_path}/backup_{timestamp}.json"
+            now = datetime.now()
+            timestamp = now.strftime("%Y%m%d_%H%M%S")
+            name = f"backup_{timestamp}.{self.EXTENSIONS[backup_format]}"
             
-            # Prepare API request
-            headers = {
-                "Authorization": f"token {self.token}",
-                "Accept": "application/vnd.github.v3+json"
-            }
+            response = self._git('POST', 'blobs', json={"content": data_b64, "encoding": "base64"})
+            response.raise_for_status()
             
-            data = {
-                "message": f"Database backup {timestamp}",
-                "content": data_b64,
-                "branch": self.branch
+            entry = {
+                "name": name,
+                "timestamp": now.isoformat(timespec='seconds'),
+                "size": len(data_bytes),
+                "sha256": hashlib.sha256(data_bytes).hexdigest(),
+                "type": backup_type,
+                "format": backup_format,
+                "blob": response.json()['sha']
             }
             
-            # Ensure backup directory exists
-            self._ensure_backup_directory(headers)
-            
-            response = requests.put(
-                f"{self.base_url}/{filename}",
-                headers=headers,
-                json=data
-            )
+            for _ in range(3):
+                if self._commit_backup(entry, f"Database backup {timestamp}"):
+                    logger.info("✅ Backup created successfully on GitHub")
+                    return True
+                # Another writer moved the branch - start again from its new head
+                self._head = None
             
-            if response.status_code == 201:
-                logger.info("✅ Backup created successfully on GitHub")
-                return True
-            else:
-                logger.error(f"❌ Backup failed with status {response.status_code}: {response.text}")
-                return False
+            logger.error("❌ Backup failed: branch kept moving")
+            return False
             
         except Exception as e:
+            self._head = None
             logger.error(f"Backup error: {e}")
             return False
     
-    def _ensure_backup_directory(self, headers):
-        """Ensure the backup directory exists in the repo"""
-        try:
-            dir_path = self.backup_path.split('/')[0]
-            response = requests.get(
-                f"{self.base_url}/{dir_path}",
-                headers=headers
-            )
-            
+    def _commit_backup(self, entry, message):
+        """Commit a backup, its manifest entry and the pruning - False if the branch moved"""
+        head = self._load_head()
+        manifest = self._load_manifest(head)
+        
+        backups = sorted([entry] + [e for e in manifest['backups'] if e['name'] != entry['name']],
+                         key=lambda e: e['timestamp'], reverse=True)
+        keep, prune = self.retention.select(backups)
+        deletions = [f"{self.backup_path}/{e['name']}" for e in manifest.get('pending_delete', []) + prune]
+        
+        manifest = {
+            "version": 1,
+            "backups": keep,
+            "pending_delete": [],
+            "updated_at": datetime.now().isoformat(timespec='seconds')
+        }
+        files = [
+            {"path": f"{self.backup_path}/{entry['name']}", "mode": "100644", "type": "blob", "sha": entry['blob']},
+            {"path": f"{self.backup_path}/{self.MANIFEST}", "mode": "100644", "type": "blob",
+             "content": json.dumps(manifest, indent=2)}
+        ]
+        
+        tree = self._create_tree(head, files, deletions)
+        if tree is None and deletions:
+            # A path to prune is already gone - commit the backup and skip pruning this time
+            logger.warning(f"⚠️ Could not prune {len(deletions)} backups, committing without pruning")
+            manifest['backups'] = backups
+            files[1]['content'] = json.dumps(manifest, indent=2)
+            deletions, prune = [], []
+            tree = self._create_tree(head, files, deletions)
+        if tree is None:
+            raise RuntimeError("creating the backup tree failed")
+        
+        response = self._git('POST', 'commits', json={
+            "message": message,
+            "tree": tree,
+            "parents": [head[0]] if head else []
+        })
+        response.raise_for_status()
+        commit = response.json()['sha']
+        
+        if head:
+            response = self._git('PATCH', f"refs/heads/{self.branch}", json={"sha": commit})
+        else:
+            response = self._git('POST', 'refs', json={"ref": f"refs/heads/{self.branch}", "sha": commit})
+        if response.status_code in (409, 422):
+            return False
+        response.raise_for_status()
+        
+        self._head = (commit, tree)
+        self._manifest = manifest
+        if deletions:
+            logger.info(f"🧹 Backup retention: {len(manifest['backups'])} kept, {len(deletions)} pruned")
+        return True
+    
+    def _create_tree(self, head, files, deletions):
+        tree = files + [{"path": path, "mode": "100644", "type": "blob", "sha": None} for path in deletions]
+        body = {"tree": tree}
+        if head:
+            body["base_tree"] = head[1]
+        response = self._git('POST', 'trees', json=body)
+        if response.status_code == 422:
+            return None
+        response.raise_for_status()
+        return response.json()['sha']
+    
+    def _load_head(self):
+        """(commit sha, tree sha) of the branch head - None while the branch doesn't exist"""
+        if self._head is None:
+            self._manifest = None
+            response = self._git('GET', f"ref/heads/{self.branch}")
             if response.status_code == 404:
-                # Create directory
-                data = {
-                    "message": f"Create {dir_path} directory",
-                    "content": base64.b64encode(b" ").decode('utf-8'),
-                    "branch": self.branch
-                }
-                requests.put(
-                    f"{self.base_url}/{dir_path}/.gitkeep",
-                    headers=headers,
-                    json=data
-                )
+                return None
+            response.raise_for_status()
+            commit = response.json()['object']['sha']
+            
+            response = self._git('GET', f"commits/{commit}")
+            response.raise_for_status()
+            self._head = (commit, response.json()['tree']['sha'])
+        return self._head
+    
+    def _load_manifest(self, head):
+        """Manifest as of the head commit - built from the directory the first time"""
+        if self._manifest is None and head:
+            self._manifest, _ = self.get_manifest(ref=head[0])
+            if self._manifest is None:
+                self._manifest = {"version": 1, "backups": self.list_backup_files(ref=head[0]), "pending_delete": []}
+        return self._manifest or {"version": 1, "backups": [], "pending_delete": []}
+    
+    def get_manifest(self, ref=None):
+        """Return (manifest, blob sha) - (None, None) when there is no manifest yet"""
+        response = self._request('GET', f"{self.backup_path}/{self.MANIFEST}", params={"ref": ref or self.branch})
+        if response.status_code == 404:
+            return None, None
+        response.raise_for_status()
+        content = response.json()
+        return json.loads(base64.b64decode(content['content'])), content['sha']
+    
+    def list_backup_files(self, ref=None):
+        """Backups found by listing the directory, for repos from before the manifest"""
+        response = self._request('GET', self.backup_path, params={"ref": ref or self.branch})
+        if response.status_code != 200:
+            return []
+        
+        entries = []
+        for f in response.json():
+            match = re.fullmatch(r'backup_(\d{8}_\d{6})\.(json|db\.gz)', f['name'])
+            if match:
+                entries.append({
+                    "name": f['name'],
+                    "timestamp": datetime.strptime(match.group(1), "%Y%m%d_%H%M%S").isoformat(),
+                    "size": f['size'],
+                    "sha256": None,
+                    "type": 'legacy',
+                    "format": 'json' if match.group(2) == 'json' else 'sqlite.gz',
+                    "blob": f['sha']
+                })
+        return sorted(entries, key=lambda e: e['timestamp'], reverse=True)
+    
+    def latest_backup_entry(self):
+        """Manifest entry of the newest backup - one small GET"""
+        if not self.token or not self.base_url:
+            return None
+        try:
+            manifest, _ = self.get_manifest()
+            if manifest is None:
+                backups = self.list_backup_files()
+            else:
+                backups = manifest['backups']
+            return backups[0] if backups else None
         except Exception as e:
-            logger.error(f"Directory creation error: {e}")
+            logger.error(f"Backup manifest error: {e}")
+            return None
     
-    def load_latest_backup(self):
+    def download_latest(self):
+        """(manifest entry, content) of the newest backup that downloads intact, or None"""
         if not self.token or not self.base_url:
             return None
             
         try:
-            headers = {
-                "Authorization": f"token {self.token}",
-                "Accept": "application/vnd.github.v3+json"
-            }
-            
-            # Get repository contents in backup directory
-            response = requests.get(f"{self.base_url}/{self.backup_path}", headers=headers)
-            if response.status_code != 200:
-                return None
-            
-            files = response.json()
-            backup_files = [f for f in files if f['name'].startswith('backup_') and f['name'].endswith('.json')]
-            
-            if not backup_files:
-                return None
+            manifest, _ = self.get_manifest()
+            backups = manifest['backups'] if manifest else self.list_backup_files()
             
-            # Get the latest backup file
-            latest_backup = sorted(backup_files, key=lambda x: x['name'], reverse=True)[0]
-            
-            # Download file content
-            file_response = requests.get(latest_backup['download_url'])
-            if file_response.status_code == 200:
-                return file_response.json()
+            # Newest backup that downloads and matches its checksum
+            for entry in backups:
+                response = self._request('GET', f"{self.backup_path}/{entry['name']}", raw=True, params={"ref": self.branch})
+                if response.status_code != 200:
+                    logger.error(f"❌ Backup {entry['name']} download failed with status {response.status_code}")
+                    continue
+                if entry['sha256'] and hashlib.sha256(response.content).hexdigest() != entry['sha256']:
+                    logger.error(f"❌ Backup {entry['name']} failed checksum, trying an older one")
+                    continue
+                entry.setdefault('format', 'json')
+                return entry, response.content
             
             return None
             
@@ -658,9 +3737,10 @@ class GitHubBackup:
             return None
 
 class PromotionBot:
-    def __init__(self):
+    def __init__(self, startup=None):
         try:
             logger.info("🔄 Initializing PromotionBot...")
+            self.startup = startup or StartupReport()
             
             self.token = os.getenv('BOT_TOKEN')
             if not self.token:
@@ -672,13 +3752,23 @@ class PromotionBot:
             logger.info(f"✅ Required channels: {len(self.required_channels)}")
             
             # Initialize database first
-            self.db = Database()
+            with self.startup.stage('database'):
+                self.db = Database()
+            self.adb = AsyncDatabase(self.db)
             
-            # Initialize GitHub backup
-            self.github_backup = GitHubBackup()
+            # GitHub backup is set up on first use, the restore runs in run()
+            self._github_backup = None
+            self._backup_task = None
+            self._backup_again = None
             
-            # Auto-load latest backup on startup
-            self.load_backup_on_startup()
+            # Local snapshots between uploads, and the file GitHub uploads - SQLite only
+            self.snapshots = None
+            if self.db.engine.dialect == 'sqlite':
+                self.snapshots = SnapshotStore(
+                    self.db.engine,
+                    directory=os.getenv('SNAPSHOT_DIR', 'snapshots'),
+                    keep=int(os.getenv('SNAPSHOT_KEEP', 8))
+                )
             
             # Pricing configuration
             self.pricing = {
@@ -689,9 +3779,71 @@ class PromotionBot:
                 'year': {'stars': 300, 'days': 365}
             }
             
+            # Updates from different users run in parallel, each user's in order
+            self.concurrent_updates = max(1, int(os.getenv('CONCURRENT_UPDATES', 8)))
+            
+            # Broadcasting - inline, or sharded across worker processes
+            self.broadcast_workers = max(0, int(os.getenv('BROADCAST_WORKERS', 0)))
+            self.broadcaster = BroadcastEngine(self.adb, process_count=self.broadcast_workers + 1)
+            self.retention = RetentionEngine(self.adb)
+            self.metadata = BotMetadataCache(call_api=self.broadcaster.call_api)
+            self.onboarder = TargetOnboarder(self.adb, self.metadata)
+            
+            # 'send' renders per target, 'copy'/'forward' reuse one staging post
+            self.delivery_mode = os.getenv('PROMOTION_DELIVERY', 'send')
+            if self.delivery_mode not in ('send', 'copy', 'forward'):
+                logger.warning(f"⚠️ Unknown PROMOTION_DELIVERY '{self.delivery_mode}', using 'send'")
+                self.delivery_mode = 'send'
+            self.staging_chat = os.getenv('PROMOTION_STAGING_CHAT')
+            self.worker_processes = []
+            
+            # Under load /start is answered from cache and expensive flows queue up
+            self.admission = AdmissionController(
+                self.respond_degraded,
+                max_in_flight=int(os.getenv('MAX_IN_FLIGHT_UPDATES', 64)),
+                full_start_cost=len(self.required_channels) + 1
+            )
+            
+            # Promotion flow state (selected_duration, pending_payment) survives restarts
+            self.persistence = SQLitePersistence(
+                self.adb,
+                update_interval=int(os.getenv('STATE_FLUSH_INTERVAL', 30)),
+                idle_ttl=int(os.getenv('STATE_IDLE_TTL', 1800)),
+                state_ttl=timedelta(days=int(os.getenv('STATE_TTL_DAYS', 7)))
+            )
+            
+            # Updates Telegram delivers again after a restart or slow poll are dropped
+            self.seen_updates = SeenUpdates(self.db, size=int(os.getenv('SEEN_UPDATES_WINDOW', 8192)))
+            self.seen_updates.load()
+            
+            # With several replicas only the lease holder runs scheduled jobs
+            self.leader = self.create_leader_election(os.getenv('LEADER_ELECTION', 'database'))
+            
+            # Telegram answers a second getUpdates with 409 Conflict, so replicas either
+            # all take updates through the webhook or only the leader polls
+            self.webhook_url = os.getenv('WEBHOOK_URL')
+            self._polling_lock = asyncio.Lock()
+            self._polling_task = None
+            if self.leader and not self.webhook_url:
+                self.leader.listeners.append(self.toggle_polling)
+            
+            # Slots per promotion post, shared out by plan tier when promotions don't fit
+            self.planner = ExposurePlanner(self.pricing, slots_per_post=int(os.getenv('PROMOTION_SLOTS', 20)))
+            
             # Create application with modern approach
-            self.application = Application.builder().token(self.token).build()
-            self.setup_handlers()
+            with self.startup.stage('application'):
+                self.application = (
+                    Application.builder()
+                    .token(self.token)
+                    .concurrent_updates(PerUserUpdateProcessor(self.concurrent_updates, admission=self.admission, seen=self.seen_updates))
+                    .persistence(self.persistence)
+                    .build()
+                )
+                logger.info(f"✅ Update workers: {self.concurrent_updates}")
+                
+                # Scheduled jobs keep their timers across restarts
+                self.scheduler = DurableScheduler(self.adb, self.application, leader=self.leader)
+                self.setup_handlers()
             
             logger.info("✅ PromotionBot initialized successfully")
             
@@ -723,21 +3875,104 @@ class PromotionBot:
         
         return channels
     
+    def create_leader_election(self, backend_name):
+        if backend_name == 'off':
+            return None
+        if backend_name == 'local':
+            backend = LocalLeaseBackend()
+        elif os.getenv('LEADER_LEASE_DB'):
+            # A SQLite file on storage every replica can reach
+            backend = DatabaseLeaseBackend(SQLiteEngine(os.getenv('LEADER_LEASE_DB')))
+        else:
+            if backend_name not in ('database', 'sqlite'):
+                logger.warning(f"⚠️ Unknown LEADER_ELECTION '{backend_name}', using 'database'")
+            backend = DatabaseLeaseBackend(self.db.engine)
+        return LeaderElection(
+            backend,
+            holder=os.getenv('RENDER_INSTANCE_ID'),
+            ttl=int(os.getenv('LEADER_LEASE_TTL', 30))
+        )
+    
+    @property
+    def github_backup(self):
+        if self._github_backup is None:
+            self._github_backup = GitHubBackup()
+        return self._github_backup
+    
     def load_backup_on_startup(self):
-        """Load the latest backup when bot starts"""
+        """Load the newer of the latest local snapshot and the latest GitHub backup when bot starts"""
         try:
-            backup_data = self.github_backup.load_latest_backup()
-            if backup_data:
-                success = self.db.import_data(backup_data)
-                if success:
-                    logger.info("✅ Successfully loaded backup from GitHub")
-                else:
-                    logger.error("❌ Failed to import backup data")
-            else:
+            snapshot = self.snapshots.latest() if self.snapshots else None
+            remote = self.github_backup.latest_backup_entry()
+            if snapshot and (remote is None or snapshot[0] >= datetime.fromisoformat(remote['timestamp'])):
+                if self.db.restore_snapshot(snapshot[1]):
+                    logger.info(f"✅ Successfully loaded local snapshot {os.path.basename(snapshot[1])}")
+                    return
+                logger.error("❌ Local snapshot failed, trying GitHub")
+            
+            success = self.restore_from_github()
+            if success is None:
                 logger.info("ℹ️ No existing backup found, starting fresh")
+            elif success:
+                logger.info("✅ Successfully loaded backup from GitHub")
+            else:
+                logger.error("❌ Failed to import backup data")
         except Exception as e:
             logger.error(f"Backup load error: {e}")
     
+    def restore_from_github(self):
+        """Restore the newest intact GitHub backup - None when there is none"""
+        latest = self.github_backup.download_latest()
+        if latest is None:
+            return None
+        
+        entry, content = latest
+        if entry['format'] == 'json':
+            return self.db.restore_data(json.loads(content))
+        
+        download_path = f"{self.db.db_path}.download"
+        try:
+            with open(download_path, 'wb') as f:
+                f.write(gzip.decompress(content))
+            return self.db.restore_snapshot(download_path)
+        finally:
+            if os.path.exists(download_path):
+                os.remove(download_path)
+    
+    async def backup_now(self, backup_type='scheduled'):
+        """Upload a backup to GitHub - a fresh snapshot file, or a JSON export without SQLite"""
+        # Uploads are blocking requests calls - keep them off the event loop
+        loop = asyncio.get_running_loop()
+        if self.snapshots:
+            path = await self.snapshots.take()
+            return await loop.run_in_executor(
+                None, functools.partial(self.github_backup.backup_snapshot, path, backup_type=backup_type)
+            )
+        data = await self.adb.export_data()
+        return await loop.run_in_executor(
+            None, functools.partial(self.github_backup.backup_database, data, backup_type=backup_type)
+        )
+    
+    def schedule_backup(self, backup_type):
+        """Upload a backup in the background - handlers don't wait for the snapshot and upload.
+        
+        Requests during a running upload are folded into one follow-up upload.
+        """
+        if self._backup_task is None or self._backup_task.done():
+            self._backup_task = asyncio.create_task(self._run_backups(backup_type))
+        else:
+            self._backup_again = backup_type
+    
+    async def _run_backups(self, backup_type):
+        while backup_type:
+            self._backup_again = None
+            try:
+                if not await self.backup_now(backup_type=backup_type):
+                    logger.error(f"❌ {backup_type.capitalize()} backup failed")
+            except Exception as e:
+                logger.error(f"Background backup error: {e}")
+            backup_type = self._backup_again
+    
     async def check_user_joined_channels(self, user_id):
         """Check if user has joined all required channels"""
         if not self.required_channels:
@@ -753,7 +3988,7 @@ class PromotionBot:
                 )
                 
                 is_joined = chat_member.status in ['member', 'administrator', 'creator']
-                self.db.update_user_join_status(user_id, channel['id'], is_joined)
+                await self.adb.update_user_join_status(user_id, channel['id'], is_joined)
                 
                 if not is_joined:
                     not_joined.append(channel['username'])
@@ -774,10 +4009,17 @@ class PromotionBot:
         self.application.add_handler(CommandHandler("check_join", self.check_join))
         self.application.add_handler(CommandHandler("health", self.health_check))
         self.application.add_handler(CommandHandler("targets", self.list_target_channels))
+        self.application.add_handler(CommandHandler("import_targets", self.import_targets))
         
         # Callback query handlers
         self.application.add_handler(CallbackQueryHandler(self.button_handler))
         
+        # Target list uploaded as a file captioned /import_targets
+        self.application.add_handler(MessageHandler(
+            filters.Document.ALL & filters.CaptionRegex(r'^/import_targets'),
+            self.import_targets
+        ))
+        
         # Message handler for channel posts and payments
         self.application.add_handler(MessageHandler(filters.FORWARDED, self.handle_forwarded_message))
         self.application.add_handler(MessageHandler(filters.ALL, self.handle_message))
@@ -790,7 +4032,7 @@ class PromotionBot:
         user_id = update.effective_user.id
         
         # Skip check for admins
-        if self.db.is_admin(user_id):
+        if await self.adb.is_admin(user_id):
             return True
         
         all_joined, not_joined = await self.check_user_joined_channels(user_id)
@@ -825,6 +4067,34 @@ class PromotionBot:
         else:
             await update.message.reply_text(message_text, reply_markup=reply_markup, parse_mode='Markdown')
     
+    async def respond_degraded(self, update: Update):
+        """Answer /start from stored join status only - one API call, used under load"""
+        user_id = update.effective_user.id
+        
+        is_admin = await self.adb.is_admin(user_id)
+        joined = is_admin or all([
+            await self.adb.get_user_join_status(user_id, channel['id']) for channel in self.required_channels
+        ])
+        
+        if not joined:
+            await self.show_join_required_message(update, [channel['username'] for channel in self.required_channels])
+            return
+        
+        keyboard = [
+            [InlineKeyboardButton("🚀 Promote Channel", callback_data="main_promote")],
+            [InlineKeyboardButton("📊 View Statistics", callback_data="main_stats")],
+            [InlineKeyboardButton("💰 Pricing", callback_data="main_pricing")],
+        ]
+        
+        if is_admin:
+            keyboard.append([InlineKeyboardButton("🛠️ Admin Panel", callback_data="main_admin")])
+        
+        await update.message.reply_text(
+            "🏠 **Main Menu**\n\nChoose an option below:",
+            reply_markup=InlineKeyboardMarkup(keyboard),
+            parse_mode='Markdown'
+        )
+    
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Check if user has joined required channels
         if not await self.check_join_requirement(update, context):
@@ -894,7 +4164,7 @@ Choose an option below to get started:
         user_id = update.effective_user.id
         
         # Skip check for admins
-        if self.db.is_admin(user_id):
+        if await self.adb.is_admin(user_id):
             await update.message.reply_text("✅ You are an admin - no channel join required!")
             return
         
@@ -911,15 +4181,16 @@ Choose an option below to get started:
         
         # Check database
         try:
-            active_channels = len(self.db.get_active_channels())
+            active_channels = len(await self.adb.get_active_channels())
             health_status += f"• Database: ✅ Connected ({active_channels} active promotions)\n"
         except:
             health_status += "• Database: ❌ Connection failed\n"
         
         # Check GitHub backup
         try:
-            if self.github_backup.load_latest_backup():
-                health_status += "• GitHub Backup: ✅ Connected\n"
+            latest = await asyncio.get_running_loop().run_in_executor(None, self.github_backup.latest_backup_entry)
+            if latest:
+                health_status += f"• GitHub Backup: ✅ Connected (latest {latest['timestamp']})\n"
             else:
                 health_status += "• GitHub Backup: ⚠️ No backups found\n"
         except:
@@ -927,8 +4198,12 @@ Choose an option below to get started:
         
         # Check bot status
         try:
-            me = await context.bot.get_me()
-            health_status += f"• Bot API: ✅ Connected (@{me.username})\n"
+            me = await self.metadata.get_me(context.bot)
+            age = self.metadata.age_of_me()
+            if age > self.metadata.me_ttl:
+                health_status += f"• Bot API: ⚠️ Unreachable, last reached {age:.0f}s ago (@{me.username})\n"
+            else:
+                health_status += f"• Bot API: ✅ Connected (@{me.username}, checked {age:.0f}s ago)\n"
         except:
             health_status += "• Bot API: ❌ Connection failed\n"
         
@@ -946,23 +4221,58 @@ Choose an option below to get started:
             return f"{days}d {hours}h {minutes}m {seconds}s"
         return "Unknown"
     
+    async def import_targets(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Bulk-add target channels from a pasted list or an uploaded file"""
+        if not await self.adb.is_admin(update.effective_user.id):
+            await update.message.reply_text("❌ Admin access required.")
+            return
+        
+        document = update.message.document
+        if document:
+            if document.file_size and document.file_size > 1024 * 1024:
+                await update.message.reply_text("❌ File too large (max 1 MB).")
+                return
+            file = await document.get_file()
+            text = (await file.download_as_bytearray()).decode('utf-8', errors='ignore')
+        else:
+            text = ' '.join(context.args or [])
+        
+        refs = TargetOnboarder.parse_refs(text)
+        if not refs:
+            await update.message.reply_text(
+                "📥 **Import Target Channels**\n\n"
+                "Send `/import_targets` followed by chat ids or @usernames, "
+                "or upload a .txt/.csv file with the caption `/import_targets`.",
+                parse_mode='Markdown'
+            )
+            return
+        
+        self.onboarder.submit(context.bot, refs, report_chat_id=update.effective_chat.id)
+        await update.message.reply_text(f"🔄 Verifying {len(refs)} channels in the background...")
+    
     async def list_target_channels(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """List all target channels"""
-        if not self.db.is_admin(update.effective_user.id):
+        if not await self.adb.is_admin(update.effective_user.id):
             await update.message.reply_text("❌ Admin access required.")
             return
         
-        target_channels = self.db.get_target_channels()
+        target_channels = await self.adb.get_target_channels()
         
         if not target_channels:
             await update.message.reply_text("📭 No target channels configured.")
             return
         
+        health = await self.adb.get_target_health()
+        
         text = "🎯 **Target Channels**\n\n"
         for channel in target_channels:
-            channel_id, username, title, added_at, auto_added = channel[1], channel[2], channel[3], channel[4], channel[5]
+            channel_id, username, title, auto_added = channel.channel_id, channel.channel_username, channel.channel_title, channel.auto_added
             text += f"• {title or 'Unknown'} (@{username or 'N/A'})\n"
-            text += f"  ID: {channel_id} | Auto: {'✅' if auto_added else '❌'}\n\n"
+            text += f"  ID: {channel_id} | Auto: {'✅' if auto_added else '❌'}\n"
+            record = health.get(channel_id)
+            if record and record['state'] != 'closed':
+                text += f"  ⚠️ Paused after {record['failures']} failures\n"
+            text += "\n"
         
         await update.message.reply_text(text, parse_mode='Markdown')
     
@@ -1003,7 +4313,7 @@ Choose an option below to get started:
             await self.show_pricing(update, context)
         
         elif query.data == 'main_admin':
-            if self.db.is_admin(query.from_user.id):
+            if await self.adb.is_admin(query.from_user.id):
                 await self.admin(update, context, from_callback=True)
             else:
                 await query.answer("❌ Admin access required.", show_alert=True)
@@ -1044,7 +4354,7 @@ Choose an option below to get started:
             [InlineKeyboardButton("💰 Pricing", callback_data="main_pricing")],
         ]
         
-        if self.db.is_admin(update.callback_query.from_user.id):
+        if await self.adb.is_admin(update.callback_query.from_user.id):
             keyboard.append([InlineKeyboardButton("🛠️ Admin Panel", callback_data="main_admin")])
         
         reply_markup = InlineKeyboardMarkup(keyboard)
@@ -1113,8 +4423,8 @@ Choose an option below to get started:
         pricing = self.pricing[duration]
         
         # For admins - free promotion
-        if self.db.is_admin(update.effective_user.id):
-            success = self.db.add_channel(
+        if await self.adb.is_admin(update.effective_user.id):
+            success = await self.adb.add_channel(
                 forwarded_from.id,
                 forwarded_from.username,
                 forwarded_from.title,
@@ -1135,19 +4445,18 @@ Choose an option below to get started:
                 
                 # Backup to GitHub if configured
                 if self.github_backup.token:
-                    data = self.db.export_data()
-                    self.github_backup.backup_database(data)
+                    self.schedule_backup('purchase')
             else:
                 await update.message.reply_text("❌ Error adding channel. Please try again.")
             
             return
         
         # For regular users - require stars
-        bot_username = (await self.application.bot.get_me()).username
+        bot_username = (await self.metadata.get_me(self.application.bot)).username
         stars_required = pricing['stars']
         
         # Create payment record
-        payment_id = self.db.add_payment(
+        payment_id = await self.adb.add_payment(
             update.effective_user.id,
             forwarded_from.id,
             stars_required,
@@ -1197,10 +4506,10 @@ Your promotion will be activated automatically after payment verification.
                     
                     # Check if bot is admin in the channel
                     try:
-                        chat_member = await context.bot.get_chat_member(chat.id, context.bot.id)
-                        if chat_member.status in ['administrator', 'creator']:
+                        bot_status = await self.metadata.get_bot_status(context.bot, chat.id, refresh=True)
+                        if bot_status in ['administrator', 'creator']:
                             # Add to target channels (bot stays in channel permanently)
-                            self.db.add_target_channel(
+                            await self.adb.add_target_channel(
                                 chat.id,
                                 chat.username,
                                 chat.title
@@ -1227,6 +4536,14 @@ Your promotion will be activated automatically after payment verification.
         except Exception as e:
             logger.error(f"Error handling bot addition: {e}")
     
+    @staticmethod
+    def get_stars_paid(message):
+        """Stars paid in a message - Telegram Stars arrive as a successful_payment in XTR"""
+        payment = message.successful_payment if message else None
+        if payment and payment.currency == 'XTR':
+            return payment.total_amount
+        return None
+    
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle regular messages including payment receipts"""
         # First check if this is a command that should bypass join check
@@ -1240,31 +4557,34 @@ Your promotion will be activated automatically after payment verification.
         user_data = context.user_data
         
         # Check if this might be a payment receipt
-        if (update.message and update.message.star and 
-            'pending_payment' in user_data):
+        stars_sent = self.get_stars_paid(update.message)
+        if stars_sent and 'pending_payment' in user_data:
             
             payment_data = user_data['pending_payment']
-            stars_sent = update.message.star
             
             if stars_sent == payment_data['stars_required']:
-                # Payment successful
-                self.db.complete_payment(payment_data['payment_id'])
-                
-                success = self.db.add_channel(
+                # Payment successful - applied once per Telegram charge, however often the update arrives
+                charge_id = update.message.successful_payment.telegram_payment_charge_id or f"update:{update.update_id}"
+                success = await self.adb.record_payment(
+                    charge_id,
+                    payment_data['payment_id'],
+                    update.effective_user.id,
                     payment_data['channel_id'],
                     payment_data['username'],
                     payment_data['title'],
-                    update.effective_user.id,
+                    stars_sent,
                     self.pricing[payment_data['duration']]['days']
                 )
                 
-                if success:
+                if success is None:
+                    logger.info(f"ℹ️ Payment {charge_id} already applied, ignoring redelivery")
+                elif success:
                     await update.message.reply_text(
                         f"✅ **Payment Received!**\n\n"
                         f"📢 Channel: @{payment_data['username']}\n"
                         f"⏰ Duration: {payment_data['duration'].replace('months', ' Months').title()}\n"
                         f"💫 Stars: {payment_data['stars_required']}\n"
-                        f"📅 Expires: {self.pricing[payment_data['duration']]['days']} days\n\n"
+                        f"📅 Expires: {success.strftime('%Y-%m-%d %H:%M')}\n\n"
                         f"Your channel is now being promoted across our network!",
                         parse_mode='Markdown',
                         reply_markup=InlineKeyboardMarkup([
@@ -1274,8 +4594,7 @@ Your promotion will be activated automatically after payment verification.
                     
                     # Backup to GitHub
                     if self.github_backup.token:
-                        data = self.db.export_data()
-                        self.github_backup.backup_database(data)
+                        self.schedule_backup('purchase')
                 else:
                     await update.message.reply_text("❌ Error activating promotion. Please contact admin.")
                 
@@ -1287,7 +4606,7 @@ Your promotion will be activated automatically after payment verification.
                 )
     
     async def admin(self, update: Update, context: ContextTypes.DEFAULT_TYPE, from_callback=False):
-        if not self.db.is_admin(update.effective_user.id):
+        if not await self.adb.is_admin(update.effective_user.id):
             if from_callback:
                 await update.callback_query.answer("❌ Admin access required.", show_alert=True)
                 return
@@ -1313,30 +4632,56 @@ Your promotion will be activated automatically after payment verification.
             await update.message.reply_text(text, reply_markup=reply_markup, parse_mode='Markdown')
     
     async def show_admin_stats(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        active_channels = self.db.get_active_channels()
-        expired_channels = self.db.get_expired_channels()
-        target_channels = self.db.get_target_channels()
+        active_count, ending_count = await self.adb.count_channels()
+        target_channels = await self.adb.get_target_channels()
+        
+        # Trends come from the stats rollups, a few rows each
+        now = datetime.now()
+        totals = await self.adb.get_stats_totals()
+        last_day = {}
+        for _, counters in await self.adb.get_stats_series('hour', now.replace(minute=0, second=0, microsecond=0) - timedelta(hours=23)):
+            for metric, value in counters.items():
+                last_day[metric] = last_day.get(metric, 0) + value
+        week = await self.adb.get_stats_series('day', now.replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=6))
         
         stats_text = f"""
 📊 **Bot Statistics**
 
-✅ Active Promotions: {len(active_channels)}
-❌ Expired Channels: {len(expired_channels)}
+✅ Active Promotions: {active_count}
+⏳ Ending Now: {ending_count}
+❌ Expired Channels: {totals.get('promotions_expired', 0)}
 🎯 Target Channels: {len(target_channels)}
 
-**Active Promotions:**
+**Last 24 Hours:**
+🆕 New Promotions: {last_day.get('promotions_started', 0)}
+💰 Payments: {last_day.get('payments_completed', 0)} ({last_day.get('stars_earned', 0)} ⭐)
+📢 Posts: {last_day.get('promotion_posts', 0)}
+
+**Last 7 Days:**
 """
         
+        for day, counters in week:
+            stats_text += (
+                f"• {day.strftime('%a %d %b')}: {counters.get('promotions_started', 0)} new, "
+                f"{counters.get('stars_earned', 0)} ⭐, {counters.get('promotion_posts', 0)} posts\n"
+            )
+        
+        stats_text += (
+            f"\n**All Time:** {totals.get('promotions_started', 0)} promotions, "
+            f"{totals.get('payments_completed', 0)} payments, {totals.get('stars_earned', 0)} ⭐\n"
+            f"\n**Active Promotions:**\n"
+        )
+        
+        active_channels = await self.adb.get_active_channels()
         for channel in active_channels[:5]:  # Show first 5 channels
-            username = channel[2] or "Private"
-            title = channel[3]
-            promo_end = datetime.strptime(channel[6], '%Y-%m-%d %H:%M:%S')
-            days_left = (promo_end - datetime.now()).days
+            username = channel.channel_username or "Private"
+            title = channel.channel_title
+            days_left = (channel.promotion_end - datetime.now()).days
             
             stats_text += f"• {title} (@{username}) - {days_left} days left\n"
         
-        if len(active_channels) > 5:
-            stats_text += f"\n... and {len(active_channels) - 5} more channels"
+        if active_count > 5:
+            stats_text += f"\n... and {active_count - 5} more channels"
         
         keyboard = [[InlineKeyboardButton("🔙 Back to Admin", callback_data="main_admin")]]
         
@@ -1353,8 +4698,7 @@ Your promotion will be activated automatically after payment verification.
         
         await update.callback_query.message.reply_text("🔄 Creating backup...")
         
-        data = self.db.export_data()
-        success = self.github_backup.backup_database(data)
+        success = await self.backup_now(backup_type='manual')
         
         if success:
             await update.callback_query.message.reply_text("✅ Backup created successfully on GitHub!")
@@ -1368,19 +4712,23 @@ Your promotion will be activated automatically after payment verification.
         
         await update.callback_query.message.reply_text("🔄 Restoring from latest backup...")
         
-        backup_data = self.github_backup.load_latest_backup()
-        if backup_data:
-            success = self.db.import_data(backup_data)
-            if success:
-                await update.callback_query.message.reply_text("✅ Backup restored successfully!")
-            else:
-                await update.callback_query.message.reply_text("❌ Restore failed!")
-        else:
+        # Buffered user state would otherwise be written over the restored rows
+        await self.application.update_persistence()
+        await self.persistence.flush()
+        success = await asyncio.get_running_loop().run_in_executor(None, self.restore_from_github)
+        if success:
+            self.persistence.reload(self.application)
+        
+        if success is None:
             await update.callback_query.message.reply_text("❌ No backup found!")
+        elif success:
+            await update.callback_query.message.reply_text("✅ Backup restored successfully!")
+        else:
+            await update.callback_query.message.reply_text("❌ Restore failed!")
     
     async def manual_backup(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Manual backup command"""
-        if not self.db.is_admin(update.effective_user.id):
+        if not await self.adb.is_admin(update.effective_user.id):
             await update.message.reply_text("❌ Admin access required.")
             return
         
@@ -1390,8 +4738,7 @@ Your promotion will be activated automatically after payment verification.
         
         await update.message.reply_text("🔄 Creating backup...")
         
-        data = self.db.export_data()
-        success = self.github_backup.backup_database(data)
+        success = await self.backup_now(backup_type='manual')
         
         if success:
             await update.message.reply_text("✅ Backup created successfully!")
@@ -1404,23 +4751,25 @@ Your promotion will be activated automatically after payment verification.
         if not await self.check_join_requirement(update, context):
             return
         
-        active_channels = self.db.get_active_channels()
+        active_count, _ = await self.adb.count_channels()
+        totals = await self.adb.get_stats_totals()
         
         stats_text = f"""
 📊 **Public Statistics**
 
-✅ Active Promotions: {len(active_channels)}
+✅ Active Promotions: {active_count}
+🚀 Channels Promoted So Far: {totals.get('promotions_started', 0)}
 
 **Currently Promoting:**
 """
         
-        for channel in active_channels[:5]:  # Show first 5 channels
-            username = channel[2] or "Private"
-            title = channel[3]
+        for channel in (await self.adb.get_active_channels())[:5]:  # Show first 5 channels
+            username = channel.channel_username or "Private"
+            title = channel.channel_title
             stats_text += f"• {title} (@{username})\n"
         
-        if len(active_channels) > 5:
-            stats_text += f"\n... and {len(active_channels) - 5} more channels!"
+        if active_count > 5:
+            stats_text += f"\n... and {active_count - 5} more channels!"
         
         stats_text += "\nUse the promotion menu to add your channel!"
         
@@ -1444,132 +4793,160 @@ Your promotion will be activated automatically after payment verification.
     
     async def monitor_promotions(self, context: ContextTypes.DEFAULT_TYPE):
         """Check for expired promotions"""
-        expired_channels = self.db.get_expired_channels()
+        expired_channels = await self.adb.get_expired_channels()
         
         for channel in expired_channels:
-            channel_id = channel[1]
-            channel_name = channel[3]
-            self.db.expire_channel(channel_id)
+            channel_id = channel.channel_id
+            channel_name = channel.channel_title
+            await self.adb.expire_channel(channel_id)
             
             logger.info(f"Channel expired: {channel_name} (ID: {channel_id})")
     
     async def promote_channels(self, context: ContextTypes.DEFAULT_TYPE):
         """Promote channels across network - works even if bot is not admin"""
-        active_channels = self.db.get_active_channels()
+        active_channels = await self.adb.get_active_channels()
         
         if not active_channels:
             return
         
-        promotion_message = "📢 **Promoted Channels**\n\n"
+        target_channels = await self.adb.get_target_channels()
         
-        for channel in active_channels:
-            username = channel[2]
-            title = channel[3]
-            
-            if username:
-                promotion_message += f"• [{title}](https://t.me/{username})\n"
-            else:
-                promotion_message += f"• {title}\n"
+        # Too many promotions for one post - plan who appears where this round
+        plan = self.planner.plan(
+            active_channels,
+            [channel.channel_id for channel in target_channels],
+            round_index=await self.adb.get_job_run_count('promote_channels')
+        )
         
-        promotion_message += "\n💫 Promote your channel with @worldwidepromotion1_bot"
+        # Compiled once, rendered per target with its own rotation
+        template = PromotionTemplate.compile(
+            active_channels,
+            seed=random.randrange(1 << 16),
+            plan=plan,
+            max_lines=self.planner.slots_per_post
+        )
         
-        # Send to all target channels (even if bot is not admin)
-        target_channels = self.db.get_target_channels()
+        staging = None
+        if self.delivery_mode != 'send':
+            staging = await self.post_staging_message(context.bot, template)
         
-        successful_posts = 0
+        if self.broadcast_workers:
+            # Hand the round to the workers, one job per shard of target channels
+            payload = {'template': template.to_payload(), 'staging': staging, 'mode': self.delivery_mode}
+            for shard in range(self.broadcast_workers):
+                await self.adb.enqueue_job('broadcast', shard, payload)
+            logger.info(f"📤 Promotion round queued for {self.broadcast_workers} broadcast workers")
+            return
         
-        for channel in target_channels:
-            channel_id = channel[1]
-            channel_title = channel[3] or "Unknown"
-            
-            try:
-                # Try to send message even if bot is not admin
-                sent_message = await context.bot.send_message(
-                    chat_id=channel_id,
-                    text=promotion_message,
-                    parse_mode='Markdown',
-                    disable_web_page_preview=True
-                )
-                
-                # Store message info for deletion after 5 hours
-                self.db.add_promotion_message(channel_id, sent_message.message_id)
-                
-                successful_posts += 1
-                logger.info(f"✅ Promoted channels in: {channel_title} (ID: {channel_id})")
-                
-            except Exception as e:
-                error_msg = str(e).lower()
-                if any(x in error_msg for x in ['bot was blocked', 'chat not found', 'not enough rights', 'forbidden']):
-                    # Remove inaccessible channels
-                    self.db.remove_target_channel(channel_id)
-                    logger.info(f"❌ Removed inaccessible target channel: {channel_title} (ID: {channel_id}) - {e}")
-                else:
-                    logger.warning(f"⚠️ Could not post in {channel_title} (ID: {channel_id}): {e}")
+        # Send to all target channels (even if bot is not admin)
+        successful_posts = await self.broadcaster.send_promotions(
+            context.bot, template, target_channels, staging=staging, mode=self.delivery_mode
+        )
         
         logger.info(f"📊 Promotion round completed: {successful_posts}/{len(target_channels)} channels")
     
+    async def post_staging_message(self, bot, template):
+        """Post the round's promotion once to the staging chat, for copy/forward delivery"""
+        if not self.staging_chat:
+            logger.warning(f"⚠️ PROMOTION_DELIVERY={self.delivery_mode} needs PROMOTION_STAGING_CHAT, sending instead")
+            return None
+        try:
+            staging_message = await bot.send_message(
+                chat_id=self.staging_chat,
+                text=template.render(),
+                parse_mode='Markdown',
+                disable_web_page_preview=True
+            )
+            await self.adb.add_promotion_message(self.staging_chat, staging_message.message_id)
+            return self.staging_chat, staging_message.message_id
+        except Exception as e:
+            logger.error(f"❌ Could not post staging message, sending instead: {e}")
+            return None
+    
     async def delete_old_promotion_messages(self, context: ContextTypes.DEFAULT_TYPE):
         """Delete promotion messages after 5 hours"""
-        messages_to_delete = self.db.get_promotion_messages_to_delete()
-        
-        deleted_count = 0
-        error_count = 0
-        
-        for message in messages_to_delete:
-            channel_id = message[1]
-            message_id = message[2]
+        if self.broadcast_workers:
+            for shard in range(self.broadcast_workers):
+                await self.adb.enqueue_job('delete', shard)
+        else:
+            messages_to_delete = await self.adb.get_promotion_messages_to_delete()
             
-            try:
-                await context.bot.delete_message(
-                    chat_id=channel_id,
-                    message_id=message_id
-                )
-                self.db.mark_message_deleted(message_id)
-                deleted_count += 1
-                logger.info(f"✅ Deleted old promotion message from channel: {channel_id}")
-            except Exception as e:
-                error_count += 1
-                logger.warning(f"⚠️ Could not delete message {message_id} from {channel_id}: {e}")
-                # Mark as deleted anyway to avoid retrying
-                self.db.mark_message_deleted(message_id)
-        
-        if deleted_count > 0 or error_count > 0:
-            logger.info(f"🗑️ Message cleanup: {deleted_count} deleted, {error_count} errors")
-        
-        # Clean up old database records
-        self.db.cleanup_old_messages()
+            deleted_count, error_count = await self.broadcaster.delete_messages(context.bot, messages_to_delete)
+            
+            if deleted_count > 0 or error_count > 0:
+                logger.info(f"🗑️ Message cleanup: {deleted_count} deleted, {error_count} errors")
     
     async def health_monitor(self, context: ContextTypes.DEFAULT_TYPE):
         """Health monitoring task"""
         try:
             # Test database
-            self.db.get_active_channels()
+            await self.adb.get_active_channels()
             
             # Test GitHub connection
             if self.github_backup.token:
-                self.github_backup.load_latest_backup()
+                await asyncio.get_running_loop().run_in_executor(None, self.github_backup.latest_backup_entry)
             
-            # Test bot API
-            await context.bot.get_me()
+            # Test bot API - the real call also refreshes the cached get_me
+            await self.metadata.get_me(context.bot, refresh=True)
+            
+            # Keep the broadcast workers running
+            self.restart_dead_workers()
             
             logger.info("✅ Health check passed")
         except Exception as e:
             logger.error(f"❌ Health check failed: {e}")
     
+    async def refresh_bot_metadata(self, context: ContextTypes.DEFAULT_TYPE):
+        """Refresh cached chat metadata of the target channels"""
+        try:
+            changed = await self.metadata.refresh_targets(context.bot, await self.adb.get_target_channels())
+            await self.adb.update_target_metadata(changed)
+            if changed:
+                logger.info(f"🔄 Updated metadata of {len(changed)} target channels")
+        except Exception as e:
+            logger.error(f"Metadata refresh error: {e}")
+    
     async def keep_alive(self, context: ContextTypes.DEFAULT_TYPE):
         """Keep alive system - sends periodic requests to prevent sleeping"""
         try:
             # Simple operation to keep the bot active
-            active_channels = len(self.db.get_active_channels())
-            logger.info(f"🤖 Keep alive - {active_channels} active promotions")
+            active_channels = len(await self.adb.get_active_channels())
+            logger.info(
+                f"🤖 Keep alive - {active_channels} active promotions, "
+                f"{self.admission.in_flight} updates in flight, {self.admission.shed_count} shed, "
+                f"{self.seen_updates.dropped} redelivered dropped"
+            )
         except Exception as e:
             logger.error(f"Keep alive error: {e}")
     
+    async def flush_seen_updates(self, context: ContextTypes.DEFAULT_TYPE):
+        """Save the seen-update window if new updates came in"""
+        try:
+            await self.seen_updates.save()
+        except Exception as e:
+            logger.error(f"Seen-update flush error: {e}")
+    
+    async def evict_user_state(self, context: ContextTypes.DEFAULT_TYPE):
+        """Release memory held by idle promotion flows"""
+        try:
+            await self.persistence.evict_idle(context.application)
+        except Exception as e:
+            logger.error(f"User state eviction error: {e}")
+    
+    async def run_retention(self, context: ContextTypes.DEFAULT_TYPE):
+        """Prune old database records and reclaim disk space"""
+        report = await self.retention.run()
+        
+        removed = ", ".join(f"{table} {count}" for table, count in report['deleted'].items() if count)
+        logger.info(
+            f"🧹 Retention: {removed or 'nothing'} removed, "
+            f"reclaimed {report['reclaimed_bytes'] / 1024:.1f} KB (db {report['size_bytes'] / 1024:.1f} KB)"
+        )
+    
     async def auto_backup(self, context: ContextTypes.DEFAULT_TYPE):
         """Automatically backup database"""
         try:
-            data = self.db.export_data()
-            success = self.github_backup.backup_database(data)
+            success = await self.backup_now()
             if success:
                 logger.info("✅ Auto-backup completed successfully")
             else:
@@ -1577,70 +4954,200 @@ Your promotion will be activated automatically after payment verification.
         except Exception as e:
             logger.error(f"Auto-backup error: {e}")
     
+    async def take_snapshot(self, context: ContextTypes.DEFAULT_TYPE):
+        """Local snapshot between GitHub uploads"""
+        try:
+            await self.snapshots.take()
+        except Exception as e:
+            logger.error(f"Snapshot error: {e}")
+    
+    async def start_receiving_updates(self):
+        if self.webhook_url:
+            health_server.on_update = self.receive_update
+            await self.application.bot.set_webhook(
+                url=self.webhook_url.rstrip('/') + health_server.webhook_path,
+                secret_token=os.getenv('WEBHOOK_SECRET') or None
+            )
+            logger.info(f"✅ Receiving updates through the webhook at {health_server.webhook_path}")
+        elif self.leader is None:
+            await self.application.updater.start_polling()
+        else:
+            logger.info("ℹ️ Polling starts once this replica is leader")
+    
+    async def receive_update(self, data):
+        await self.application.update_queue.put(Update.de_json(data, self.application.bot))
+    
+    def toggle_polling(self, leading):
+        """Leader election listener - only the leader polls"""
+        self._polling_task = asyncio.create_task(self._set_polling(leading))
+    
+    async def _set_polling(self, leading):
+        async with self._polling_lock:
+            if not self.application.running:
+                return
+            if leading and not self.application.updater.running:
+                await self.application.updater.start_polling()
+                logger.info("📡 Polling for updates as leader")
+            elif not leading and self.application.updater.running:
+                await self.application.updater.stop()
+                logger.info("📴 Stopped polling, another replica leads")
+    
+    def spawn_broadcast_worker(self, shard):
+        process = multiprocessing.get_context('spawn').Process(
+            target=run_broadcast_worker,
+            args=(shard, self.broadcast_workers),
+            name=f"broadcast-worker-{shard}",
+            daemon=True
+        )
+        process.start()
+        return process
+    
+    def start_broadcast_workers(self):
+        """Spawn one broadcast worker process per shard"""
+        self.worker_processes = [self.spawn_broadcast_worker(shard) for shard in range(self.broadcast_workers)]
+        logger.info(f"✅ Started {self.broadcast_workers} broadcast workers")
+    
+    def restart_dead_workers(self):
+        for shard, process in enumerate(self.worker_processes):
+            if not process.is_alive():
+                logger.warning(f"⚠️ Broadcast worker {shard} exited ({process.exitcode}), restarting")
+                self.worker_processes[shard] = self.spawn_broadcast_worker(shard)
+    
     async def run(self):
         self.start_time = datetime.now()
         
-        # Check if JobQueue is available before setting up jobs
-        if hasattr(self.application, 'job_queue') and self.application.job_queue:
-            # Start monitoring tasks
-            self.application.job_queue.run_repeating(
-                self.monitor_promotions, 
-                interval=3600,  # Check every hour
-                first=10
-            )
-            
-            # Start promotion task
-            self.application.job_queue.run_repeating(
-                self.promote_channels,
-                interval=43200,  # Promote every 12 hours
-                first=30
-            )
-            
-            # Delete old promotion messages (5 hours)
-            self.application.job_queue.run_repeating(
-                self.delete_old_promotion_messages,
-                interval=1800,  # Check every 30 minutes
-                first=60
-            )
-            
-            # Health monitoring
-            self.application.job_queue.run_repeating(
-                self.health_monitor,
-                interval=300,  # Every 5 minutes
-                first=10
+        # Restore off the event loop so the health server keeps answering, and
+        # before polling so no update is written and then overwritten
+        with self.startup.stage('restore'):
+            await asyncio.get_running_loop().run_in_executor(None, self.load_backup_on_startup)
+        
+        with self.startup.stage('telegram'):
+            await self.application.initialize()
+            await self.application.start()
+            await self.start_receiving_updates()
+        
+        # Start monitoring tasks
+        await self.scheduler.add_job(
+            self.monitor_promotions,
+            interval=3600,  # Check every hour
+            first=10
+        )
+        
+        # Start promotion task
+        await self.scheduler.add_job(
+            self.promote_channels,
+            interval=43200,  # Promote every 12 hours
+            first=30,
+            heavy=True
+        )
+        
+        # Delete old promotion messages (5 hours)
+        await self.scheduler.add_job(
+            self.delete_old_promotion_messages,
+            interval=1800,  # Check every 30 minutes
+            first=60,
+            heavy=True
+        )
+        
+        # Health monitoring
+        await self.scheduler.add_job(
+            self.health_monitor,
+            interval=300,  # Every 5 minutes
+            first=10,
+            leader_only=False
+        )
+        
+        # Keep alive system
+        await self.scheduler.add_job(
+            self.keep_alive,
+            interval=300,  # Every 5 minutes
+            first=15,
+            leader_only=False
+        )
+        
+        # Bot API metadata of target channels
+        await self.scheduler.add_job(
+            self.refresh_bot_metadata,
+            interval=21600,  # Every 6 hours
+            first=600,
+            heavy=True
+        )
+        
+        # Evict idle conversation state
+        await self.scheduler.add_job(
+            self.evict_user_state,
+            interval=600,  # Every 10 minutes
+            first=120,
+            leader_only=False
+        )
+        
+        # Seen-update window, so a restart doesn't replay recent updates
+        await self.scheduler.add_job(
+            self.flush_seen_updates,
+            interval=5,
+            first=5,
+            leader_only=False
+        )
+        
+        # Database retention
+        await self.scheduler.add_job(
+            self.run_retention,
+            interval=21600,  # Every 6 hours
+            first=300,
+            heavy=True
+        )
+        
+        # Local snapshots between uploads
+        if self.snapshots:
+            await self.scheduler.add_job(
+                self.take_snapshot,
+                interval=int(os.getenv('SNAPSHOT_INTERVAL', 900)),  # 15 minutes
+                first=120
             )
-            
-            # Keep alive system
-            self.application.job_queue.run_repeating(
-                self.keep_alive,
-                interval=300,  # Every 5 minutes
-                first=15
+        
+        # Auto-backup every 6 hours
+        if self.github_backup.token:
+            await self.scheduler.add_job(
+                self.auto_backup,
+                interval=21600,  # 6 hours
+                first=60,
+                heavy=True
             )
-            
-            # Auto-backup every 6 hours
-            if self.github_backup.token:
-                self.application.job_queue.run_repeating(
-                    self.auto_backup,
-                    interval=21600,  # 6 hours
-                    first=60
-                )
-            
-            logger.info("✅ All scheduled tasks initialized")
-        else:
-            logger.warning("⚠️ JobQueue not available - scheduled tasks disabled")
         
-        logger.info("🤖 Starting Promotion Bot with all features...")
+        self.scheduler.start()
         
-        # Start HTTP server for Render port binding
-        http_runner = await health_server.start()
+        # TARGET_CHANNELS entries are stored unverified - check them once
+        unverified = [channel.channel_id for channel in await self.adb.get_target_channels() if not channel.channel_title]
+        if unverified:
+            self.onboarder.submit(self.application.bot, unverified)
+        logger.info("✅ All scheduled tasks initialized")
         
-        logger.info("✅ HTTP server started successfully")
+        # Start broadcast workers, one process per shard
+        if self.broadcast_workers:
+            with self.startup.stage('workers'):
+                self.start_broadcast_workers()
         
-        # Use the simple modern approach for Telegram bot
-        await self.application.run_polling()
+        health_server.state = 'running'
+        self.startup.finish()
+        logger.info("🤖 Promotion Bot running with all features")
         
-        # Cleanup (this won't be reached until bot stops)
-        await http_runner.cleanup()
+        try:
+            # Polling runs in the background until the process is stopped
+            await asyncio.Event().wait()
+        finally:
+            health_server.on_update = None
+            await self.scheduler.stop()
+            if self.application.updater.running:
+                await self.application.updater.stop()
+            if self.application.running:
+                await self.application.stop()
+            await self.application.shutdown()
+            # Let a purchase backup that is still uploading finish
+            if self._backup_task and not self._backup_task.done():
+                await asyncio.wait([self._backup_task], timeout=60)
+            self.seen_updates.flush()
+            self.adb.close()
+            self.db.engine.close()
 
 async def main():
     """Main async function to run the bot"""
@@ -1651,9 +5158,20 @@ async def main():
         
         logger.info("🚀 Starting Promotion Bot with HTTP server...")
         
-        # Create and run the bot
-        bot = PromotionBot()
-        await bot.run()
+        startup = StartupReport(BOOT_STARTED)
+        startup.record('imports', time.monotonic() - BOOT_STARTED)
+        health_server.startup = startup
+        
+        # Bind the port before anything slow so Render's port check passes
+        with startup.stage('http'):
+            http_runner = await health_server.start()
+        
+        try:
+            # Create and run the bot
+            bot = PromotionBot(startup)
+            await bot.run()
+        finally:
+            await http_runner.cleanup()
         
     except KeyboardInterrupt:
         logger.info("🛑 Bot stopped by user")
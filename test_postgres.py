@@ -0,0 +1,511 @@
+"""Tests for the PostgreSQL translation of the SQL that Database issues.
+
+Database writes its statements in SQLite's dialect, and PostgresEngine
+translates them. These tests run every Database method against a SQLite file
+and record each statement it issues. They then translate each statement with
+an engine that needs no server: table columns and conflict keys come from the
+SQLite schema, and a stand-in asyncpg connection records what
+PostgresConnection sends.
+
+Set TEST_DATABASE_URL to a scratch PostgreSQL database to also prepare every
+translated statement on a real server. Its schema is dropped and recreated.
+
+    python -m unittest test_postgres
+"""
+import os
+import re
+import sys
+import json
+import shutil
+import asyncio
+import logging
+import sqlite3
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+logging.basicConfig(format='%(levelname)s - %(message)s', level=logging.WARNING)
+os.environ.setdefault('ADMIN_USER_IDS', '42')
+os.environ.setdefault('TARGET_CHANNELS', '-1001,-1002')
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import promo_bot  # noqa: E402
+from promo_bot import Database, PostgresConnection, PostgresEngine, SQLiteEngine  # noqa: E402
+
+# Statements with no PostgreSQL counterpart - Database only issues them on SQLite,
+# staging.* is the restore file the snapshot swap attaches
+SQLITE_ONLY = re.compile(r"^\s*(PRAGMA|VACUUM|ATTACH|DETACH)\b|\bsqlite_master\b|\bstaging\.", re.I)
+TRANSACTION = re.compile(r"^\s*(BEGIN|COMMIT|END|ROLLBACK)\b", re.I)
+
+
+class RecordingCursor(sqlite3.Cursor):
+    def execute(self, sql, params=()):
+        self.connection.statements.append(sql)
+        return super().execute(sql, params)
+
+    def executemany(self, sql, rows):
+        self.connection.statements.append(sql)
+        return super().executemany(sql, rows)
+
+
+class RecordingConnection(sqlite3.Connection):
+    statements = None
+
+    def cursor(self, factory=RecordingCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, rows):
+        return self.cursor().executemany(sql, rows)
+
+
+class RecordingEngine(SQLiteEngine):
+    """SQLite engine that keeps every statement issued on its connections"""
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.statements = []
+
+    def connect(self, **kwargs):
+        conn = sqlite3.connect(self.path, factory=RecordingConnection, **kwargs)
+        conn.statements = self.statements
+        return conn
+
+
+class OfflinePostgresEngine(PostgresEngine):
+    """PostgresEngine without a server.
+
+    Table columns and conflict keys are read from a SQLite database with the
+    same schema, and the pool hands out StandInConnections.
+    """
+
+    def __init__(self, catalog_path):
+        self._tables = {}
+        self._statements = {}
+        self._loop = asyncio.new_event_loop()
+        self.catalog = sqlite3.connect(catalog_path)
+        self.pool = StandInPool()
+
+    def run(self, coroutine):
+        return self._loop.run_until_complete(coroutine)
+
+    def close(self):
+        self.catalog.close()
+        self._loop.close()
+
+    async def table_info(self, conn, table):
+        if table not in self._tables:
+            info = self.catalog.execute(f'PRAGMA table_info({table})').fetchall()
+            columns = [row[1] for row in info]
+            keys = [[row[1] for row in sorted(info, key=lambda row: row[5]) if row[5]]]
+            for index in self.catalog.execute(f'PRAGMA index_list({table})').fetchall():
+                if index[2]:
+                    keys.append([row[2] for row in self.catalog.execute(f'PRAGMA index_info({index[1]})')])
+            keys = [key for key in keys if key and key != ['id']]
+            self._tables[table] = (columns, keys[0] if keys else None)
+        return self._tables[table]
+
+
+class StandInType:
+    def __init__(self, name):
+        self.name = name
+
+
+class StandInStatement:
+    def __init__(self, sql):
+        self.sql = sql
+
+    def get_parameters(self):
+        return tuple(StandInType('unknown') for _ in re.findall(r"\$\d+", self.sql))
+
+
+class StandInConnection:
+    """Records what PostgresConnection sends to asyncpg and returns canned results"""
+
+    def __init__(self):
+        self.calls = []
+        self.rows = []
+
+    async def execute(self, sql, *args):
+        self.calls.append(('execute', sql, args))
+        command = sql.split(None, 1)[0].upper()
+        return f"{'INSERT 0' if command == 'INSERT' else command} 3"
+
+    async def fetch(self, sql, *args):
+        self.calls.append(('fetch', sql, args))
+        return self.rows
+
+    async def executemany(self, sql, rows):
+        self.calls.append(('executemany', sql, rows))
+
+    async def prepare(self, sql):
+        self.calls.append(('prepare', sql, ()))
+        return StandInStatement(sql)
+
+    def sent(self, kind=None):
+        return [sql for call, sql, _ in self.calls if kind is None or call == kind]
+
+
+class StandInPool:
+    def __init__(self):
+        self.released = []
+
+    async def acquire(self):
+        return StandInConnection()
+
+    async def release(self, conn):
+        self.released.append(conn)
+
+
+def exercise(db):
+    """Call every Database method that talks to the database"""
+    now = datetime.now().replace(microsecond=0)
+    db.is_admin(42)
+    db.add_admin(43, 'admin')
+    db.add_channel(-100500, 'chan', 'Chan', 9, 7)
+    db.add_channel(-100501, 'chan2', 'Chan2', 9, 7)
+    db.expire_channel(-100501)
+    db.add_channel(-100501, 'chan2', 'Chan2b', 9, 7)
+    db.record_payment('charge-1', None, 9, -100502, 'chan3', 'Chan3', 50, 7)
+    db.record_payment('charge-1', None, 9, -100502, 'chan3', 'Chan3', 50, 7)
+    db.get_active_channels()
+    db.get_expired_channels()
+    db.count_channels()
+    payment_id = db.add_payment(9, -100500, 10, 'week')
+    db.complete_payment(payment_id)
+    db.update_user_join_status(9, '-1001', True)
+    db.update_user_join_status(9, '-1001', False)
+    db.get_user_join_status(9, '-1001')
+    db.add_target_channel(-1003, 'x', 'X')
+    db.upsert_target_channels([(-1004, 'y', 'Y'), (-1001, 'one', 'One')])
+    db.update_target_metadata([(-1002, 'two', 'Two')])
+    db.migrate_target_channel(-1003, -1005)
+    db.get_target_channels()
+    db.save_target_health({
+        -1001: {'state': 'open', 'failures': 3, 'fatal_failures': 1, 'trips': 1, 'last_error': 'x',
+                'last_failure_at': now, 'open_until': now + timedelta(hours=1)},
+        -1002: None,
+    })
+    db.get_target_health()
+    db.remove_target_channel(-1004)
+    db.add_promotion_message(-1001, 5)
+    db.get_promotion_messages_to_delete()
+    db.mark_messages_deleted([(-1001, 5)])
+    db.get_stats_totals()
+    db.get_stats_series('day', now - timedelta(days=7))
+    db.save_user_states({1: '{"a": 1}', 2: '{"b": 2}'})
+    db.save_user_states({2: None})
+    db.get_user_state(1)
+    db.delete_user_state(1)
+    db.purge_user_states(now + timedelta(seconds=1))
+    db.enqueue_job('promote', 0, {'x': 1})
+    job = db.lease_job('w1', 0, 60)
+    db.renew_job_lease(job[0], 'w1', 60)
+    db.finish_job(job[0], 'failed')
+    db.save_scheduled_job('job', 60, now)
+    db.get_scheduled_job('job')
+    db.claim_scheduled_job('job', now - timedelta(hours=1), owner='a')
+    db.renew_scheduled_job('job', 'a', 60)
+    db.finish_scheduled_job('job', now + timedelta(minutes=1), now, 'ok')
+    db.reset_running_jobs()
+    db.reset_running_jobs(expired_only=True)
+    db.get_job_run_count('job')
+    db.merge_seen_updates('polling', lambda saved: (100, b'\x01' * 16))
+    db.get_seen_updates('polling')
+    db.delete_expired_batch('job_runs', 'started_at < ?', (now + timedelta(days=1),), 10)
+    db.get_storage_stats()
+    db.incremental_vacuum()
+    data = json.loads(json.dumps(db.export_data(), default=str))
+    db.import_data(data, verify=True)
+    db.restore_data(data)
+
+
+class TranslationTestCase(unittest.TestCase):
+    """Translates every statement the Database methods issue"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.cwd = os.getcwd()
+        # Snapshot restores stage their files next to the database
+        os.chdir(cls.directory)
+        path = os.path.join(cls.directory, 'promotion_bot.db')
+        recorder = RecordingEngine(path)
+        db = Database(engine=recorder)
+        exercise(db)
+        cls.statements = list(dict.fromkeys(
+            sql.strip() for sql in recorder.statements
+            if not SQLITE_ONLY.search(sql) and not TRANSACTION.match(sql)
+        ))
+        cls.engine = OfflinePostgresEngine(path)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.engine.close()
+        os.chdir(cls.cwd)
+        shutil.rmtree(cls.directory, ignore_errors=True)
+
+    def translate(self, sql, returning_id=True):
+        return self.engine.run(self.engine.translate(None, sql, returning_id=returning_id))
+
+    def test_every_statement_shape_was_seen(self):
+        commands = {sql.split(None, 1)[0].upper() for sql in self.statements}
+        self.assertTrue({'CREATE', 'INSERT', 'SELECT', 'UPDATE', 'DELETE'} <= commands, commands)
+        self.assertTrue(any(re.match(r"INSERT\s+OR\s+REPLACE", sql, re.I) for sql in self.statements))
+        self.assertTrue(any(re.match(r"INSERT\s+OR\s+IGNORE", sql, re.I) for sql in self.statements))
+        self.assertTrue(any('rowid' in sql for sql in self.statements))
+        self.assertTrue(any('ON CONFLICT' in sql.upper() for sql in self.statements))
+
+    def test_placeholders_are_numbered(self):
+        for sql in self.statements:
+            with self.subTest(sql=sql):
+                translated, _ = self.translate(sql)
+                without_literals = re.sub(r"'[^']*'", "''", sql)
+                numbers = [int(n) for n in re.findall(r"\$(\d+)", re.sub(r"'[^']*'", "''", translated))]
+                self.assertEqual(numbers, list(range(1, without_literals.count('?') + 1)))
+                self.assertNotIn('?', re.sub(r"'[^']*'", "''", translated))
+
+    def test_no_sqlite_dialect_left(self):
+        leftovers = re.compile(r"INSERT\s+OR\b|\browid\b|datetime\('now'\)|julianday\(|AUTOINCREMENT", re.I)
+        for sql in self.statements:
+            with self.subTest(sql=sql):
+                translated, _ = self.translate(sql)
+                self.assertIsNone(leftovers.search(translated), translated)
+
+    def test_insert_or_becomes_on_conflict(self):
+        for sql in self.statements:
+            insert_or = re.match(r"INSERT\s+OR\s+(REPLACE|IGNORE)\s+INTO\s+(\w+)", sql, re.I)
+            if not insert_or:
+                continue
+            with self.subTest(sql=sql):
+                translated, _ = self.translate(sql)
+                if insert_or.group(1).upper() == 'IGNORE':
+                    self.assertIn('ON CONFLICT DO NOTHING', translated)
+                else:
+                    _, key = self.engine.run(self.engine.table_info(None, insert_or.group(2)))
+                    self.assertIsNotNone(key, f"{insert_or.group(2)} has no conflict key")
+                    self.assertRegex(translated, rf"ON CONFLICT \({', '.join(key)}\) DO (UPDATE SET|NOTHING)")
+
+    def test_inserts_return_new_id(self):
+        for sql in self.statements:
+            if not sql.upper().startswith('INSERT'):
+                continue
+            with self.subTest(sql=sql):
+                table = re.match(r"INSERT\s+(?:OR\s+\w+\s+)?INTO\s+(\w+)", sql, re.I).group(1)
+                columns, _ = self.engine.run(self.engine.table_info(None, table))
+                translated, returns_id = self.translate(sql)
+                self.assertEqual(returns_id, 'id' in columns and 'RETURNING' not in sql.upper())
+                self.assertEqual(translated.endswith(' RETURNING id'), returns_id)
+
+    def test_ddl_column_types(self):
+        for sql in self.statements:
+            if not sql.upper().startswith('CREATE TABLE'):
+                continue
+            with self.subTest(sql=sql):
+                translated, returns_id = self.translate(sql)
+                self.assertFalse(returns_id)
+                self.assertNotRegex(translated, r"\b(INTEGER|DATETIME|REAL|BLOB)\b")
+                if 'AUTOINCREMENT' in sql:
+                    self.assertIn('BIGSERIAL PRIMARY KEY', translated)
+
+    def test_placeholder_inside_literal(self):
+        translated, _ = self.translate("SELECT id FROM channels WHERE channel_title = '?' AND channel_id = ?")
+        self.assertEqual(translated, "SELECT id FROM channels WHERE channel_title = '?' AND channel_id = $1")
+
+    def test_insert_or_replace(self):
+        translated, returns_id = self.translate(
+            'INSERT OR REPLACE INTO user_state (user_id, data, updated_at) VALUES (?, ?, ?)')
+        self.assertEqual(translated, (
+            'INSERT INTO user_state (user_id, data, updated_at) VALUES ($1, $2, $3)'
+            ' ON CONFLICT (user_id) DO UPDATE SET data = EXCLUDED.data, updated_at = EXCLUDED.updated_at'
+        ))
+        self.assertFalse(returns_id)
+
+    def test_insert_or_replace_resets_left_out_columns(self):
+        translated, returns_id = self.translate(
+            'INSERT OR REPLACE INTO channels (channel_id, channel_title) VALUES (?, ?)')
+        columns, key = self.engine.run(self.engine.table_info(None, 'channels'))
+        self.assertEqual(key, ['channel_id'])
+        for column in columns:
+            if column not in ('id', 'channel_id'):
+                self.assertIn(f"{column} = EXCLUDED.{column}", translated)
+        self.assertTrue(returns_id)
+        self.assertTrue(translated.endswith(' RETURNING id'))
+
+    def test_insert_or_ignore(self):
+        translated, returns_id = self.translate(
+            'INSERT OR IGNORE INTO target_channels (channel_id, auto_added) VALUES (?, ?)')
+        self.assertEqual(translated, (
+            'INSERT INTO target_channels (channel_id, auto_added) VALUES ($1, $2)'
+            ' ON CONFLICT DO NOTHING RETURNING id'
+        ))
+        self.assertTrue(returns_id)
+
+    def test_upsert_passes_through(self):
+        sql = ('INSERT INTO stats_rollup (period, bucket, metric, value) VALUES (?, ?, ?, ?) '
+               'ON CONFLICT(period, bucket, metric) DO UPDATE SET value = stats_rollup.value + excluded.value')
+        translated, returns_id = self.translate(sql)
+        self.assertEqual(translated, sql.replace('?, ?, ?, ?', '$1, $2, $3, $4'))
+        self.assertFalse(returns_id)
+
+    def test_rowid_batches(self):
+        translated, _ = self.translate(
+            'DELETE FROM job_runs WHERE rowid IN (SELECT rowid FROM job_runs WHERE started_at < ? LIMIT ?)')
+        self.assertEqual(
+            translated, 'DELETE FROM job_runs WHERE ctid IN (SELECT ctid FROM job_runs WHERE started_at < $1 LIMIT $2)')
+
+    def test_date_functions(self):
+        translated, _ = self.translate(
+            "SELECT julianday('now') - julianday(created_at), datetime('now') FROM payments WHERE id = ?")
+        self.assertEqual(translated, (
+            "SELECT (EXTRACT(EPOCH FROM (now() AT TIME ZONE 'UTC')) / 86400.0) - (EXTRACT(EPOCH FROM created_at) / 86400.0),"
+            " (now() AT TIME ZONE 'UTC') FROM payments WHERE id = $1"
+        ))
+
+    def test_add_column(self):
+        translated, returns_id = self.translate(
+            'ALTER TABLE scheduled_jobs ADD COLUMN IF NOT EXISTS running_until DATETIME', returning_id=False)
+        self.assertEqual(translated, 'ALTER TABLE scheduled_jobs ADD COLUMN IF NOT EXISTS running_until TIMESTAMP')
+        self.assertFalse(returns_id)
+
+    def test_statements_are_cached(self):
+        conn = StandInConnection()
+        sql = 'SELECT channel_id FROM channels WHERE status = ?'
+        first = self.engine.run(self.engine.statement(conn, sql))
+        second = self.engine.run(self.engine.statement(conn, sql))
+        self.assertIs(first, second)
+        self.assertEqual(conn.sent('prepare'), ['SELECT channel_id FROM channels WHERE status = $1'])
+
+
+class ConnectionTestCase(unittest.TestCase):
+    """What PostgresConnection sends for the sqlite3 calls Database makes"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        path = os.path.join(self.directory, 'catalog.db')
+        cwd = os.getcwd()
+        os.chdir(self.directory)
+        try:
+            Database(engine=SQLiteEngine(path))
+        finally:
+            os.chdir(cwd)
+        self.engine = OfflinePostgresEngine(path)
+
+    def tearDown(self):
+        self.engine.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_reads_open_no_transaction(self):
+        conn = self.engine.connect()
+        conn.conn.rows = [(1, 'chan')]
+        rows = conn.execute('SELECT channel_id, channel_username FROM channels WHERE status = ?', ('active',)).fetchall()
+        self.assertEqual(rows, [(1, 'chan')])
+        self.assertNotIn('BEGIN', conn.conn.sent())
+        self.assertFalse(conn.in_transaction)
+
+    def test_insert_returns_lastrowid(self):
+        conn = self.engine.connect()
+        stand_in = conn.conn
+        stand_in.rows = [(17,)]
+        cursor = conn.cursor()
+        cursor.execute('INSERT INTO payments (user_id, channel_id, amount, duration) VALUES (?, ?, ?, ?)',
+                       (9, -100500, 10, 'week'))
+        self.assertEqual(cursor.lastrowid, 17)
+        self.assertEqual(stand_in.sent('execute'), ['BEGIN'])
+        self.assertEqual(stand_in.sent('fetch'), [
+            'INSERT INTO payments (user_id, channel_id, amount, duration) VALUES ($1, $2, $3, $4) RETURNING id'])
+        conn.commit()
+        self.assertEqual(stand_in.sent('execute')[-1], 'COMMIT')
+        conn.close()
+        self.assertEqual(self.engine.pool.released, [stand_in])
+
+    def test_update_rowcount_from_status(self):
+        conn = self.engine.connect()
+        cursor = conn.execute("UPDATE channels SET status = 'expired' WHERE channel_id = ?", (1,))
+        self.assertEqual(cursor.rowcount, 3)
+        self.assertEqual(conn.conn.sent('execute'),
+                         ['BEGIN', "UPDATE channels SET status = 'expired' WHERE channel_id = $1"])
+
+    def test_begin_immediate_takes_write_lock(self):
+        conn = self.engine.connect(isolation_level=None)
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute('UPDATE jobs SET status = ? WHERE id = ?', ('done', 1))
+        conn.execute('COMMIT')
+        self.assertEqual(conn.conn.calls[:2], [
+            ('execute', 'BEGIN', ()),
+            ('execute', 'SELECT pg_advisory_xact_lock($1)', (PostgresEngine.WRITE_LOCK,)),
+        ])
+        self.assertEqual(conn.conn.sent('execute').count('BEGIN'), 1)
+        self.assertEqual(conn.conn.sent('execute')[-1], 'COMMIT')
+        self.assertFalse(conn.in_transaction)
+
+    def test_autocommit_writes_open_no_transaction(self):
+        conn = self.engine.connect(isolation_level=None)
+        conn.execute('DELETE FROM user_state WHERE user_id = ?', (1,))
+        self.assertEqual(conn.conn.sent('execute'), ['DELETE FROM user_state WHERE user_id = $1'])
+
+    def test_executemany_prepares_once(self):
+        conn = self.engine.connect()
+        conn.executemany('UPDATE target_channels SET channel_username = ? WHERE channel_id = ?',
+                         [('a', 1), ('b', 2)])
+        conn.executemany('UPDATE target_channels SET channel_username = ? WHERE channel_id = ?', [('c', 3)])
+        self.assertEqual(len(conn.conn.sent('prepare')), 1)
+        self.assertEqual(len(conn.conn.sent('executemany')), 2)
+
+    def test_ddl_clears_caches(self):
+        conn = self.engine.connect()
+        conn.execute('SELECT id FROM channels WHERE channel_id = ?', (1,))
+        self.assertTrue(self.engine._statements)
+        conn.execute('ALTER TABLE channels ADD COLUMN IF NOT EXISTS note TEXT')
+        self.assertEqual(self.engine._statements, {})
+        self.assertEqual(self.engine._tables, {})
+
+    def test_values_are_coerced_like_sqlite(self):
+        types = [StandInType(name) for name in ('int8', 'bool', 'timestamp', 'float8', 'text')]
+        values = PostgresConnection._coerce(('-1001', 'true', '2024-01-02 03:04:05', 3, 7), types)
+        self.assertEqual(values, [-1001, True, datetime(2024, 1, 2, 3, 4, 5), 3.0, '7'])
+
+
+@unittest.skipUnless(os.getenv('TEST_DATABASE_URL'), 'TEST_DATABASE_URL is not set')
+class ServerTestCase(TranslationTestCase):
+    """Prepares every translated statement on a real PostgreSQL server"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = promo_bot.create_engine(os.getenv('TEST_DATABASE_URL'))
+        conn = cls.server.connect(isolation_level=None)
+        conn.execute('DROP SCHEMA public CASCADE')
+        conn.execute('CREATE SCHEMA public')
+        conn.close()
+        Database(engine=cls.server)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.close()
+        super().tearDownClass()
+
+    def test_statements_prepare_on_server(self):
+        async def prepare(sql):
+            conn = await self.server.pool.acquire()
+            try:
+                translated, _ = await self.server.translate(conn, sql, returning_id=True)
+                await conn.prepare(translated)
+                return translated
+            finally:
+                await self.server.pool.release(conn)
+
+        for sql in self.statements:
+            if sql.upper().startswith(('CREATE', 'ALTER')):
+                continue
+            with self.subTest(sql=sql):
+                self.assertEqual(self.server.run(prepare(sql)), self.translate(sql)[0])
+
+    def test_database_runs_on_server(self):
+        exercise(Database(engine=self.server))
+
+
+if __name__ == '__main__':
+    unittest.main()